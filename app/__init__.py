@@ -1,4 +1,11 @@
 from config import Config
+from app.cache import SearchCache
+from app.distances import DistanceMatrix
+from app.identity import IdentityCache
+from app.instrumentation import QueryInstrumentation
+from app.outbox import Outbox
+from app.quotes import QuoteStore
+from app.reference import ReferenceCache
 from flask import Flask, render_template
 from flask_login import LoginManager
 from flask_mail import Mail
@@ -13,6 +20,13 @@ migrate = Migrate()
 login = LoginManager()
 mail = Mail()
 search = Search()
+search_cache = SearchCache()
+distance_matrix = DistanceMatrix()
+outbox = Outbox()
+quote_store = QuoteStore()
+identity_cache = IdentityCache()
+reference_cache = ReferenceCache()
+query_instrumentation = QueryInstrumentation()
 
 
 def create_app(config_class=Config) -> "Flask":
@@ -25,10 +39,28 @@ def create_app(config_class=Config) -> "Flask":
     login.init_app(app)
     mail.init_app(app)
     search.init_app(app)
+    search_cache.init_app(app)
+    distance_matrix.init_app(app)
+    outbox.init_app(app)
+    quote_store.init_app(app)
+    identity_cache.init_app(app)
+    reference_cache.init_app(app)
+    query_instrumentation.init_app(app)
 
     if app.config.get('USE_SESSION', True) != False:
-        Session(app)
-        SqlAlchemySessionInterface(app, db, "sessions", "sess_")
+        if app.config.get('SESSION_TYPE') == 'cached_sqlalchemy':
+            from app.sessions import CachedSqlAlchemySessionInterface
+            app.session_interface = CachedSqlAlchemySessionInterface(
+                app,
+                db,
+                app.config.get('SESSION_SQLALCHEMY_TABLE', 'sessions'),
+                app.config.get('SESSION_KEY_PREFIX', 'session:'),
+                app.config.get('SESSION_USE_SIGNER', False),
+                app.config.get('SESSION_PERMANENT', True),
+            )
+        else:
+            Session(app)
+            SqlAlchemySessionInterface(app, db, "sessions", "sess_")
 
     from app.auth import bp as auth_bp
     app.register_blueprint(auth_bp)
@@ -45,6 +77,9 @@ def create_app(config_class=Config) -> "Flask":
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
+    from app.models import resume_cancellations
+    app.cli.add_command(resume_cancellations)
+
     @app.errorhandler(HTTPException)
     def handle_error(error):
         code = error.code
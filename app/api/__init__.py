@@ -1,7 +1,10 @@
 from flask import Blueprint
 from flask_restful import Api
 
+from app.api.representations import output_json
+
 bp = Blueprint("api", __name__)
 api = Api(bp)
+api.representation("application/json")(output_json)
 
 from app.api import airports, airplanes, flights, itineraries, users, auth, checkout, purchases
\ No newline at end of file
@@ -1,8 +1,9 @@
 from distutils.util import strtobool
 
-from app import db, models
+from app import db, models, search_cache
 from app.api import api
 from app.api.helpers import get_or_404, json_abort, role_required
+from app.graph import route_graph
 from app.forms import AirplaneForm
 from flask_restful import Resource, reqparse, request
 from sqlalchemy.exc import IntegrityError
@@ -73,6 +74,8 @@ class Airplane(Resource):
         airplane = get_or_404(models.Airplane, id)
         db.session.delete(airplane)
         db.session.commit()
+        route_graph.invalidate()
+        search_cache.clear()
         return "", 204
 
     @role_required('admin')
@@ -82,6 +85,9 @@ class Airplane(Resource):
         if form.validate():
             form.populate_obj(airplane)
             airplane.home_id = form.home_id
+            models.FlightInstance.update_capacity(
+                [flight.id for flight in airplane.flights], airplane.capacity
+            )
             try:
                 db.session.commit()
                 db.session.refresh(airplane)
@@ -93,5 +99,7 @@ class Airplane(Resource):
                         "registration_number": "An airplane with this registration number already exists"
                     },
                 )
+            route_graph.update_airplane(airplane)
+            search_cache.invalidate_flights(flight.id for flight in airplane.flights)
             return airplane.to_dict(), 201
         json_abort(400, message=form.errors)
@@ -1,7 +1,8 @@
-from app import db, models
+from app import db, distance_matrix, models, search_cache
 from app.api import api
 from app.api.helpers import code_to_airport, get_or_404, json_abort, role_required
 from app.forms import AirportForm
+from app.graph import route_graph
 from flask_restful import Resource, reqparse, request
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import HTTPException
@@ -44,6 +45,8 @@ class Airports(Resource):
                 json_abort(
                     409, message={"code": "An airport with this code already exists"}
                 )
+            distance_matrix.update_airport(airport)
+            route_graph.invalidate()
             return airport.to_dict(), 201
         json_abort(400, message=form.errors)
 
@@ -69,6 +72,8 @@ class Airport(Resource):
         airport = get_or_404(models.Airport, id)
         db.session.delete(airport)
         db.session.commit()
+        route_graph.invalidate()
+        search_cache.clear()
         return "", 204
 
     @role_required("admin")
@@ -86,5 +91,12 @@ class Airport(Resource):
                 json_abort(
                     409, message={"code": "An airport with this code already exists"}
                 )
+            # The airports location and timezone may have changed
+            distance_matrix.update_airport(airport)
+            for flight in airport.departures + airport.arrivals:
+                flight.update_route()
+            db.session.commit()
+            route_graph.invalidate()
+            search_cache.clear()
             return airport.to_dict(), 201
         json_abort(400, message=form.errors)
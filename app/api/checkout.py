@@ -1,10 +1,11 @@
-from app import db, models
+import datetime as dt
+
+from app import db, models, outbox, quote_store, search_cache
 from app.api import api
-from app.api.helpers import get_or_404, json_abort, str_to_date
-from app.email import send_email
+from app.api.helpers import get_or_404, json_abort
+from app.email import queue_email
 from app.forms import PurchaseTransactionForm
 from app.helpers import calculate_taxes
-from flask import render_template, session
 from flask_login import current_user
 from flask_restful import Resource, request
 
@@ -14,21 +15,19 @@ class Checkout(Resource):
     def post(self):
         form = PurchaseTransactionForm(data=request.json)
         if form.validate():
-            # Get itinerary from session data
-            itineraries = session["itineraries"]
             transactions = []
             for itinerary_field in form.itineraries:
-                itinerary = itineraries.get(itinerary_field.data)
-                if itinerary is None:
+                quote = quote_store.get(itinerary_field.data)
+                if quote is None:
                     json_abort(404, message="Quote is not longer valid")
 
                 flights = [
                     get_or_404(
                         models.Flight, id, "One ore more flights are no longer available."
                     )
-                    for id in itinerary["flights"]
+                    for id in quote.flight_ids
                 ]
-                departure_date = str_to_date(itinerary["departure_date"])
+                departure_date = quote.date
 
                 user = models.User.query.filter_by(email=form.email.data).first()
 
@@ -39,8 +38,10 @@ class Checkout(Resource):
                     form.email.data
                 )
                 transaction.departure_date = departure_date
-                transaction.departure_id = itinerary["departure_airport"]
-                transaction.destination_id = itinerary["destination_airport"]
+                # Set here instead of by the database so the sales rollup uses the same date.
+                transaction.purchase_timestamp = dt.datetime.utcnow()
+                transaction.departure_id = flights[0].departure_id
+                transaction.destination_id = flights[-1].arrival_id
 
                 form_user = -1
                 if user is not None:
@@ -63,7 +64,10 @@ class Checkout(Resource):
 
                 base_fare = 0
                 for flight in flights:
-                    if not flight.available_seats(departure_date) >= num_of_passengers:
+                    # Reserve the seats now so two customers can't buy the last seats.
+                    if not models.FlightInstance.sell(
+                        flight, departure_date, num_of_passengers
+                    ):
                         json_abort(
                             400, message=f"Flight {flight.number} is no longer available"
                         )
@@ -90,28 +94,29 @@ class Checkout(Resource):
                 db.session.add(transaction)
                 transactions.append(transaction)
 
+            # Queue the confirmations in the same transaction as the purchase.
+            db.session.flush()
+            for transaction in transactions:
+                models.AgentDailySales.record_sale(transaction)
+                queue_email(
+                    "Your Purchase Confirmation",
+                    transaction.email,
+                    "email/purchase_confirmation",
+                    transaction=transaction,
+                )
+
             db.session.commit()
+            outbox.notify()
+            # Seats were sold so any cached searches using these flights are out of date.
+            search_cache.invalidate_flights(
+                ticket.flight_id
+                for transaction in transactions
+                for ticket in transaction.tickets
+            )
             items = []
             for transaction in transactions:
                 db.session.refresh(transaction)
                 items.append(transaction.to_dict(expand=True))
-                itinerary = models.TripItinerary(
-                    transaction.departure_date, transaction.flights
-                )
-                send_email(
-                    "Your Purchase Confirmation",
-                    [transaction.email],
-                    render_template(
-                        "email/purchase_confirmation.txt",
-                        transaction=transaction,
-                        itinerary=itinerary,
-                    ),
-                    render_template(
-                        "email/purchase_confirmation.html",
-                        transaction=transaction,
-                        itinerary=itinerary,
-                    ),
-                )
             return items
 
         json_abort(400, message=form.errors)
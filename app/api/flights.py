@@ -1,19 +1,22 @@
 import datetime as dt
+import json
 from distutils.util import strtobool
-import smtplib
 
 from werkzeug.exceptions import HTTPException
+from flask import current_app
 from flask_login import current_user
 
-from app import db, models
+from app import db, models, search_cache
 from app.api import api
+from app.graph import route_graph
+from app.rebooking import RebookingPlanner
 from app.api.helpers import (
     get_or_404,
     json_abort,
     role_required,
     str_to_date,
 )
-from app.forms import FlightCancellationForm, FlightForm
+from app.forms import BulkCancellationForm, FlightCancellationForm, FlightForm
 from flask_restful import Resource, reqparse, request
 
 
@@ -23,6 +26,10 @@ class Flights(Resource):
         parser = reqparse.RequestParser()
         parser.add_argument("per_page", type=int, default=25, location="args")
         parser.add_argument("page", type=int, default=1, location="args")
+        parser.add_argument(
+            "cursor", type=models.PaginatedAPIMixin.decode_cursor, location="args"
+        )
+        parser.add_argument("count", type=strtobool, default=False, location="args")
         parser.add_argument("search", location="args")
         parser.add_argument("expand", type=strtobool, default=False, location="args")
         parser.add_argument("active", type=strtobool, default=False, location="args")
@@ -30,6 +37,8 @@ class Flights(Resource):
         args = parser.parse_args()
         items_per_page = args["per_page"]
         page = args["page"]
+        cursor = args["cursor"]
+        count = args["count"]
         search = args["search"]
         expand = args["expand"]
         active = args["active"]
@@ -45,7 +54,14 @@ class Flights(Resource):
             query = query.msearch(f"{search}*")
 
         data = models.Flight.to_collection_dict(
-            query, page, items_per_page, "api.flights", expand=expand, search=search
+            query,
+            page,
+            items_per_page,
+            "api.flights",
+            cursor=cursor,
+            count=count,
+            expand=expand,
+            search=search,
         )
         return data
 
@@ -58,6 +74,9 @@ class Flights(Resource):
             db.session.add(flight)
             db.session.commit()
             db.session.refresh(flight)
+            route_graph.add_flight(flight)
+            # New routes can show up in any search
+            search_cache.clear()
             return flight.to_dict(), 201
         json_abort(400, message=form.errors)
 
@@ -88,6 +107,8 @@ class Flight(Resource):
         flight = get_or_404(models.Flight, id)
         db.session.delete(flight)
         db.session.commit()
+        route_graph.remove_flight(flight.id)
+        search_cache.invalidate_flights([flight.id])
         return "", 204
 
     @role_required("admin")
@@ -96,8 +117,11 @@ class Flight(Resource):
         form = FlightForm(data=request.json)
         if form.validate():
             form.populate_obj(flight)
+            models.FlightInstance.update_capacity([flight.id], flight.airplane.capacity)
             db.session.commit()
             db.session.refresh(flight)
+            route_graph.update_flight(flight)
+            search_cache.clear()
             return flight.to_dict(), 200
         json_abort(400, message=form.errors)
 
@@ -137,6 +161,46 @@ class FlightStatus(Resource):
         return {"status": status, "tickets": tickets}
 
 
+@api.resource("/flights/<id>/rebooking")
+class FlightRebooking(Resource):
+    @role_required(["agent", "admin"])
+    def get(self, id):
+        parser = reqparse.RequestParser()
+        parser.add_argument("date", type=str_to_date, required=True, location="args")
+        parser.add_argument(
+            "max_days",
+            type=int,
+            default=2,
+            choices=range(RebookingPlanner.MAX_DAYS + 1),
+            location="args",
+        )
+        parser.add_argument("max_layovers", type=int, default=2, location="args")
+        parser.add_argument("expand", type=strtobool, default=False, location="args")
+        args = parser.parse_args()
+
+        flight = get_or_404(models.Flight, id)
+        planner = RebookingPlanner(
+            flight,
+            args["date"],
+            max_days=args["max_days"],
+            max_layovers=args["max_layovers"],
+        )
+        proposals = planner.plan()
+        return {
+            "items": [proposal.to_dict(args["expand"]) for proposal in proposals],
+            "_meta": {
+                "total_items": len(proposals),
+                "passengers": sum(len(proposal.tickets) for proposal in proposals),
+                "unplaced": sum(
+                    len(proposal.tickets)
+                    for proposal in proposals
+                    if proposal.itinerary is None
+                ),
+                "searches": planner.searches,
+            },
+        }
+
+
 @api.resource("/flights/<id>/cancel")
 class FlightCancellation(Resource):
     @role_required(["agent", "admin"])
@@ -144,8 +208,45 @@ class FlightCancellation(Resource):
         flight: models.Flight = get_or_404(models.Flight, id)
         form = FlightCancellationForm(data=request.json)
         if form.validate():
-            try:
-                flight.cancel(form.date.data, current_user.id)
-            except smtplib.SMTPServerDisconnected:
-                json_abort(500, message="Failed to send cancellation emails")
-            return "", 204
+            summary = flight.cancel(form.date.data, current_user.id)
+            return summary.to_dict(), 200
+
+
+@api.resource("/flights/cancellations")
+class FlightCancellations(Resource):
+    @role_required(["agent", "admin"])
+    def post(self):
+        form = BulkCancellationForm(data=request.json)
+        if form.validate():
+            job = models.CancellationJob(
+                created_by=current_user.id,
+                airport_id=form.airport.data.id if form.airport.data else None,
+                flight_ids=json.dumps(form.flights.data) if form.flights.data else None,
+                start=form.start.data,
+                end=form.end.data,
+            )
+            job.plan()
+            db.session.add(job)
+            db.session.commit()
+            job.submit()
+            data = job.to_dict()
+            return data, 202, {"Location": data["self"]}
+
+        json_abort(400, message=form.errors)
+
+
+@api.resource("/flights/cancellations/<int:id>")
+class FlightCancellationJob(Resource):
+    @role_required(["agent", "admin"])
+    def get(self, id):
+        return get_or_404(models.CancellationJob, id).to_dict()
+
+    @role_required(["agent", "admin"])
+    def post(self, id):
+        """Resume a job that failed or whose process died."""
+        job: models.CancellationJob = get_or_404(models.CancellationJob, id)
+        timeout = current_app.config.get("CANCELLATION_JOB_TIMEOUT", 300)
+        if not job.claim(timeout):
+            json_abort(409, message="Only failed or stalled jobs can be resumed")
+        job.submit()
+        return job.to_dict(), 202
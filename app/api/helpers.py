@@ -7,6 +7,7 @@ from flask import jsonify
 from flask_login import current_user
 from flask_restful import abort
 
+from app import reference_cache
 from app.models import Airport
 
 
@@ -60,14 +61,17 @@ def owner_or_role_required(roles: Union[str, List[str]], is_owner = _is_owner):
 
 T = TypeVar('T')
 def get_or_404(model: Type[T], id, message: str = "Resource not found") -> T:
-    item = model.query.get(int(id))
+    if reference_cache.caches(model):
+        item = reference_cache.get(model, int(id))
+    else:
+        item = model.query.get(int(id))
     if item is None:
         json_abort(404, message=message)
     return item
 
 
 def code_to_airport(code: str, error_message: str = None) -> Airport:
-    airport = Airport.query.filter_by(code=code).first()
+    airport = reference_cache.airport_by_code(code)
     if not airport:
         if not error_message:
             error_message = "Invalid airport code."
@@ -2,10 +2,9 @@ import datetime as dt
 from distutils.util import strtobool
 from operator import attrgetter
 
-from app import models
+from app import models, quote_store, search_cache
 from app.api import api
-from app.api.helpers import code_to_airport, json_abort, str_to_datetime
-from flask import session
+from app.api.helpers import code_to_airport, json_abort, role_required, str_to_datetime
 from flask_restful import Resource, reqparse
 
 
@@ -27,6 +26,9 @@ class FlightSearch(Resource):
         parser.add_argument("min_layover_time", type=int, default=45, location="args")
         parser.add_argument("expand", type=strtobool, default=False, location="args")
         parser.add_argument("limit", type=int, default=10, location="args")
+        parser.add_argument(
+            "engine", default="dfs", choices=models.SEARCH_ENGINES, location="args"
+        )
         args = parser.parse_args()
 
         expand = args["expand"]
@@ -37,46 +39,45 @@ class FlightSearch(Resource):
         max_layovers = args["max_layovers"]
         min_layover_time = dt.timedelta(seconds=args["min_layover_time"]*60)
         limit = args["limit"]
+        engine = args["engine"]
 
         if departure_dt.date() < dt.datetime.utcnow().date():
             json_abort(400, message='Departure date must be in the future')
 
-        itineraries = models.TripItinerary.search(
-            departing_airport=departure.id,
-            final_airport=arrival.id,
-            departure_dt=departure_dt,
-            num_of_passengers=num_of_passengers,
-            max_layovers=max_layovers,
-            min_layover_time=min_layover_time,
-            limit=limit
+        cache_key = search_cache.key(
+            departure.id,
+            arrival.id,
+            departure_dt,
+            num_of_passengers,
+            max_layovers,
+            min_layover_time,
+            limit,
+            engine,
         )
+        paths = search_cache.get(cache_key)
+        if paths is not None:
+            itineraries = models.TripItinerary.from_paths(paths)
+        else:
+            snapshot = search_cache.snapshot()
+            itineraries = models.TripItinerary.search(
+                departing_airport=departure.id,
+                final_airport=arrival.id,
+                departure_dt=departure_dt,
+                num_of_passengers=num_of_passengers,
+                max_layovers=max_layovers,
+                min_layover_time=min_layover_time,
+                limit=limit,
+                engine=engine,
+            )
+            search_cache.set(cache_key, itineraries, snapshot)
         # Sort the itineraries by the number of layovers, departure time, and total time.
         itineraries.sort(key=attrgetter("departure_datetime", "total_time"))
         # Slice the list to limit the results.
         # Always do this after sorting so we get the best results.
         itineraries = itineraries[:limit]
 
-        if "itineraries" not in session:
-            session["itineraries"] = dict()
-
-        session_itineraries = session["itineraries"]
-
-        # Store the quotes in the session object so we can retrieve them at checkout
-        session_itineraries.update(
-            {
-                itinerary.id: {
-                    "base_fare": itinerary.base_fare,
-                    "total_price": itinerary.cost,
-                    "departure_airport": itinerary.departure_airport.id,
-                    "destination_airport": itinerary.arrival_airport.id,
-                    "departure_date": itinerary.departure_datetime.date().isoformat(),
-                    "flights": [flight.flight.id for flight in itinerary.flights],
-                }
-                for itinerary in itineraries
-            }
-        )
-
-        session["itineraries"] = session_itineraries
+        # Store the quotes so we can retrieve them at checkout
+        quote_store.add(itineraries)
 
         return {
             "items": [
@@ -87,3 +88,15 @@ class FlightSearch(Resource):
                 "total_items": len(itineraries),
             },
         }
+
+
+@api.resource("/flights/search/cache")
+class FlightSearchCache(Resource):
+    @role_required("admin")
+    def get(self):
+        return search_cache.stats()
+
+    @role_required("admin")
+    def delete(self):
+        search_cache.clear()
+        return "", 204
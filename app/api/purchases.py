@@ -1,14 +1,20 @@
+import datetime as dt
+from collections import Counter
 from distutils.util import strtobool
 
-from app import db, models
+from app import db, models, outbox, search_cache
 from app.api import api
-from app.api.helpers import get_or_404, json_abort, owner_or_role_required, str_to_date
-from app.email import send_email
+from app.api.helpers import (
+    get_or_404,
+    json_abort,
+    owner_or_role_required,
+    role_required,
+    str_to_date,
+)
+from app.email import queue_email
 from app.forms import TransactionRefundForm
-from flask import render_template
 from flask_login import current_user
 from flask_restful import Resource, reqparse, request
-from sqlalchemy import func
 
 
 @api.resource("/purchases")
@@ -17,12 +23,18 @@ class Purchases(Resource):
         parser = reqparse.RequestParser()
         parser.add_argument("per_page", type=int, default=25, location="args")
         parser.add_argument("page", type=int, default=1, location="args")
+        parser.add_argument(
+            "cursor", type=models.PaginatedAPIMixin.decode_cursor, location="args"
+        )
+        parser.add_argument("count", type=strtobool, default=False, location="args")
         parser.add_argument("search", location="args")
         parser.add_argument("expand", type=strtobool, default=False, location="args")
 
         args = parser.parse_args()
         items_per_page = args["per_page"]
         page = args["page"]
+        cursor = args["cursor"]
+        count = args["count"]
         search = args["search"]
         expand = args["expand"]
 
@@ -31,7 +43,14 @@ class Purchases(Resource):
             query = query.msearch(f"{search}*")
 
         data = models.PurchaseTransaction.to_collection_dict(
-            query, page, items_per_page, "api.userpurchases", id=id, expand=expand
+            query,
+            page,
+            items_per_page,
+            "api.purchases",
+            cursor=cursor,
+            count=count,
+            search=search,
+            expand=expand,
         )
         return data
 
@@ -58,16 +77,29 @@ class UserPurchases(Resource):
         parser = reqparse.RequestParser()
         parser.add_argument("per_page", type=int, default=25, location="args")
         parser.add_argument("page", type=int, default=1, location="args")
+        parser.add_argument(
+            "cursor", type=models.PaginatedAPIMixin.decode_cursor, location="args"
+        )
+        parser.add_argument("count", type=strtobool, default=False, location="args")
         parser.add_argument("expand", type=strtobool, default=False, location="args")
 
         args = parser.parse_args()
         items_per_page = args["per_page"]
         page = args["page"]
+        cursor = args["cursor"]
+        count = args["count"]
         expand = args["expand"]
 
         query = models.PurchaseTransaction.query.filter_by(email=user.email)
         data = models.PurchaseTransaction.to_collection_dict(
-            query, page, items_per_page, "api.userpurchases", id=id, expand=expand
+            query,
+            page,
+            items_per_page,
+            "api.userpurchases",
+            cursor=cursor,
+            count=count,
+            id=id,
+            expand=expand,
         )
         return data
 
@@ -98,6 +130,44 @@ class AgentSales(Resource):
         
         return data
 
+
+@api.resource("/agents/sales")
+class AgentsSales(Resource):
+    @role_required("admin")
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument("start", type=str_to_date, required=True, location="args")
+        parser.add_argument("end", type=str_to_date, required=True, location="args")
+        parser.add_argument("group", default="date", location="args")
+        parser.add_argument("rank", type=strtobool, default=False, location="args")
+        parser.add_argument("top", type=int, location="args")
+
+        args = parser.parse_args()
+        start = args["start"]
+        end = args["end"]
+        group = args["group"]
+        top = args["top"]
+
+        if group not in ("date", "month"):
+            json_abort(400, message="group must be either date or month")
+        if top is not None and top < 1:
+            json_abort(400, message="top must be at least 1")
+        if end < start:
+            json_abort(400, message="end must be on or after start")
+
+        items = models.Agent.sales_leaderboard(
+            start, end, group=group, ranked=args["rank"], top=top
+        )
+        return {
+            "items": items,
+            "_meta": {
+                "start": start.isoformat(),
+                "end": end.isoformat(),
+                "group": group,
+                "total_items": len(items),
+            },
+        }
+
 def _test_owner(**kwargs):
     id = kwargs.get("id")
     purchase: models.PurchaseTransaction = get_or_404(models.PurchaseTransaction, id)
@@ -115,6 +185,7 @@ class PurchaseRefund(Resource):
         if form.validate():
             fare_refund = 0
             refunded_tickets = []
+            now = dt.datetime.utcnow()
             for ticket_field in form.tickets:
                 found = False
                 for ticket in purchase.tickets:
@@ -123,7 +194,7 @@ class PurchaseRefund(Resource):
                         # Only refund tickets that haven't already been refunded.
                         if ticket.refund_timestamp is None:
                             refunded_tickets.append(ticket)
-                            ticket.refund_timestamp = func.now()
+                            ticket.refund_timestamp = now
                             fare_refund += ticket.purchase_price
                             # TODO: What happens if the agent is refunding their own ticket?
                             # Should that be logged as "refunded by"?
@@ -136,23 +207,26 @@ class PurchaseRefund(Resource):
                         400,
                         message=f"Ticket {ticket_field.data} does not belong to transaction {purchase.id}",
                     )
-            db.session.commit()
+            # Put the seats back into the inventory
+            for flight, count in Counter(ticket.flight for ticket in refunded_tickets).items():
+                models.FlightInstance.release(flight, purchase.departure_date, count)
 
             taxes_refund = (purchase.taxes / len(purchase.tickets)) * len(refunded_tickets)
-
-            text_body = render_template(
-                "email/return.txt",
-                fare_refund=fare_refund,
-                taxes_refund=taxes_refund,
-                refunded_tickets=refunded_tickets,
+            models.AgentDailySales.record_refunds(
+                [(purchase, fare_refund + taxes_refund)], now
             )
-            html_body = render_template(
-                "email/return.html",
+            queue_email(
+                "Purchase Refund",
+                purchase.email,
+                "email/return",
                 fare_refund=fare_refund,
                 taxes_refund=taxes_refund,
                 refunded_tickets=refunded_tickets,
             )
-            send_email("Purchase Refund", [purchase.email], text_body, html_body)
+
+            db.session.commit()
+            outbox.notify()
+            search_cache.invalidate_flights(ticket.flight_id for ticket in refunded_tickets)
 
             return "", 204
         
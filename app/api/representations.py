@@ -0,0 +1,96 @@
+import datetime as dt
+import json
+from collections.abc import Sequence
+from typing import Any, Callable, Dict, Iterator
+
+from flask import Response, current_app, make_response, stream_with_context
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    """Encode the types our models return that JSON doesn't support.
+    Dates and times are formatted the same way orjson formats them.
+    """
+    if isinstance(obj, (dt.datetime, dt.date, dt.time)):
+        return obj.isoformat()
+    if isinstance(obj, dt.timedelta):
+        return str(obj)
+    # The lazy items of a collection. See models.ItemDicts
+    if isinstance(obj, Sequence) and not isinstance(obj, (str, bytes)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _json_dumps(data: Any) -> bytes:
+    settings = dict(current_app.config.get("RESTFUL_JSON", {}))
+    if current_app.debug:
+        settings.setdefault("indent", 4)
+    return json.dumps(data, default=_default, **settings).encode()
+
+
+def _orjson_dumps(data: Any) -> bytes:
+    options = orjson.OPT_NON_STR_KEYS
+    return orjson.dumps(data, default=_default, option=options)
+
+
+ENCODERS: Dict[str, Callable[[Any], bytes]] = {"json": _json_dumps}
+if orjson is not None:
+    ENCODERS["orjson"] = _orjson_dumps
+
+
+def get_encoder() -> Callable[[Any], bytes]:
+    """The encoder set by API_JSON_ENCODER. Defaults to orjson when it's installed."""
+    name = current_app.config.get("API_JSON_ENCODER")
+    if name is None:
+        # Keep the indented output while debugging
+        name = "orjson" if orjson is not None and not current_app.debug else "json"
+    try:
+        return ENCODERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown JSON encoder {name}")
+
+
+def _stream(data: Dict[str, Any], dumps: Callable[[Any], bytes]) -> Iterator[bytes]:
+    """Encode a collection one item at a time so the whole body
+    never has to be built in memory at once.
+    """
+    yield b"{"
+    first = True
+    for key, value in data.items():
+        if not first:
+            yield b","
+        first = False
+        yield dumps(key) + b":"
+        if key != "items":
+            yield dumps(value)
+            continue
+
+        yield b"["
+        for index, item in enumerate(value):
+            if index:
+                yield b","
+            yield dumps(item)
+        yield b"]"
+    yield b"}\n"
+
+
+def output_json(data: Any, code: int, headers=None) -> Response:
+    """Makes a Flask response with a JSON encoded body"""
+    dumps = get_encoder()
+
+    threshold = current_app.config.get("API_JSON_STREAM_THRESHOLD", 1000)
+    items = data.get("items") if isinstance(data, dict) else None
+    if threshold and isinstance(items, Sequence) and len(items) > threshold:
+        response = Response(
+            stream_with_context(_stream(data, dumps)), code, mimetype="application/json"
+        )
+    else:
+        # always end the json dumps with a new line
+        response = make_response(dumps(data) + b"\n", code)
+        response.mimetype = "application/json"
+    response.headers.extend(headers or {})
+    return response
@@ -1,6 +1,6 @@
 import uuid
 
-from app import db, models
+from app import db, identity_cache, models
 from app.api import api
 from app.api.helpers import (
     get_or_404,
@@ -57,8 +57,10 @@ class UserResource(Resource):
 
     def delete(self, id):
         user: self.__model__ = get_or_404(self.__model__, id)
+        user_id = user.id
         db.session.delete(user)
         db.session.commit()
+        identity_cache.invalidate(user_id)
         return "", 204
 
     def patch(self, id):
@@ -82,6 +84,7 @@ class UserResource(Resource):
 
             form.populate_obj(user)
             db.session.commit()
+            identity_cache.invalidate(user.id)
             db.session.refresh(user)
             return user.to_dict(), 200
         json_abort(400, message=form.errors)
@@ -0,0 +1,238 @@
+import datetime as dt
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Any, Iterable, List, Optional
+
+from cachelib import BaseCache, MemcachedCache, NullCache, RedisCache
+from flask import current_app
+
+# A search result without any of the flights loaded.
+CachedPath = namedtuple("CachedPath", ["date", "flight_ids"])
+
+
+class MemoryCache(BaseCache):
+    """Thread safe in process cache with LRU and TTL eviction.
+
+    A threshold of 0 means the cache is never trimmed.
+    """
+
+    def __init__(self, threshold: int = 500, default_timeout: int = 300) -> None:
+        super().__init__(default_timeout)
+        self._threshold = threshold
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _expires(self, timeout: Optional[int]) -> float:
+        timeout = self._normalize_timeout(timeout)
+        if timeout == 0:
+            return 0
+        return time.monotonic() + timeout
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires and expires <= time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = None) -> bool:
+        with self._lock:
+            self._cache[key] = (self._expires(timeout), value)
+            self._cache.move_to_end(key)
+            if self._threshold:
+                while len(self._cache) > self._threshold:
+                    self._cache.popitem(last=False)
+        return True
+
+    def add(self, key: str, value: Any, timeout: Optional[int] = None) -> bool:
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def has(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def inc(self, key: str, delta: int = 1) -> int:
+        with self._lock:
+            expires, value = self._cache.get(key, (0, 0))
+            value = (value or 0) + delta
+            self._cache[key] = (expires, value)
+            return value
+
+    def clear(self) -> bool:
+        with self._lock:
+            self._cache.clear()
+        return True
+
+
+def create_backend(cache_type: str, url: str = None, threshold: int = 500, timeout: int = 300) -> BaseCache:
+    """Create a cache backend. Supports memory, redis, memcached and null."""
+    if cache_type == "memory":
+        return MemoryCache(threshold=threshold, default_timeout=timeout)
+    if cache_type == "redis":
+        import redis
+
+        client = redis.from_url(url or "redis://localhost:6379/0")
+        return RedisCache(host=client, default_timeout=timeout, key_prefix="redeye:")
+    if cache_type == "memcached":
+        servers = url.split(",") if url else ["127.0.0.1:11211"]
+        return MemcachedCache(servers=servers, default_timeout=timeout, key_prefix="redeye:")
+    if cache_type == "null":
+        return NullCache()
+    raise ValueError(f"Unknown cache type {cache_type}")
+
+
+class _SearchCacheState:
+    def __init__(self, entries: BaseCache, versions: BaseCache) -> None:
+        self.entries = entries
+        # Versions have to outlive the entries that depend on them
+        # or an evicted version could make a stale entry look valid.
+        self.versions = versions
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+
+class SearchCache:
+    """Caches itinerary search results.
+
+    Each entry remembers the version of every flight it uses. Anything that
+    changes a flight's availability bumps its version which makes every entry
+    using that flight stale. Clearing the cache bumps a global generation.
+
+    Every invalidation also bumps a counter before the versions. Searches
+    take a snapshot of it before they run and their result isn't cached if
+    it changed, since the versions read afterwards may already include a
+    change the search didn't see.
+    """
+
+    def __init__(self, app=None) -> None:
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        cache_type = app.config.get("SEARCH_CACHE_TYPE", "memory")
+        url = app.config.get("SEARCH_CACHE_URL")
+        threshold = app.config.get("SEARCH_CACHE_SIZE", 1024)
+        timeout = app.config.get("SEARCH_CACHE_TIMEOUT", 300)
+
+        entries = create_backend(cache_type, url, threshold, timeout)
+        if cache_type == "memory":
+            versions = MemoryCache(threshold=0, default_timeout=0)
+        else:
+            versions = entries
+        app.extensions["search_cache"] = _SearchCacheState(entries, versions)
+
+    @property
+    def _state(self) -> _SearchCacheState:
+        return current_app.extensions["search_cache"]
+
+    @staticmethod
+    def key(
+        departure_id: int,
+        arrival_id: int,
+        departure_dt: dt.datetime,
+        num_of_passengers: int,
+        max_layovers: int,
+        min_layover_time: dt.timedelta,
+        limit: int,
+        engine: str,
+    ) -> str:
+        minutes = int(min_layover_time.total_seconds() // 60)
+        return (
+            f"search:{departure_id}:{arrival_id}:{departure_dt.isoformat()}:"
+            f"{num_of_passengers}:{max_layovers}:{minutes}:{limit}:{engine}"
+        )
+
+    @staticmethod
+    def _version_key(flight_id) -> str:
+        return f"flight-version:{flight_id}"
+
+    def _bump(self, key: str) -> None:
+        versions = self._state.versions
+        # Some backends can't increment a key that doesn't exist.
+        versions.add(key, 0, timeout=0)
+        versions.inc(key)
+
+    def snapshot(self) -> Any:
+        """Taken before searching and passed to set."""
+        return self._state.versions.get(self._version_key("invalidations"))
+
+    def _versions(self, flight_ids: Iterable) -> List:
+        keys = [self._version_key(id) for id in flight_ids]
+        return list(self._state.versions.get_many(*keys)) if keys else []
+
+    def get(self, key: str) -> Optional[List[CachedPath]]:
+        state = self._state
+        entry = state.entries.get(key)
+        if entry is not None:
+            flight_ids, versions, paths = entry
+            current = self._versions(["generation"] + flight_ids)
+            if current == versions:
+                with state.lock:
+                    state.hits += 1
+                return [
+                    CachedPath(dt.date.fromisoformat(date), ids) for date, ids in paths
+                ]
+            state.entries.delete(key)
+
+        with state.lock:
+            state.misses += 1
+        return None
+
+    def set(self, key: str, itineraries, snapshot: Any) -> None:
+        """Cache the result of a search that started at snapshot."""
+        paths = [
+            (
+                itinerary.flights[0].date.isoformat(),
+                [flight.flight.id for flight in itinerary.flights],
+            )
+            for itinerary in itineraries
+        ]
+        flight_ids = sorted({id for _, ids in paths for id in ids})
+        versions = self._versions(["generation"] + flight_ids)
+        # Read after the versions so an invalidation that bumped them is seen here.
+        if self.snapshot() != snapshot:
+            return
+        self._state.entries.set(key, (flight_ids, versions, paths))
+
+    def invalidate_flights(self, flight_ids: Iterable[int]) -> None:
+        """Mark every cached search using one of these flights as stale."""
+        state = self._state
+        self._bump(self._version_key("invalidations"))
+        for id in set(flight_ids):
+            self._bump(self._version_key(id))
+        with state.lock:
+            state.invalidations += 1
+
+    def clear(self) -> None:
+        """Mark every cached search as stale. Used when new routes are added."""
+        state = self._state
+        self._bump(self._version_key("invalidations"))
+        self._bump(self._version_key("generation"))
+        with state.lock:
+            state.invalidations += 1
+
+    def stats(self) -> dict:
+        state = self._state
+        total = state.hits + state.misses
+        return {
+            "hits": state.hits,
+            "misses": state.misses,
+            "hit_rate": round(state.hits / total, 4) if total else 0.0,
+            "invalidations": state.invalidations,
+        }
@@ -0,0 +1,336 @@
+import os
+import tempfile
+import threading
+from itertools import chain
+from typing import Dict, Optional, Sequence
+
+import geopy.distance
+import numpy as np
+from flask import current_app, has_app_context
+
+# WGS-84, the same ellipsoid geopy uses by default.
+_A = 6378137.0
+_F = 1 / 298.257223563
+_B = (1 - _F) * _A
+_METERS_PER_MILE = 1609.344
+# Rows of the matrix computed at once. Keeps the temporary arrays small.
+_BLOCK_SIZE = 256
+# Single precision is still well under a mile and halves the size of the matrix.
+_DTYPE = np.float32
+
+
+def _vincenty_terms(lam, sin_u1, cos_u1, sin_u2, cos_u2):
+    sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+    sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+    cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+    sigma = np.arctan2(sin_sigma, cos_sigma)
+    sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+    cos2_alpha = 1 - sin_alpha**2
+    # Both points are on the equator when cos2_alpha is 0
+    cos_2sigma_m = np.where(
+        cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha
+    )
+    return sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m
+
+
+def vincenty(lat1, lon1, lat2, lon2, iterations: int = 200):
+    """Vectorized Vincenty inverse formula.
+
+    Accepts scalars or arrays that broadcast together and returns a tuple of
+    the distances in miles and a mask of the pairs that converged. Nearly
+    antipodal points may not converge and need to be solved some other way.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+        *(np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    )
+    shape = lat1.shape
+    L = (lon2 - lon1).reshape(-1)
+    U1 = np.arctan((1 - _F) * np.tan(lat1.reshape(-1)))
+    U2 = np.arctan((1 - _F) * np.tan(lat2.reshape(-1)))
+    sin_u1, cos_u1 = np.sin(U1), np.cos(U1)
+    sin_u2, cos_u2 = np.sin(U2), np.cos(U2)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lam = L.copy()
+        converged = np.zeros(L.shape, dtype=bool)
+        # Only keep iterating on the pairs that haven't converged yet.
+        active = np.arange(L.size)
+        for _ in range(iterations):
+            previous = lam[active]
+            terms = _vincenty_terms(
+                previous, sin_u1[active], cos_u1[active], sin_u2[active], cos_u2[active]
+            )
+            sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m = terms
+            C = _F / 16 * cos2_alpha * (4 + _F * (4 - 3 * cos2_alpha))
+            updated = L[active] + (1 - C) * _F * sin_alpha * (
+                sigma
+                + C
+                * sin_sigma
+                * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m**2))
+            )
+            lam[active] = updated
+            done = np.abs(updated - previous) < 1e-12
+            converged[active[done]] = True
+            active = active[~done]
+            if not active.size:
+                break
+
+        terms = _vincenty_terms(lam, sin_u1, cos_u1, sin_u2, cos_u2)
+        sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m = terms
+        u2 = cos2_alpha * (_A**2 - _B**2) / _B**2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = (
+            B
+            * sin_sigma
+            * (
+                cos_2sigma_m
+                + B
+                / 4
+                * (
+                    cos_sigma * (-1 + 2 * cos_2sigma_m**2)
+                    - B
+                    / 6
+                    * cos_2sigma_m
+                    * (-3 + 4 * sin_sigma**2)
+                    * (-3 + 4 * cos_2sigma_m**2)
+                )
+            )
+        )
+        meters = _B * A * (sigma - delta_sigma)
+
+    meters = meters.reshape(shape)
+    converged = converged.reshape(shape)
+    return meters / _METERS_PER_MILE, converged & np.isfinite(meters)
+
+
+def geodesic(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distance in miles between two points."""
+    miles, converged = vincenty(lat1, lon1, lat2, lon2)
+    if converged:
+        return float(miles)
+    return geopy.distance.geodesic((lat1, lon1), (lat2, lon2)).miles
+
+
+def _distance_block(
+    lats: np.ndarray, lons: np.ndarray, rows: slice, start: int = 0
+) -> np.ndarray:
+    """Distances from the airports in rows to every airport from start on."""
+    miles, converged = vincenty(
+        lats[rows, None], lons[rows, None], lats[None, start:], lons[None, start:]
+    )
+    for i, j in zip(*np.nonzero(~converged)):
+        row, column = rows.start + i, start + j
+        miles[i, j] = geopy.distance.geodesic(
+            (lats[row], lons[row]), (lats[column], lons[column])
+        ).miles
+    return miles
+
+
+class _DistanceState:
+    def __init__(self, path: Optional[str]) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = False
+        # airport id -> row in the matrix
+        self.index: Dict[int, int] = {}
+        self.latitudes = np.empty(0)
+        self.longitudes = np.empty(0)
+        self.matrix = np.empty((0, 0))
+
+
+class DistanceMatrix:
+    """Precomputed distances in miles between every pair of airports.
+
+    The matrix is built once for every airport in the database. When
+    DISTANCE_MATRIX_PATH is set it is saved to disk and memory mapped so every
+    worker shares the same pages, otherwise it's kept in memory. Building it
+    takes a few seconds so saved matrices should be built ahead of time with
+    init_db.py --create-distances instead of by the first request. Airports that
+    aren't in the matrix or have moved since it was built fall back to
+    calculating the distance directly.
+    """
+
+    def __init__(self, app=None) -> None:
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        app.extensions["distance_matrix"] = _DistanceState(
+            app.config.get("DISTANCE_MATRIX_PATH")
+        )
+
+    @property
+    def _state(self) -> _DistanceState:
+        return current_app.extensions["distance_matrix"]
+
+    @staticmethod
+    def _coords_path(path: str) -> str:
+        return os.path.splitext(path)[0] + ".coords.npy"
+
+    def _ensure_loaded(self, state: _DistanceState) -> None:
+        if state.loaded:
+            return
+        with state.lock:
+            if state.loaded:
+                return
+            from app.models import Airport
+
+            rows = (
+                Airport.query.with_entities(
+                    Airport.id, Airport.latitude, Airport.longitude
+                )
+                .order_by(Airport.id)
+                .all()
+            )
+            coords = np.array(rows, dtype=np.float64).reshape(-1, 3)
+            if not self._load(state, coords):
+                self._build(state, coords)
+            state.loaded = True
+
+    def _set_coords(self, state: _DistanceState, coords: np.ndarray) -> None:
+        state.index = {int(id): row for row, id in enumerate(coords[:, 0])}
+        state.latitudes = coords[:, 1].copy()
+        state.longitudes = coords[:, 2].copy()
+
+    def _load(self, state: _DistanceState, coords: np.ndarray) -> bool:
+        """Memory map the saved matrix if it matches the airports in the database."""
+        if not state.path or not os.path.exists(state.path):
+            return False
+        try:
+            saved = np.load(self._coords_path(state.path))
+            matrix = np.load(state.path, mmap_mode="r+")
+        except (OSError, ValueError):
+            return False
+        if saved.shape != coords.shape or not np.array_equal(saved, coords):
+            return False
+        if matrix.shape != (len(coords), len(coords)) or matrix.dtype != _DTYPE:
+            return False
+        self._set_coords(state, coords)
+        state.matrix = matrix
+        return True
+
+    def _save(self, state: _DistanceState, coords: np.ndarray, matrix: np.ndarray) -> None:
+        """Write the matrix next to the configured path and memory map it."""
+        directory = os.path.dirname(os.path.abspath(state.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".npy")
+        os.close(fd)
+        out = np.lib.format.open_memmap(
+            tmp, mode="w+", dtype=_DTYPE, shape=matrix.shape
+        )
+        out[:] = matrix
+        out.flush()
+        del out
+        np.save(self._coords_path(state.path), coords)
+        # Replacing the file keeps other processes on their old mapping
+        # until they reload instead of reading a half written matrix.
+        os.replace(tmp, state.path)
+        state.matrix = np.load(state.path, mmap_mode="r+")
+
+    def _build(self, state: _DistanceState, coords: np.ndarray) -> None:
+        self._set_coords(state, coords)
+        count = len(coords)
+        matrix = np.empty((count, count), dtype=_DTYPE)
+        for start in range(0, count, _BLOCK_SIZE):
+            rows = slice(start, min(start + _BLOCK_SIZE, count))
+            # The matrix is symmetric so only the upper triangle is calculated.
+            block = _distance_block(state.latitudes, state.longitudes, rows, start)
+            matrix[rows, start:] = block
+            matrix[start:, rows] = block.T
+
+        if state.path:
+            self._save(state, coords, matrix)
+        else:
+            state.matrix = matrix
+
+    def _row(self, state: _DistanceState, airport) -> Optional[int]:
+        row = state.index.get(airport.id)
+        if row is None:
+            return None
+        # The airport has moved but the matrix hasn't been updated yet.
+        if (
+            state.latitudes[row] != airport.latitude
+            or state.longitudes[row] != airport.longitude
+        ):
+            return None
+        return row
+
+    def distance(self, start, end) -> float:
+        """Distance in miles between two airports."""
+        if has_app_context() and start.id is not None and end.id is not None:
+            state = self._state
+            self._ensure_loaded(state)
+            i, j = self._row(state, start), self._row(state, end)
+            if i is not None and j is not None:
+                return float(state.matrix[i, j])
+        return geodesic(start.latitude, start.longitude, end.latitude, end.longitude)
+
+    def build(self) -> None:
+        """Load the matrix now, building and saving it if it's out of date."""
+        state = self._state
+        self.invalidate()
+        self._ensure_loaded(state)
+
+    def distances(self, starts: Sequence[int], ends: Sequence[int]) -> np.ndarray:
+        """Distances in miles from each airport id in starts to each one in ends.
+
+        Every airport has to be in the database.
+        """
+        state = self._state
+        self._ensure_loaded(state)
+        if any(id not in state.index for id in chain(starts, ends)):
+            # Added without update_airport being called.
+            self.invalidate()
+            self._ensure_loaded(state)
+        rows = [state.index[id] for id in starts]
+        columns = [state.index[id] for id in ends]
+        return np.asarray(state.matrix[np.ix_(rows, columns)])
+
+    def invalidate(self) -> None:
+        """Rebuild the matrix from the database the next time it's used."""
+        state = self._state
+        with state.lock:
+            state.loaded = False
+
+    def update_airport(self, airport) -> None:
+        """Add an airport to the matrix or update it after it has moved."""
+        state = self._state
+        if not state.loaded:
+            # It'll be picked up when the matrix is loaded
+            return
+
+        with state.lock:
+            count = len(state.index)
+            row = state.index.get(airport.id)
+            if row is None:
+                # Grow the matrix by one airport
+                row = count
+                count += 1
+                matrix = np.empty((count, count), dtype=_DTYPE)
+                matrix[:row, :row] = state.matrix
+                state.index[airport.id] = row
+                state.latitudes = np.append(state.latitudes, airport.latitude)
+                state.longitudes = np.append(state.longitudes, airport.longitude)
+            else:
+                matrix = state.matrix
+                state.latitudes[row] = airport.latitude
+                state.longitudes[row] = airport.longitude
+
+            distances = _distance_block(
+                state.latitudes, state.longitudes, slice(row, row + 1)
+            )[0]
+            matrix[row, :] = distances
+            matrix[:, row] = distances
+
+            if state.path:
+                ids = sorted(state.index, key=state.index.get)
+                coords = np.column_stack(
+                    (np.array(ids, dtype=np.float64), state.latitudes, state.longitudes)
+                )
+                if matrix is state.matrix:
+                    matrix.flush()
+                    np.save(self._coords_path(state.path), coords)
+                else:
+                    self._save(state, coords, matrix)
+            else:
+                state.matrix = matrix
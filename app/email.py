@@ -1,9 +1,12 @@
+import datetime as dt
+import json
 import logging
+from typing import Any, Callable, Dict, List, Tuple
 
-from flask import render_template
+from flask import current_app, has_request_context, render_template, request
 from flask_mail import Message
 
-from app import mail
+from app import db, mail
 
 
 def send_email(subject, recipients, text_body, html_body):
@@ -23,15 +26,109 @@ def send_email(subject, recipients, text_body, html_body):
     return True
 
 
-def send_bulk_email(subject, recipients, text_template, html_template):
-    with mail.connect() as conn:
-        for email, data in recipients:
-            msg = Message(subject=subject, recipients=[email])
-            msg.body = render_template(text_template, **data)
-            msg.html = render_template(html_template, **data)
-            try:
-                conn.send(msg)
-            except Exception as e:
-                logging.getLogger(__name__).error(
-                    "Unable to send email", exc_info=e, stack_info=True
-                )
+def _dump_context(value: Any) -> Any:
+    """Convert template variables into something that can be stored as JSON.
+    Models are stored by id and loaded again when the email is rendered.
+    """
+    if isinstance(value, db.Model):
+        return {"__model__": type(value).__name__, "id": value.id}
+    if isinstance(value, dt.datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, dt.date):
+        return {"__date__": value.isoformat()}
+    if isinstance(value, dict):
+        return {key: _dump_context(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_dump_context(item) for item in value]
+    return value
+
+
+def _load_context(value: Any) -> Any:
+    from app import models
+
+    if isinstance(value, list):
+        return [_load_context(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "__model__" in value:
+        return db.session.get(getattr(models, value["__model__"]), value["id"])
+    if "__datetime__" in value:
+        return dt.datetime.fromisoformat(value["__datetime__"])
+    if "__date__" in value:
+        return dt.date.fromisoformat(value["__date__"])
+    return {key: _load_context(item) for key, item in value.items()}
+
+
+def _purchase_confirmation(context: Dict[str, Any]) -> None:
+    from app.models import TripItinerary
+
+    transaction = context["transaction"]
+    context["itinerary"] = TripItinerary(
+        transaction.departure_date, transaction.flights
+    )
+
+
+# Extra template variables that can't be stored and have to be rebuilt.
+CONTEXT_BUILDERS: Dict[str, Callable[[Dict[str, Any]], None]] = {
+    "email/purchase_confirmation": _purchase_confirmation,
+}
+
+
+def _outbox_row(subject: str, recipient: str, template: str, context) -> Dict[str, Any]:
+    return {
+        "subject": subject,
+        "recipient": recipient,
+        "template": template,
+        "context": json.dumps(_dump_context(context)),
+        # Templates use external urls so remember where the request came from.
+        "base_url": request.url_root if has_request_context() else None,
+    }
+
+
+def queue_email(subject: str, recipient: str, template: str, **context) -> "EmailOutbox":
+    """Add an email to the outbox to be sent by the outbox workers.
+
+    The email is part of the current transaction so it's only sent if the
+    transaction is committed. template is the name of the template without
+    the extension, both the .txt and .html versions are rendered. Any models
+    in context must already have an id so call db.session.flush() first
+    if they were just created.
+    """
+    from app.models import EmailOutbox
+
+    email = EmailOutbox(**_outbox_row(subject, recipient, template, context))
+    db.session.add(email)
+    return email
+
+
+def queue_bulk_email(
+    subject: str, template: str, recipients: List[Tuple[str, Dict[str, Any]]]
+) -> None:
+    """Same as queue_email for a list of (email, context) pairs
+    but inserted with a single statement.
+    """
+    from app.models import EmailOutbox
+
+    if not recipients:
+        return
+    db.session.bulk_insert_mappings(
+        EmailOutbox,
+        [
+            _outbox_row(subject, email, template, context)
+            for email, context in recipients
+        ],
+    )
+
+
+def render_email(email: "EmailOutbox") -> Message:
+    """Render an email from the outbox into a message that's ready to send."""
+    context = _load_context(json.loads(email.context))
+    builder = CONTEXT_BUILDERS.get(email.template)
+    if builder is not None:
+        builder(context)
+
+    msg = Message(email.subject, recipients=[email.recipient])
+    with current_app.test_request_context(base_url=email.base_url):
+        msg.body = render_template(f"{email.template}.txt", **context)
+        msg.html = render_template(f"{email.template}.html", **context)
+    return msg
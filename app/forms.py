@@ -20,6 +20,7 @@ from wtforms.validators import (
     InputRequired,
     Length,
     NumberRange,
+    Optional,
     ValidationError,
 )
 from wtforms.widgets import HiddenInput
@@ -171,3 +172,18 @@ class TransactionRefundForm(FlaskForm):
 
 class FlightCancellationForm(FlaskForm):
     date = DateField("Departure Date", validators=[InputRequired()])
+
+
+class BulkCancellationForm(FlaskForm):
+    airport = StringField("Airport", validators=[Optional(), AirportValidator()])
+    flights = FieldList(IntegerField())
+    start = DateField("Start", validators=[InputRequired()])
+    end = DateField("End", validators=[InputRequired()])
+
+    def validate_end(form, _):
+        if form.start.data and form.end.data and form.start.data > form.end.data:
+            raise ValidationError("End date can't come before start date")
+
+    def validate_flights(form, field):
+        if not form.airport.data and not field.data:
+            raise ValidationError("An airport or a list of flights is required")
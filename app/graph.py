@@ -0,0 +1,540 @@
+import datetime as dt
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from flask import current_app
+from sqlalchemy.orm import joinedload
+
+from app import db
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def _to_minutes(value: dt.time) -> int:
+    return value.hour * 60 + value.minute
+
+
+class RouteEdge:
+    """A scheduled flight as an edge in the route graph.
+
+    All times are stored as minutes so the search never has to touch
+    datetime objects or the flight's airports while walking the graph.
+    """
+
+    __slots__ = (
+        "flight_id",
+        "airplane_id",
+        "departure_id",
+        "arrival_id",
+        "departure_minute",
+        "arrival_minute",
+        "duration",
+        "capacity",
+        "start",
+        "end",
+    )
+
+    def __init__(
+        self,
+        flight_id: int,
+        airplane_id: int,
+        departure_id: int,
+        arrival_id: int,
+        departure_minute: int,
+        duration: int,
+        capacity: int,
+        start: dt.date,
+        end: dt.date,
+    ) -> None:
+        self.flight_id = flight_id
+        self.airplane_id = airplane_id
+        self.departure_id = departure_id
+        self.arrival_id = arrival_id
+        # Minutes after midnight UTC
+        self.departure_minute = departure_minute
+        # Can be greater than a day if the flight lands the next day
+        self.arrival_minute = departure_minute + duration
+        self.duration = duration
+        self.capacity = capacity
+        self.start = start
+        self.end = end
+
+    def operates_on(self, date: dt.date) -> bool:
+        return self.start <= date <= self.end
+
+    @staticmethod
+    def from_flight(flight) -> "RouteEdge":
+        return RouteEdge(
+            flight_id=flight.id,
+            airplane_id=flight.airplane_id,
+            departure_id=flight.departure_id,
+            arrival_id=flight.arrival_id,
+            departure_minute=_to_minutes(flight.departure_time),
+            duration=int(flight.flight_time.total_seconds() // 60),
+            capacity=flight.airplane.capacity,
+            start=flight.start,
+            end=flight.end,
+        )
+
+
+class Availability:
+    """Snapshot of the seat inventory for a range of dates.
+
+    Loaded with a single query so a search can check every candidate
+    flight without going back to the database.
+    """
+
+    def __init__(self, instances: Dict[Tuple[int, dt.date], Tuple[int, int]] = None) -> None:
+        # (flight id, date) -> (capacity, sold). Cancelled flights have no seats left.
+        self._instances = instances or {}
+
+    @staticmethod
+    def load(start: dt.date, end: dt.date) -> "Availability":
+        """Load availability for all flights departing from start to end (inclusive)."""
+        from app.models import FlightInstance
+
+        query = db.session.query(
+            FlightInstance.flight_id,
+            FlightInstance.date,
+            FlightInstance.capacity,
+            FlightInstance.sold,
+            FlightInstance.cancelled,
+        ).filter(FlightInstance.date >= start, FlightInstance.date <= end)
+
+        instances = {}
+        for flight_id, date, capacity, sold, cancelled in query:
+            instances[(flight_id, date)] = (0, 0) if cancelled else (capacity, sold)
+
+        return Availability(instances)
+
+    def seats(self, edge: RouteEdge, date: dt.date) -> int:
+        # Flights without any inventory yet haven't sold any tickets.
+        capacity, sold = self._instances.get((edge.flight_id, date), (edge.capacity, 0))
+        return capacity - sold
+
+    def reserve(self, edge: RouteEdge, date: dt.date, count: int) -> None:
+        key = (edge.flight_id, date)
+        capacity, sold = self._instances.get(key, (edge.capacity, 0))
+        self._instances[key] = (capacity, sold + count)
+
+    def close(self, flight_id: int, date: dt.date) -> None:
+        """Remove all of the seats on a flight like it was cancelled."""
+        self._instances[(flight_id, date)] = (0, 0)
+
+
+class SearchPath:
+    """A single result from RouteGraph.search."""
+
+    __slots__ = ("date", "edges")
+
+    def __init__(self, date: dt.date, edges: List[RouteEdge]) -> None:
+        self.date = date
+        self.edges = edges
+
+    @property
+    def flight_ids(self) -> List[int]:
+        return [edge.flight_id for edge in self.edges]
+
+
+class _GraphState:
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.loaded = False
+        # When the graph has to be built again to pick up other processes' changes.
+        self.expires = 0.0
+        self.edges: Dict[int, RouteEdge] = {}
+        self.adjacency: Dict[int, List[RouteEdge]] = defaultdict(list)
+        self.timezones: Dict[int, str] = {}
+        # Time sorted connections for each day used by the connection scan.
+        self.connections: Dict[dt.date, List[RouteEdge]] = {}
+
+
+class RouteGraph:
+    """Process local graph of all scheduled flights keyed by departure airport.
+
+    The graph is lazily built the first time it's needed and is kept up to date
+    by the flights api. Each Flask app gets its own copy of the graph. Other
+    processes don't know about changes made through this one so the graph is
+    rebuilt every ROUTE_GRAPH_TIMEOUT seconds.
+    """
+
+    @property
+    def _state(self) -> _GraphState:
+        return current_app.extensions.setdefault("route_graph", _GraphState())
+
+    def _ensure_loaded(self) -> _GraphState:
+        state = self._state
+        if not state.loaded or state.expires <= time.monotonic():
+            with state.lock:
+                if not state.loaded or state.expires <= time.monotonic():
+                    self._build(state)
+        return state
+
+    def _build(self, state: _GraphState) -> None:
+        from app.models import Airport, Flight
+
+        state.timezones = {
+            id: timezone for id, timezone in db.session.query(Airport.id, Airport.timezone)
+        }
+        # The flight times are stored on the flights so the airports aren't needed.
+        flights = Flight.query.options(joinedload(Flight.airplane)).all()
+
+        adjacency = defaultdict(list)
+        edges = {}
+        for flight in flights:
+            edge = RouteEdge.from_flight(flight)
+            edges[edge.flight_id] = edge
+            adjacency[edge.departure_id].append(edge)
+
+        for departures in adjacency.values():
+            departures.sort(key=lambda edge: edge.departure_minute)
+
+        state.edges = edges
+        state.adjacency = adjacency
+        state.connections = {}
+        state.loaded = True
+        state.expires = time.monotonic() + current_app.config.get(
+            "ROUTE_GRAPH_TIMEOUT", 60
+        )
+
+    def invalidate(self) -> None:
+        """Throw away the graph. It will be rebuilt on the next search."""
+        state = self._state
+        with state.lock:
+            state.loaded = False
+            state.edges = {}
+            state.adjacency = defaultdict(list)
+            state.timezones = {}
+            state.connections = {}
+
+    def add_flight(self, flight) -> None:
+        """Add or replace a flight in the graph."""
+        state = self._state
+        with state.lock:
+            if not state.loaded:
+                # Nothing to update, it will be included when the graph is built.
+                return
+            self._remove(state, flight.id)
+            edge = RouteEdge.from_flight(flight)
+            state.edges[edge.flight_id] = edge
+            # Replace the list rather than mutating it so searches
+            # running in other threads never see a partial update.
+            departures = state.adjacency[edge.departure_id] + [edge]
+            departures.sort(key=lambda edge: edge.departure_minute)
+            state.adjacency[edge.departure_id] = departures
+            state.timezones[flight.departure_id] = flight.departure_airport.timezone
+            state.timezones[flight.arrival_id] = flight.arrival_airport.timezone
+            state.connections = {}
+
+    update_flight = add_flight
+
+    def remove_flight(self, flight_id: int) -> None:
+        state = self._state
+        with state.lock:
+            if state.loaded:
+                self._remove(state, flight_id)
+
+    def update_airplane(self, airplane) -> None:
+        """Update the capacity of every flight flown by airplane."""
+        state = self._state
+        with state.lock:
+            for edge in state.edges.values():
+                if edge.airplane_id == airplane.id:
+                    edge.capacity = airplane.capacity
+
+    @staticmethod
+    def _remove(state: _GraphState, flight_id: int) -> None:
+        edge = state.edges.pop(flight_id, None)
+        if edge is not None:
+            state.adjacency[edge.departure_id] = [
+                e for e in state.adjacency[edge.departure_id] if e.flight_id != flight_id
+            ]
+            state.connections = {}
+
+    def departures(self, airport_id: int) -> List[RouteEdge]:
+        return self._ensure_loaded().adjacency.get(airport_id, [])
+
+    def edges(self) -> Iterable[RouteEdge]:
+        return list(self._ensure_loaded().edges.values())
+
+    def timezone(self, airport_id: int) -> Optional[str]:
+        return self._ensure_loaded().timezones.get(airport_id)
+
+    def connections(self, date: dt.date) -> List[RouteEdge]:
+        """All flights operating on date sorted by departure time."""
+        state = self._ensure_loaded()
+        connections = state.connections.get(date)
+        if connections is None:
+            connections = [
+                edge
+                for departures in state.adjacency.values()
+                for edge in departures
+                if edge.operates_on(date)
+            ]
+            connections.sort(key=lambda edge: edge.departure_minute)
+            state.connections[date] = connections
+        return connections
+
+    @staticmethod
+    def _first_leg_filter(timezone: str, departure_dt: dt.datetime):
+        """Returns a function that checks if a departure minute can be used for the first flight."""
+        # Handle situations where the timezone wraps around past midnight in the
+        # airports timezone. Fixes issues where some flights aren't retrieved
+        # because they are "before" the departure time.
+        departure_minute = _to_minutes(departure_dt.time())
+        midnight = dt.datetime.combine(
+            departure_dt.date(), dt.time(0, 0, 0, tzinfo=ZoneInfo(timezone))
+        ).astimezone(dt.timezone.utc)
+        midnight_minute = _to_minutes(midnight.time())
+        if departure_minute > 0 and departure_minute < midnight_minute:
+            return lambda m: departure_minute <= m < midnight_minute
+        return lambda m: m >= departure_minute or m < midnight_minute
+
+    @staticmethod
+    def _window_days(max_trip_time: dt.timedelta) -> int:
+        """Number of days after the departure date a trip could touch."""
+        return max_trip_time.days + 1
+
+    def search(
+        self,
+        departing_airport: int,
+        final_airport: int,
+        departure_dt: dt.datetime,
+        num_of_passengers: int = 1,
+        max_layovers: int = 2,
+        limit: int = 10,
+        min_layover_time: dt.timedelta = dt.timedelta(minutes=45),
+        max_layover_time: dt.timedelta = dt.timedelta(hours=12),
+        max_trip_time: dt.timedelta = dt.timedelta(days=1),
+        availability: Availability = None,
+    ) -> List[SearchPath]:
+        """Depth first search from departing_airport to final_airport.
+
+        Follows the same rules as the original SQL based search. Direct
+        flights are explored first followed by the latest departures.
+        If availability isn't given it's loaded from the database.
+        """
+        state = self._ensure_loaded()
+
+        departure_date = departure_dt.date()
+        if availability is None:
+            availability = Availability.load(
+                departure_date,
+                departure_date + dt.timedelta(days=self._window_days(max_trip_time)),
+            )
+
+        min_layover = int(min_layover_time.total_seconds() // 60)
+        max_layover = int(max_layover_time.total_seconds() // 60)
+        max_trip = int(max_trip_time.total_seconds() // 60)
+        base_date = departure_date
+
+        timezone = state.timezones.get(departing_airport)
+        if timezone is None:
+            # No flights can leave from an airport the graph doesn't know about.
+            return []
+        first_leg = self._first_leg_filter(timezone, departure_dt)
+
+        def candidates(airport_id: int, date: dt.date, earliest, path_len: int):
+            direct = []
+            connecting = []
+            for edge in state.adjacency.get(airport_id, ()):
+                if not earliest(edge.departure_minute):
+                    continue
+                if not edge.operates_on(date):
+                    continue
+                if path_len == max_layovers and edge.arrival_id != final_airport:
+                    continue
+                if availability.seats(edge, date) < num_of_passengers:
+                    continue
+                if edge.arrival_id == final_airport:
+                    direct.append(edge)
+                else:
+                    connecting.append(edge)
+            # Prioritize direct flights and then the latest departures.
+            direct.reverse()
+            connecting.reverse()
+            return direct + connecting
+
+        results: List[SearchPath] = []
+        path: List[RouteEdge] = []
+        visited: List[int] = []
+
+        def walk(origin_minute: int, arrival_minute: int, previous: RouteEdge):
+            # Absolute minutes are relative to midnight UTC of the base date.
+            earliest_abs = arrival_minute + min_layover
+            day, earliest_minute = divmod(earliest_abs, MINUTES_PER_DAY)
+            date = base_date + dt.timedelta(days=day)
+            arrival_day = arrival_minute // MINUTES_PER_DAY
+            arrival_of_day = arrival_minute % MINUTES_PER_DAY
+
+            for edge in candidates(
+                previous.arrival_id,
+                date,
+                lambda m: m >= earliest_minute,
+                len(path),
+            ):
+                if edge.arrival_id in visited:
+                    continue
+                # Enforce a maximum layover length
+                layover = (edge.departure_minute - previous.arrival_minute) % MINUTES_PER_DAY
+                if layover > max_layover:
+                    continue
+                # Match TripItinerary.add_flight, the flight departs on the day
+                # of the last arrival unless that would be before we land.
+                departs = arrival_day * MINUTES_PER_DAY + edge.departure_minute
+                if edge.departure_minute < arrival_of_day:
+                    departs += MINUTES_PER_DAY
+                if visit(edge, origin_minute, departs):
+                    return True
+            return False
+
+        def visit(edge: RouteEdge, origin_minute: int, departs: int) -> bool:
+            arrives = departs + edge.duration
+            if arrives - origin_minute > max_trip:
+                return False
+
+            path.append(edge)
+            visited.append(edge.departure_id)
+            if edge.arrival_id == final_airport:
+                results.append(SearchPath(base_date, path.copy()))
+            else:
+                walk(origin_minute, arrives, edge)
+            path.pop()
+            visited.pop()
+            return len(results) >= limit
+
+        for edge in candidates(departing_airport, departure_date, first_leg, 0):
+            if edge.arrival_id == departing_airport:
+                continue
+            if visit(edge, edge.departure_minute, edge.departure_minute):
+                break
+
+        return results
+
+    def scan(
+        self,
+        departing_airport: int,
+        final_airport: int,
+        departure_dt: dt.datetime,
+        num_of_passengers: int = 1,
+        max_layovers: int = 2,
+        limit: int = 10,
+        min_layover_time: dt.timedelta = dt.timedelta(minutes=45),
+        max_layover_time: dt.timedelta = dt.timedelta(hours=12),
+        max_trip_time: dt.timedelta = dt.timedelta(days=1),
+        availability: Availability = None,
+        max_labels: int = 16,
+    ) -> List[SearchPath]:
+        """Connection Scan Algorithm search from departing_airport to final_airport.
+
+        Every connection in the search window is scanned once in departure order.
+        Each airport keeps at most max_labels partial trips that aren't beaten by
+        another trip leaving later, arriving earlier and using fewer flights.
+        This keeps the cost bounded no matter how many layovers are allowed.
+        """
+        state = self._ensure_loaded()
+
+        base_date = departure_dt.date()
+        days = self._window_days(max_trip_time)
+        if availability is None:
+            availability = Availability.load(
+                base_date, base_date + dt.timedelta(days=days)
+            )
+
+        min_layover = int(min_layover_time.total_seconds() // 60)
+        max_layover = int(max_layover_time.total_seconds() // 60)
+        max_trip = int(max_trip_time.total_seconds() // 60)
+        max_flights = max_layovers + 1
+        timezone = state.timezones.get(departing_airport)
+        if timezone is None:
+            # No flights can leave from an airport the graph doesn't know about.
+            return []
+        first_leg = self._first_leg_filter(timezone, departure_dt)
+
+        # Partial trips waiting at each airport as
+        # (arrival minute, start minute, [(edge, date), ...])
+        labels: Dict[int, List[Tuple[int, int, list]]] = defaultdict(list)
+        results: List[Tuple[int, int, list]] = []
+
+        def dominated(label, other) -> bool:
+            return (
+                other[1] >= label[1]
+                and other[0] <= label[0]
+                and len(other[2]) <= len(label[2])
+            )
+
+        def arrive(edge: RouteEdge, label) -> None:
+            if edge.arrival_id == final_airport:
+                results.append(label)
+                return
+            if len(label[2]) >= max_flights:
+                return
+            waiting = labels[edge.arrival_id]
+            if any(dominated(label, other) for other in waiting):
+                return
+            waiting = [other for other in waiting if not dominated(other, label)]
+            waiting.append(label)
+            if len(waiting) > max_labels:
+                # Keep the trips that left the latest and arrived the earliest.
+                waiting.sort(key=lambda l: (-l[1], l[0]))
+                waiting = waiting[:max_labels]
+            labels[edge.arrival_id] = waiting
+
+        for day in range(days + 1):
+            date = base_date + dt.timedelta(days=day)
+            offset = day * MINUTES_PER_DAY
+            for edge in self.connections(date):
+                departs = offset + edge.departure_minute
+                arrives = departs + edge.duration
+
+                if (
+                    day == 0
+                    and edge.departure_id == departing_airport
+                    and edge.arrival_id != departing_airport
+                    and first_leg(edge.departure_minute)
+                    and (max_flights > 1 or edge.arrival_id == final_airport)
+                    and edge.duration <= max_trip
+                    and availability.seats(edge, date) >= num_of_passengers
+                ):
+                    arrive(edge, (arrives, departs, [(edge, date)]))
+
+                waiting = labels.get(edge.departure_id)
+                if not waiting or edge.departure_id == departing_airport:
+                    continue
+
+                seats = None
+                for label in waiting:
+                    arrival, start, legs = label
+                    layover = departs - arrival
+                    if layover < min_layover or layover > max_layover:
+                        continue
+                    if arrives - start > max_trip:
+                        continue
+                    if len(legs) + 1 == max_flights and edge.arrival_id != final_airport:
+                        continue
+                    # Make sure this flight doesn't backtrack to an airport we've already been to.
+                    if any(leg.departure_id == edge.arrival_id for leg, _ in legs):
+                        continue
+                    if seats is None:
+                        seats = availability.seats(edge, date)
+                    if seats < num_of_passengers:
+                        break
+                    arrive(edge, (arrives, start, legs + [(edge, date)]))
+
+                # Drop trips that have waited longer than the maximum layover.
+                labels[edge.departure_id] = [
+                    label for label in labels.get(edge.departure_id, ())
+                    if departs - label[0] <= max_layover
+                ]
+
+        results.sort(key=lambda label: (label[1], label[0] - label[1]))
+        return [
+            SearchPath(base_date, [edge for edge, _ in legs])
+            for _, _, legs in results[:limit]
+        ]
+
+
+route_graph = RouteGraph()
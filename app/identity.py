@@ -0,0 +1,90 @@
+from typing import Any, Dict, Optional
+
+from cachelib import BaseCache, NullCache
+from flask import current_app
+from flask_login import UserMixin
+
+from app.cache import MemoryCache
+
+# Everything the permission checks and page layouts need.
+IDENTITY_FIELDS = ("id", "role", "email", "first_name", "last_name")
+
+
+class UserIdentity(UserMixin):
+    """The logged in user as returned by load_user.
+
+    Holds the cached identity fields and loads the full user the first
+    time anything else is used so current_user works like a User.
+    """
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.__dict__.update(data)
+        self._user = None
+
+    def __repr__(self) -> str:
+        return f"<UserIdentity {self.id} {self.role}>"
+
+    @property
+    def user(self):
+        if self._user is None:
+            from app.models import User
+
+            self._user = User.query.get(self.id)
+        return self._user
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes that aren't cached.
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+
+class IdentityCache:
+    """Per process cache of the identity fields for logged in users.
+
+    Entries are removed when a user is changed or deleted through the api.
+    Other processes keep using their entries until they time out so
+    USER_CACHE_TIMEOUT is how long a change can take to apply everywhere.
+    """
+
+    def __init__(self, app=None) -> None:
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        size = app.config.get("USER_CACHE_SIZE", 1024)
+        timeout = app.config.get("USER_CACHE_TIMEOUT", 60)
+        if size:
+            app.extensions["identity_cache"] = MemoryCache(size, timeout)
+        else:
+            app.extensions["identity_cache"] = NullCache()
+
+    @property
+    def _cache(self) -> BaseCache:
+        return current_app.extensions["identity_cache"]
+
+    @staticmethod
+    def _key(id: int) -> str:
+        return f"user:{id}"
+
+    def load(self, id: int) -> Optional[UserIdentity]:
+        data = self._cache.get(self._key(id))
+        if data is None:
+            from app import db
+            from app.models import User
+
+            # The user table has every field so skip the subclass joins.
+            table = User.__table__
+            row = db.session.execute(
+                table.select()
+                .with_only_columns(*(table.c[field] for field in IDENTITY_FIELDS))
+                .where(table.c.id == id)
+            ).first()
+            if row is None:
+                return None
+            data = dict(row._mapping)
+            self._cache.set(self._key(id), data)
+        return UserIdentity(data)
+
+    def invalidate(self, id: int) -> None:
+        self._cache.delete(self._key(id))
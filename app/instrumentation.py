@@ -0,0 +1,166 @@
+import heapq
+import logging
+import time
+from collections import Counter
+from typing import List, Optional, Tuple
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Server-Timing descriptions are kept short so the headers stay small.
+_DESCRIPTION_LENGTH = 100
+
+
+class _InstrumentationState:
+    def __init__(self, app) -> None:
+        config = app.config
+        self.enabled = config.get("SQL_INSTRUMENTATION", True)
+        # Defaults to only adding the header in debug mode.
+        self.server_timing = config.get("SQL_SERVER_TIMING")
+        if self.server_timing is None:
+            self.server_timing = app.debug
+        self.slowest = config.get("SQL_SLOWEST_STATEMENTS", 3)
+        # Requests over either limit are logged. 0 disables the limit.
+        self.max_queries = config.get("SQL_LOG_QUERY_COUNT", 50)
+        self.max_time = config.get("SQL_LOG_QUERY_TIME", 500)
+        # Statements run this many times in a request are logged as N+1 queries.
+        self.repeated = config.get("SQL_LOG_REPEATED_STATEMENTS", 10)
+
+
+class RequestQueries:
+    """The SQL statements run while handling a request."""
+
+    def __init__(self, slowest: int) -> None:
+        self.count = 0
+        # Milliseconds
+        self.time = 0.0
+        self.statements: Counter = Counter()
+        self._slowest = slowest
+        # (milliseconds, statement) min heap of the slowest statements
+        self._heap: List[Tuple[float, str]] = []
+
+    def add(self, statement: str, elapsed: float) -> None:
+        self.count += 1
+        self.time += elapsed
+        self.statements[statement] += 1
+        if len(self._heap) < self._slowest:
+            heapq.heappush(self._heap, (elapsed, statement))
+        elif self._heap and elapsed > self._heap[0][0]:
+            heapq.heapreplace(self._heap, (elapsed, statement))
+
+    @property
+    def slowest(self) -> List[Tuple[float, str]]:
+        return sorted(self._heap, reverse=True)
+
+    def repeated(self, threshold: int) -> List[Tuple[str, int]]:
+        """Statements that ran at least threshold times, most frequent first."""
+        if not threshold:
+            return []
+        return [
+            (statement, count)
+            for statement, count in self.statements.most_common()
+            if count >= threshold
+        ]
+
+
+def _current() -> Optional[RequestQueries]:
+    if not has_app_context():
+        return None
+    return g.get("_request_queries")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    queries = _current()
+    starts = conn.info.get("query_start")
+    if queries is None or not starts:
+        return
+    queries.add(statement, (time.perf_counter() - starts.pop()) * 1000)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context) -> None:
+    # after_cursor_execute isn't called for statements that fail.
+    connection = context.connection
+    if connection is not None and connection.info.get("query_start"):
+        connection.info["query_start"].pop()
+
+
+def _describe(statement: str) -> str:
+    statement = " ".join(statement.split())
+    if len(statement) > _DESCRIPTION_LENGTH:
+        statement = statement[: _DESCRIPTION_LENGTH - 3] + "..."
+    return statement
+
+
+class QueryInstrumentation:
+    """Records the SQL statements each request runs.
+
+    The number of statements, the time spent running them and the slowest
+    ones are added as Server-Timing headers in debug mode so they show up
+    in the browser's network tab. Requests that run more statements or
+    spend longer in the database than the SQL_LOG_* settings allow are
+    logged as warnings along with any statement repeated enough times to
+    be an N+1 query. Statements run while a streamed response is being
+    sent aren't counted.
+    """
+
+    def __init__(self, app=None) -> None:
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        state = app.extensions["query_instrumentation"] = _InstrumentationState(app)
+        if not state.enabled:
+            return
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    @property
+    def _state(self) -> _InstrumentationState:
+        return current_app.extensions["query_instrumentation"]
+
+    def _before_request(self) -> None:
+        g._request_queries = RequestQueries(self._state.slowest)
+
+    def _after_request(self, response):
+        queries = g.pop("_request_queries", None)
+        if queries is None:
+            return response
+
+        state = self._state
+        if state.server_timing:
+            timings = [f'db;dur={queries.time:.2f};desc="{queries.count} queries"']
+            for i, (elapsed, statement) in enumerate(queries.slowest, start=1):
+                description = _describe(statement).replace("\\", "\\\\").replace('"', '\\"')
+                timings.append(f'db-{i};dur={elapsed:.2f};desc="{description}"')
+            response.headers.add("Server-Timing", ", ".join(timings))
+
+        self._log(state, queries)
+        return response
+
+    def _log(self, state: _InstrumentationState, queries: RequestQueries) -> None:
+        repeated = queries.repeated(state.repeated)
+        too_many = state.max_queries and queries.count > state.max_queries
+        too_slow = state.max_time and queries.time > state.max_time
+        if not (too_many or too_slow or repeated):
+            return
+
+        lines = [
+            f"{request.method} {request.full_path.rstrip('?')} ran {queries.count} "
+            f"queries in {queries.time:.2f}ms"
+        ]
+        for elapsed, statement in queries.slowest:
+            lines.append(f"  {elapsed:.2f}ms: {_describe(statement)}")
+        for statement, count in repeated:
+            lines.append(f"  Possible N+1, ran {count} times: {_describe(statement)}")
+        logger.warning("\n".join(lines))
@@ -1,24 +1,61 @@
+import base64
 import datetime as dt
+import json
 import math
 import random
 import string
+import threading
 import time
 import uuid
-from collections import OrderedDict
-from typing import Any, Dict, List
+from collections import OrderedDict, defaultdict
+from collections.abc import Sequence
+from typing import Any, Dict, List, Optional, Tuple
 from zoneinfo import ZoneInfo
 
-import geopy.distance
+import click
 import jwt
 from dateutil.relativedelta import relativedelta
 from flask import current_app, url_for
 from flask_login import UserMixin
-from sqlalchemy import UniqueConstraint, and_, desc, func, or_, sql
+from sqlalchemy import UniqueConstraint, and_, desc, event, func, sql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session, joinedload, object_session, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from app import db, login
-from app.email import send_bulk_email
+from app import (
+    db,
+    distance_matrix,
+    identity_cache,
+    login,
+    outbox,
+    reference_cache,
+    search_cache,
+)
+from app.email import queue_bulk_email
+from app.graph import SearchPath, route_graph
 from app.helpers import calculate_taxes
+from app.urls import url_for_id
+
+
+class ItemDicts(Sequence):
+    """A page of models that are only converted with to_dict as they're read.
+    Lets the api encode a streamed collection one item at a time.
+    """
+
+    def __init__(self, items: List["PaginatedAPIMixin"], expand: bool = False) -> None:
+        self._items = items
+        self._expand = expand
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [item.to_dict(expand=self._expand) for item in self._items[index]]
+        return self._items[index].to_dict(expand=self._expand)
 
 
 class PaginatedAPIMixin:
@@ -26,24 +63,109 @@ class PaginatedAPIMixin:
         data = dict(self.__dict__)
         # SQLAlchemy models contain an extra field that we don't want to expose.
         data.pop("_sa_instance_state", None)
-        for key, value in data.items():
-            if isinstance(value, dt.time):
-                data[key] = value.strftime("%H:%M")
-            if isinstance(value, dt.date):
-                data[key] = value.strftime("%Y-%m-%d")
 
         if "id" in data:
-            data["self"] = url_for(self.__endpoint__, id=data["id"])
+            data["self"] = url_for_id(self.__endpoint__, data["id"])
             del data["id"]
 
         return data
 
+    @classmethod
+    def _to_cursor_dict(cls, query, cursor, per_page, endpoint, count=False, **kwargs):
+        """Keyset pagination on the primary key. Unlike paginate this doesn't
+        need an OFFSET so deep pages are just as fast as the first one and
+        the total is only counted when asked for.
+        """
+        expand = kwargs.get("expand", False)
+        direction, id = cursor
+        total = query.order_by(None).count() if count else None
+
+        query = query.order_by(None)
+        if direction == "next":
+            if id is not None:
+                query = query.filter(cls.id > id)
+            query = query.order_by(cls.id)
+        else:
+            query = query.filter(cls.id < id).order_by(cls.id.desc())
+
+        # Grab an extra item to see if there is another page.
+        items = query.limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        if direction == "prev":
+            items.reverse()
+
+        if direction == "next":
+            has_next, has_prev = has_more, id is not None
+        else:
+            has_next, has_prev = True, has_more
+
+        def link(direction, id):
+            return url_for(
+                endpoint,
+                cursor=cls.encode_cursor(direction, id),
+                per_page=per_page,
+                count=count,
+                **kwargs,
+            )
+
+        data = {
+            "items": ItemDicts(items, expand),
+            "_meta": {"per_page": per_page},
+            "_links": {
+                "self": url_for(
+                    endpoint,
+                    cursor=cls.encode_cursor(*cursor) if id is not None else "",
+                    per_page=per_page,
+                    count=count,
+                    **kwargs,
+                ),
+                "next": link("next", items[-1].id) if items and has_next else None,
+                "prev": link("prev", items[0].id) if items and has_prev else None,
+            },
+        }
+        if total is not None:
+            data["_meta"]["total_items"] = total
+        return data
+
+    @classmethod
+    def load_plan(cls, expand: bool = False) -> List:
+        """Loader options for the relationships to_dict uses.
+        Applied to collection queries so a page doesn't lazy load every item.
+        """
+        return []
+
+    @staticmethod
+    def encode_cursor(direction: str, id: int) -> str:
+        value = json.dumps([direction, id], separators=(",", ":"))
+        return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
     @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    def decode_cursor(value: str) -> Tuple[str, Optional[int]]:
+        """Decode a cursor from the url. An empty cursor is the first page."""
+        if not value:
+            return "next", None
+        try:
+            padding = "=" * (-len(value) % 4)
+            direction, id = json.loads(base64.urlsafe_b64decode(value + padding))
+        except (ValueError, TypeError):
+            raise ValueError("Invalid cursor")
+        if direction not in ("next", "prev") or not isinstance(id, int):
+            raise ValueError("Invalid cursor")
+        return direction, id
+
+    @classmethod
+    def to_collection_dict(
+        cls, query, page, per_page, endpoint, cursor=None, count=False, **kwargs
+    ):
         expand = kwargs.get("expand", False)
+        query = query.options(*cls.load_plan(expand))
+        if cursor is not None:
+            return cls._to_cursor_dict(query, cursor, per_page, endpoint, count, **kwargs)
+
         resources = query.paginate(page, per_page, False)
         data = {
-            "items": [item.to_dict(expand=expand) for item in resources.items],
+            "items": ItemDicts(resources.items, expand),
             "_meta": {
                 "page": page,
                 "per_page": per_page,
@@ -146,76 +268,234 @@ class Agent(User):
         "polymorphic_identity": "agent",
     }
 
-    def sales_by_date(self, start: dt.date, end: dt.date) -> List[Dict]:
-        # Add an extra day to include results on that date
-        end += relativedelta(days=+1)
+    def _daily_sales(self, start: dt.date, end: dt.date):
+        return (
+            AgentDailySales.query.with_entities(AgentDailySales.date, AgentDailySales.sales)
+            .filter(AgentDailySales.agent_id == self.id)
+            .filter(AgentDailySales.date >= start)
+            .filter(AgentDailySales.date <= end)
+            .order_by(AgentDailySales.date)
+        )
 
-        date_col = func.date(PurchaseTransaction.purchase_timestamp).label("date")
+    @staticmethod
+    def _sales_periods(start: dt.date, end: dt.date, group: str) -> Dict[str, float]:
+        """Every period from start to end (inclusive) with no sales."""
+        data = OrderedDict()
+        if group == "date":
+            date, step = start, relativedelta(days=+1)
+        else:
+            date, step = start.replace(day=1), relativedelta(months=+1)
+        while date <= end:
+            data[date.isoformat()] = 0.00
+            date += step
+        return data
 
-        query = (
+    @staticmethod
+    def _sales_period(date: dt.date, group: str) -> str:
+        if group == "month":
+            date = date.replace(day=1)
+        return date.isoformat()
+
+    def _sales_by(self, start: dt.date, end: dt.date, group: str) -> Dict[str, float]:
+        data = self._sales_periods(start, end, group)
+        for date, sales in self._daily_sales(start, end):
+            key = self._sales_period(date, group)
+            data[key] = round(data[key] + sales, 2)
+        return data
+
+    def sales_by_date(self, start: dt.date, end: dt.date) -> Dict[str, float]:
+        """Total sales for each day from start to end (inclusive)."""
+        return self._sales_by(start, end, "date")
+
+    def sales_by_month(self, start: dt.date, end: dt.date) -> Dict[str, float]:
+        """Total sales for each month from start to end (inclusive)
+        keyed by the first day of the month.
+        """
+        return self._sales_by(start, end, "month")
+
+    @staticmethod
+    def sales_leaderboard(
+        start: dt.date,
+        end: dt.date,
+        group: str = "date",
+        ranked: bool = False,
+        top: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """Every agent's sales from start to end (inclusive) in a single query.
+
+        Each entry has the agent, their total sales and their sales for each
+        period, with the same periods as sales_by_date or sales_by_month.
+        Ranked results are ordered by total sales with ties sharing a rank.
+        top limits the results to the agents with the highest sales.
+        """
+        in_range = and_(
+            AgentDailySales.agent_id == Agent.id,
+            AgentDailySales.date >= start,
+            AgentDailySales.date <= end,
+        )
+        ranked = ranked or top is not None
+        totals = (
             db.session.query(
-                PurchaseTransaction.id,
-                func.sum(PurchaseTransaction.purchase_price).label("sales"),
-                date_col,
+                Agent.id.label("agent_id"),
+                func.coalesce(func.sum(AgentDailySales.sales), 0).label("total"),
             )
-            .filter(PurchaseTransaction.assisted_by == self.id)
-            .filter(PurchaseTransaction.purchase_timestamp >= start)
-            .filter(PurchaseTransaction.purchase_timestamp <= end)
-            .group_by(date_col)
-            .order_by(date_col)
+            .outerjoin(AgentDailySales, in_range)
+            .group_by(Agent.id)
         )
+        if top is not None:
+            totals = totals.order_by(desc("total"), Agent.id).limit(top)
+        totals = totals.subquery()
 
-        data = {row["date"].isoformat(): round(row["sales"], 2) for row in query.all()}
+        query = (
+            db.session.query(Agent, totals.c.total, AgentDailySales.date, AgentDailySales.sales)
+            .join(totals, totals.c.agent_id == Agent.id)
+            .outerjoin(AgentDailySales, in_range)
+        )
+        if ranked:
+            query = query.order_by(totals.c.total.desc())
+        query = query.order_by(Agent.id, AgentDailySales.date)
+
+        entries = OrderedDict()
+        for agent, total, date, sales in query:
+            entry = entries.get(agent.id)
+            if entry is None:
+                entry = entries[agent.id] = {
+                    "agent": agent.to_dict(),
+                    "total": round(total, 2),
+                    "sales": Agent._sales_periods(start, end, group),
+                }
+            if date is not None:
+                key = Agent._sales_period(date, group)
+                entry["sales"][key] = round(entry["sales"][key] + sales, 2)
+
+        data = list(entries.values())
+        if ranked:
+            rank = 0
+            for i, entry in enumerate(data):
+                if i == 0 or entry["total"] != data[i - 1]["total"]:
+                    rank = i + 1
+                entry["rank"] = rank
+        return data
 
-        while start < end:
-            if start.isoformat() not in data:
-                data[start.isoformat()] = 0.00
-            start += relativedelta(days=+1)
 
-        ordered_data = OrderedDict(
-            sorted(data.items(), key=lambda x: dt.date.fromisoformat(x[0]))
-        )
-        return ordered_data
+class AgentDailySales(db.Model):
+    """Each agent's sales totals for a day.
 
-    def sales_by_month(self, start: dt.date, end: dt.date) -> List[Dict]:
-        # Add an extra day to include results on that date
-        end += relativedelta(days=+1)
+    Kept up to date at checkout and refund time so the sales reports only
+    have to read a row per day instead of aggregating every purchase. Sales
+    count on the day of the purchase and refunds on the day they were made.
+    """
 
-        month_col = func.month(PurchaseTransaction.purchase_timestamp).label("month")
-        year_col = func.year(PurchaseTransaction.purchase_timestamp).label("year")
+    __tablename__ = "agent_daily_sales"
 
-        query = (
-            db.session.query(
-                PurchaseTransaction.id,
-                func.sum(PurchaseTransaction.purchase_price).label("sales"),
-                month_col,
-                year_col,
-            )
-            .filter(PurchaseTransaction.assisted_by == self.id)
-            .filter(PurchaseTransaction.purchase_timestamp >= start)
-            .filter(PurchaseTransaction.purchase_timestamp <= end)
-            .group_by(year_col)
-            .group_by(month_col)
-            .order_by(year_col)
-            .order_by(month_col)
-        )
+    agent_id = db.Column(db.Integer, db.ForeignKey("agent.id"), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    sales = db.Column(db.Float, nullable=False, default=0)
+    transactions = db.Column(db.Integer, nullable=False, default=0)
+    refunds = db.Column(db.Float, nullable=False, default=0)
 
-        data = {
-            f"{row['year']}-{row['month']:0>2}-01": round(row["sales"], 2)
-            for row in query.all()
+    @staticmethod
+    def record(
+        agent_id: int,
+        date: dt.date,
+        sales: float = 0,
+        transactions: int = 0,
+        refunds: float = 0,
+    ) -> None:
+        """Add to an agent's totals for date."""
+        values = {
+            "sales": AgentDailySales.sales + sales,
+            "transactions": AgentDailySales.transactions + transactions,
+            "refunds": AgentDailySales.refunds + refunds,
         }
+        query = AgentDailySales.query.filter_by(agent_id=agent_id, date=date)
+        if query.update(values, synchronize_session=False):
+            return
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(
+                    AgentDailySales(
+                        agent_id=agent_id,
+                        date=date,
+                        sales=sales,
+                        transactions=transactions,
+                        refunds=refunds,
+                    )
+                )
+        except IntegrityError:
+            # Someone else created it first
+            query.update(values, synchronize_session=False)
+
+    @staticmethod
+    def record_sale(transaction: "PurchaseTransaction") -> None:
+        if transaction.assisted_by is not None:
+            AgentDailySales.record(
+                transaction.assisted_by,
+                transaction.purchase_timestamp.date(),
+                sales=transaction.purchase_price,
+                transactions=1,
+            )
+
+    @staticmethod
+    def record_refunds(
+        refunds: List[Tuple["PurchaseTransaction", float]], timestamp: dt.datetime
+    ) -> None:
+        """Credit refunded amounts back against the agents that sold them.
+        timestamp is the refund_timestamp of the tickets so the day matches rebuild.
+        """
+        totals = defaultdict(float)
+        for transaction, amount in refunds:
+            if transaction.assisted_by is not None:
+                totals[transaction.assisted_by] += amount
 
-        start = start.replace(day=1)
-        end = end.replace(day=1)
-        while start < end:
-            if start.isoformat() not in data:
-                data[start.isoformat()] = 0.00
-            start += relativedelta(months=+1)
+        for agent_id, amount in totals.items():
+            AgentDailySales.record(agent_id, timestamp.date(), refunds=amount)
 
-        ordered_data = OrderedDict(
-            sorted(data.items(), key=lambda x: dt.date.fromisoformat(x[0]))
+    @staticmethod
+    def rebuild() -> None:
+        """Recalculate every agent's totals from the purchases."""
+        AgentDailySales.query.delete()
+
+        totals = defaultdict(lambda: [0.0, 0, 0.0])
+        query = db.session.query(
+            PurchaseTransaction.assisted_by,
+            PurchaseTransaction.purchase_timestamp,
+            PurchaseTransaction.purchase_price,
+        ).filter(PurchaseTransaction.assisted_by != None)
+        for agent_id, timestamp, price in query:
+            total = totals[(agent_id, timestamp.date())]
+            total[0] += price
+            total[1] += 1
+
+        transactions = (
+            PurchaseTransaction.query.options(selectinload(PurchaseTransaction.tickets))
+            .filter(PurchaseTransaction.assisted_by != None)
+            .join(PurchaseTransaction.tickets)
+            .filter(PurchasedTicket.refund_timestamp != None)
+            .distinct()
         )
-        return ordered_data
+        for transaction in transactions:
+            taxes = transaction.taxes / len(transaction.tickets)
+            for ticket in transaction.tickets:
+                if ticket.refund_timestamp is not None:
+                    key = (transaction.assisted_by, ticket.refund_timestamp.date())
+                    totals[key][2] += ticket.purchase_price + taxes
+
+        db.session.bulk_insert_mappings(
+            AgentDailySales,
+            [
+                {
+                    "agent_id": agent_id,
+                    "date": date,
+                    "sales": sales,
+                    "transactions": count,
+                    "refunds": refunds,
+                }
+                for (agent_id, date), (sales, count, refunds) in totals.items()
+            ],
+        )
+        db.session.commit()
 
 
 class Admin(User):
@@ -230,7 +510,7 @@ class Admin(User):
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return identity_cache.load(int(id))
 
 
 class Airport(PaginatedAPIMixin, db.Model):
@@ -248,17 +528,18 @@ class Airport(PaginatedAPIMixin, db.Model):
     longitude = db.Column(db.Float, nullable=False)
 
     def distance_to(self, other: "Airport") -> float:
-        start_coords = (self.latitude, self.longitude)
-        end_coords = (other.latitude, other.longitude)
-        distance = geopy.distance.geodesic(start_coords, end_coords)
-        return distance.miles
+        return distance_matrix.distance(self, other)
 
     def time_to(self, other: "Airport") -> dt.timedelta:
-        # Assume an average ground speed of 500nmph.
-        travel_time = self.distance_to(other) / 500
-        hours = math.floor(travel_time)
-        minutes = int((travel_time - hours) * 60)
-        return dt.timedelta(hours=hours, minutes=minutes)
+        return _travel_time(self.distance_to(other))
+
+
+def _travel_time(distance: float) -> dt.timedelta:
+    # Assume an average ground speed of 500nmph.
+    travel_time = distance / 500
+    hours = math.floor(travel_time)
+    minutes = int((travel_time - hours) * 60)
+    return dt.timedelta(hours=hours, minutes=minutes)
 
 
 class Airplane(PaginatedAPIMixin, db.Model):
@@ -276,6 +557,25 @@ class Airplane(PaginatedAPIMixin, db.Model):
     flights = db.relationship("Flight", backref="airplane")
 
 
+@event.listens_for(Airport, "after_insert")
+@event.listens_for(Airport, "after_update")
+@event.listens_for(Airport, "after_delete")
+@event.listens_for(Airplane, "after_insert")
+@event.listens_for(Airplane, "after_update")
+@event.listens_for(Airplane, "after_delete")
+def _reference_changed(mapper, connection, target) -> None:
+    reference_cache.changed(object_session(target))
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _reference_bulk_changed(orm_execute_state) -> None:
+    """Same as _reference_changed for query.update and query.delete."""
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ in (Airport, Airplane):
+            reference_cache.changed(orm_execute_state.session)
+
+
 class Flight(PaginatedAPIMixin, db.Model):
     __endpoint__ = "api.flight"
     __searchable__ = ["number"]
@@ -290,6 +590,13 @@ class Flight(PaginatedAPIMixin, db.Model):
     start = db.Column(db.Date, nullable=False, index=True)
     end = db.Column(db.Date, nullable=False, index=True)
 
+    # Derived from the route whenever the flight is written so they
+    # don't need the airports. See _store_route below.
+    _distance = db.Column("distance", db.Float)
+    _duration = db.Column("duration", db.Integer)
+    _arrival_time = db.Column("arrival_time", db.Time, index=True)
+    _base_fare = db.Column("base_fare", db.Float)
+
     departure_airport = db.relationship(
         "Airport", foreign_keys=[departure_id], backref="departures"
     )
@@ -297,32 +604,92 @@ class Flight(PaginatedAPIMixin, db.Model):
         "Airport", foreign_keys=[arrival_id], backref="arrivals"
     )
 
-    @property
-    def distance(self) -> float:
+    @staticmethod
+    def route(departure, arrival, departure_time: dt.time) -> Dict[str, Any]:
+        """Calculate the stored values for a route between two airports."""
+        distance = distance_matrix.distance(departure, arrival)
+        return Flight.route_values(distance, departure_time)
+
+    @staticmethod
+    def route_values(distance: float, departure_time: dt.time) -> Dict[str, Any]:
+        """Calculate the stored values for a route that is distance miles long."""
+        # Add 45 minutes for taxiing, takeoff and landing.
+        flight_time = _travel_time(distance) + dt.timedelta(minutes=45)
+        departure_dt = dt.datetime.combine(dt.date.today(), departure_time)
+        return {
+            "_distance": distance,
+            "_duration": int(flight_time.total_seconds() // 60),
+            "_arrival_time": (departure_dt + flight_time).time(),
+            # TODO: Figure out better pricing model.
+            # Maybe base it on date?
+            # Weekends more expenive?
+            # Have the ability to put surge charges in the DB?
+            "_base_fare": round(distance * 0.2, 2),
+        }
+
+    def update_route(self) -> None:
+        """Recalculate the stored route values from the airports."""
         if self.departure_airport is None or self.arrival_airport is None:
-            return None
+            return
+        values = Flight.route(
+            self.departure_airport, self.arrival_airport, self.departure_time
+        )
+        for key, value in values.items():
+            setattr(self, key, value)
+
+    def _route_value(self, key: str) -> Any:
+        value = getattr(self, key)
+        if value is None:
+            # Not written yet so calculate it from the airports.
+            if self.departure_airport is None or self.arrival_airport is None:
+                return None
+            value = Flight.route(
+                self.departure_airport, self.arrival_airport, self.departure_time
+            )[key]
+        return value
+
+    @hybrid_property
+    def distance(self) -> float:
+        return self._route_value("_distance")
+
+    @distance.expression
+    def distance(cls):
+        return cls._distance
 
-        return self.departure_airport.distance_to(self.arrival_airport)
+    @hybrid_property
+    def duration(self) -> int:
+        """Flight time in minutes."""
+        return self._route_value("_duration")
+
+    @duration.expression
+    def duration(cls):
+        return cls._duration
 
     @property
     def flight_time(self) -> dt.timedelta:
-        if self.departure_airport is None or self.arrival_airport is None:
+        duration = self.duration
+        if duration is None:
             return None
+        return dt.timedelta(minutes=duration)
 
-        return self.departure_airport.time_to(self.arrival_airport) + dt.timedelta(minutes=45)
-
-    @property
+    @hybrid_property
     def arrival_time(self) -> dt.time:
-        departure_dt = dt.datetime.combine(dt.date.today(), self.departure_time)
-        arrival_dt = departure_dt + self.flight_time
-        return arrival_dt.time()
+        return self._route_value("_arrival_time")
+
+    @arrival_time.expression
+    def arrival_time(cls):
+        return cls._arrival_time
+
+    @hybrid_property
+    def base_fare(self) -> float:
+        return self._route_value("_base_fare")
+
+    @base_fare.expression
+    def base_fare(cls):
+        return cls._base_fare
 
     def cost(self, date: dt.date) -> float:
-        # TODO: Figure out better pricing model.
-        # Maybe base it on date?
-        # Weekends more expenive?
-        # Have the ability to put surge charges in the DB?
-        return round(self.distance * 0.2, 2)
+        return self.base_fare
 
     def is_cancelled(self, date: dt.date) -> bool:
         cancellation = (
@@ -332,77 +699,126 @@ class Flight(PaginatedAPIMixin, db.Model):
         )
         return cancellation is not None
 
-    def cancel(self, date: dt.date, user_id: int) -> "FlightCancellation":
+    def cancel(
+        self, date: dt.date, user_id: int, commit: bool = True, notify: bool = True
+    ) -> "CancellationSummary":
+        """Cancel the flight on date and refund every ticket for it.
+
+        The tickets are refunded with a single UPDATE and the refunds are
+        calculated with one grouped query so the number of round trips
+        doesn't depend on how many passengers were booked. Pass commit=False
+        to cancel several flights in one transaction, the caller is then
+        responsible for committing and invalidating the search cache. Pass
+        notify=False to send the customers a different email.
+        """
         if date < self.start or date > self.end:
             raise ValueError("date must be between start and end")
 
+        # Make sure the inventory exists before any tickets are refunded.
+        instance = FlightInstance.get(self, date)
+
+        # The refunded tickets get the same timestamp so they can be found later.
+        now = dt.datetime.utcnow()
         cancellation = FlightCancellation(
-            date=date, cancelled_by=user_id, flight_id=self.id
+            date=date, cancelled_by=user_id, flight_id=self.id, timestamp=now
         )
         db.session.add(cancellation)
 
-        # Refund all of the tickets
-        tickets = (
-            PurchasedTicket.query.filter_by(flight_id=self.id)
-            .join(PurchaseTransaction)
-            .filter(PurchaseTransaction.departure_date == date)
-            .filter(PurchasedTicket.refund_timestamp == None)
+        affected = and_(
+            PurchasedTicket.flight_id == self.id,
+            PurchasedTicket.refund_timestamp == None,
+        )
+        transaction_ids = sql.select(PurchaseTransaction.id).where(
+            PurchaseTransaction.departure_date == date
+        )
+        # Everything needed to refund each purchase. The totals include the
+        # tickets for other flights since the taxes are split across all of them.
+        refunds = (
+            db.session.query(
+                PurchaseTransaction,
+                func.count(PurchasedTicket.id),
+                func.sum(PurchasedTicket.purchase_price),
+                func.sum(sql.case((affected, 1), else_=0)),
+                func.sum(sql.case((affected, PurchasedTicket.purchase_price), else_=0)),
+            )
+            .join(PurchaseTransaction.tickets)
+            .filter(
+                PurchaseTransaction.id.in_(
+                    sql.select(PurchasedTicket.transaction_id).where(
+                        affected, PurchasedTicket.transaction_id.in_(transaction_ids)
+                    )
+                )
+            )
+            .group_by(PurchaseTransaction.id)
+            .order_by(PurchaseTransaction.id)
             .all()
         )
 
-        emails = []
-        for ticket in tickets:
-            ticket.refund_timestamp = func.now()
-            ticket.refunded_by = user_id
-
-            transaction = ticket.transaction
-            email = transaction.email
-            if email not in emails:
-                refund_amount = ticket.purchase_price + (
-                    transaction.taxes / len(transaction.tickets)
+        refunded = (
+            PurchasedTicket.query.filter(
+                affected, PurchasedTicket.transaction_id.in_(transaction_ids)
+            )
+            .update(
+                {
+                    PurchasedTicket.refund_timestamp: now,
+                    PurchasedTicket.refunded_by: user_id,
+                },
+                synchronize_session=False,
+            )
+        )
+
+        summary = CancellationSummary(cancellation, refunded)
+        for transaction, tickets, base_fare, passengers, fare_refund in refunds:
+            taxes = round(transaction.purchase_price - base_fare, 2)
+            summary.add(transaction, passengers, fare_refund + taxes * passengers / tickets)
+        AgentDailySales.record_refunds(
+            [(transaction, refund) for transaction, _, refund in summary.refunds], now
+        )
+
+        if notify:
+            # One email per customer with the refunds for all of their purchases.
+            emails: Dict[str, Dict[str, Any]] = OrderedDict()
+            for transaction, _, refund_amount in summary.refunds:
+                context = emails.setdefault(
+                    transaction.email,
+                    {"purchases": [], "flight": self, "date": date, "refund_amount": 0},
                 )
-                emails.append(
-                    (
-                        email,
-                        {
-                            "transaction": transaction,
-                            "flight": self,
-                            "date": date,
-                            "refund_amount": refund_amount,
-                        },
-                    )
+                context["purchases"].append(
+                    {"transaction": transaction, "refund_amount": refund_amount}
                 )
+                context["refund_amount"] += refund_amount
+            queue_bulk_email(
+                "Flight Cancellation", "email/flight_cancellation", list(emails.items())
+            )
+
+        instance.cancel(refunded=refunded)
+
+        if not commit:
+            db.session.flush()
+            return summary
 
         db.session.commit()
         db.session.refresh(cancellation)
+        outbox.notify()
+        search_cache.invalidate_flights([self.id])
 
-        send_bulk_email(
-            "Flight Cancellation",
-            emails,
-            "email/flight_cancellation.txt",
-            "email/flight_cancellation.html",
-        )
-
-        return cancellation
+        return summary
 
     def available_seats(self, date: dt.date) -> int:
         if date < self.start or date > self.end:
             raise ValueError("date must be between start and end")
 
-        if self.is_cancelled(date):
-            return 0
+        return FlightInstance.get(self, date).available
 
-        capacity = self.airplane.capacity
-        used = (
-            PurchasedTicket.query.filter_by(flight_id=self.id)
-            .outerjoin(
-                PurchaseTransaction,
-                PurchaseTransaction.id == PurchasedTicket.transaction_id,
-            )
-            .filter(PurchaseTransaction.departure_date == date)
-            .count()
-        )
-        return capacity - used
+    @classmethod
+    def load_plan(cls, expand: bool = False) -> List:
+        if not expand:
+            return []
+        return [
+            joinedload(Flight.airplane),
+            joinedload(Flight.departure_airport),
+            joinedload(Flight.arrival_airport),
+        ]
 
     def to_dict(self, expand=False) -> Dict[str, Any]:
         data = super().to_dict()
@@ -412,26 +828,158 @@ class Flight(PaginatedAPIMixin, db.Model):
         del data["airplane_id"]
         del data["departure_id"]
         del data["arrival_id"]
+        for key in ("_distance", "_duration", "_arrival_time", "_base_fare"):
+            data.pop(key, None)
 
         data["flight_time"] = str(self.flight_time)
-        data["arrival_time"] = self.arrival_time.strftime("%H:%M")
-        data["status"] = url_for("api.flightstatus", id=self.id)
-        data["cancel"] = url_for("api.flightcancellation", id=self.id)
+        data["arrival_time"] = self.arrival_time
+        data["status"] = url_for_id("api.flightstatus", self.id)
+        data["cancel"] = url_for_id("api.flightcancellation", self.id)
 
         if expand:
             data["airplane"] = self.airplane.to_dict()
             data["departure_airport"] = self.departure_airport.to_dict()
             data["arrival_airport"] = self.arrival_airport.to_dict()
         else:
-            data["airplane"] = url_for(self.airplane.__endpoint__, id=self.airplane.id)
-            data["departure_airport"] = url_for(
-                self.departure_airport.__endpoint__, id=self.departure_id
+            # Only the ids are needed for links so don't load the relationships.
+            data["airplane"] = url_for_id(Airplane.__endpoint__, self.airplane_id)
+            data["departure_airport"] = url_for_id(Airport.__endpoint__, self.departure_id)
+            data["arrival_airport"] = url_for_id(Airport.__endpoint__, self.arrival_id)
+
+        return data
+
+
+@event.listens_for(Flight, "before_insert")
+@event.listens_for(Flight, "before_update")
+def _store_route(mapper, connection, flight: Flight) -> None:
+    """Store the route values whenever a flight's route changes."""
+    state = db.inspect(flight)
+    changed = any(
+        state.attrs[key].history.has_changes()
+        for key in ("departure_id", "arrival_id", "departure_time")
+    )
+    if not changed and flight._distance is not None:
+        return
+
+    # Use the airports already in the session when we can. Otherwise
+    # they're read with the connection since a flush is in progress.
+    ids = (flight.departure_id, flight.arrival_id)
+    coords = {}
+    for id in ids:
+        airport = state.session.identity_map.get(identity_key(Airport, id))
+        if airport is not None:
+            coords[id] = airport
+    missing = [id for id in ids if id not in coords]
+    if missing:
+        airports = Airport.__table__
+        rows = connection.execute(
+            sql.select(airports.c.id, airports.c.latitude, airports.c.longitude).where(
+                airports.c.id.in_(missing)
             )
-            data["arrival_airport"] = url_for(
-                self.arrival_airport.__endpoint__, id=self.arrival_id
+        )
+        coords.update({row.id: row for row in rows})
+    departure = coords.get(flight.departure_id)
+    arrival = coords.get(flight.arrival_id)
+    if departure is None or arrival is None or flight.departure_time is None:
+        return
+
+    values = Flight.route(departure, arrival, flight.departure_time)
+    for key, value in values.items():
+        setattr(flight, key, value)
+
+
+class FlightInstance(db.Model):
+    """Seat inventory for a single day of a flight.
+
+    The sold counter is maintained with atomic updates by checkout, refunds and
+    cancellations so availability is a primary key lookup instead of counting tickets.
+    Rows are created the first time a flight's date is needed.
+    """
+
+    flight_id = db.Column(db.Integer, db.ForeignKey("flight.id"), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    capacity = db.Column(db.Integer, nullable=False)
+    sold = db.Column(db.Integer, nullable=False, default=0)
+    cancelled = db.Column(db.Boolean, nullable=False, default=False)
+
+    flight = db.relationship(
+        "Flight", backref=db.backref("instances", cascade="all, delete-orphan")
+    )
+
+    @property
+    def available(self) -> int:
+        if self.cancelled:
+            return 0
+        return self.capacity - self.sold
+
+    @staticmethod
+    def get(flight: Flight, date: dt.date) -> "FlightInstance":
+        instance = FlightInstance.query.get((flight.id, date))
+        if instance is None:
+            instance = FlightInstance._materialize(flight, date)
+        return instance
+
+    @staticmethod
+    def _materialize(flight: Flight, date: dt.date) -> "FlightInstance":
+        # Don't let tickets that are still being created get counted twice.
+        with db.session.no_autoflush:
+            sold = (
+                PurchasedTicket.query.filter_by(flight_id=flight.id)
+                .join(PurchaseTransaction)
+                .filter(PurchaseTransaction.departure_date == date)
+                .filter(PurchasedTicket.refund_timestamp == None)
+                .count()
+            )
+            instance = FlightInstance(
+                flight_id=flight.id,
+                date=date,
+                capacity=flight.airplane.capacity,
+                sold=sold,
+                cancelled=flight.is_cancelled(date),
             )
 
-        return data
+        try:
+            with db.session.begin_nested():
+                db.session.add(instance)
+        except IntegrityError:
+            # Someone else created it first
+            instance = FlightInstance.query.get((flight.id, date))
+        return instance
+
+    def _update(self, *criteria, **values) -> bool:
+        updated = (
+            FlightInstance.query.filter_by(flight_id=self.flight_id, date=self.date)
+            .filter(*criteria)
+            .update(values, synchronize_session=False)
+        )
+        db.session.expire(self)
+        return updated == 1
+
+    @staticmethod
+    def sell(flight: Flight, date: dt.date, seats: int) -> bool:
+        """Atomically sell seats on a flight. Returns False if there aren't enough seats."""
+        instance = FlightInstance.get(flight, date)
+        return instance._update(
+            FlightInstance.cancelled == False,
+            FlightInstance.capacity - FlightInstance.sold >= seats,
+            sold=FlightInstance.sold + seats,
+        )
+
+    @staticmethod
+    def release(flight: Flight, date: dt.date, seats: int) -> None:
+        """Atomically return seats from refunded tickets."""
+        instance = FlightInstance.get(flight, date)
+        instance._update(sold=FlightInstance.sold - seats)
+
+    def cancel(self, refunded: int) -> None:
+        self._update(cancelled=True, sold=FlightInstance.sold - refunded)
+
+    @staticmethod
+    def update_capacity(flight_ids: List[int], capacity: int) -> None:
+        """Update the capacity after the airplane for a flight changes."""
+        FlightInstance.query.filter(FlightInstance.flight_id.in_(flight_ids)).update(
+            {"capacity": capacity}, synchronize_session=False
+        )
 
 
 class FlightCancellation(db.Model):
@@ -440,10 +988,410 @@ class FlightCancellation(db.Model):
     flight_id = db.Column(db.Integer, db.ForeignKey("flight.id"))
     cancelled_by = db.Column(db.Integer, db.ForeignKey("agent.id"))
     date = db.Column(db.Date, nullable=False)
+    # Matches the refund_timestamp of the tickets refunded by the cancellation.
+    timestamp = db.Column(db.DateTime)
 
     flight = db.relationship("Flight", backref="cancellations")
 
 
+class CancellationSummary:
+    """The passengers affected by a flight cancellation."""
+
+    def __init__(self, cancellation: FlightCancellation, passengers: int) -> None:
+        self.cancellation = cancellation
+        self.passengers = passengers
+        # (transaction, passengers, refund amount) for each purchase
+        self.refunds: List[Tuple["PurchaseTransaction", int, float]] = []
+
+    def add(self, transaction: "PurchaseTransaction", passengers: int, refund: float) -> None:
+        self.refunds.append((transaction, passengers, refund))
+
+    @property
+    def refund_total(self) -> float:
+        return sum(refund for _, _, refund in self.refunds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "flight": url_for_id(Flight.__endpoint__, self.cancellation.flight_id),
+            "date": self.cancellation.date,
+            "passengers": self.passengers,
+            "purchases": [
+                {
+                    "confirmation_number": transaction.confirmation_number,
+                    "email": transaction.email,
+                    "passengers": passengers,
+                    "refund_amount": round(refund, 2),
+                }
+                for transaction, passengers, refund in self.refunds
+            ],
+            "refund_total": round(self.refund_total, 2),
+        }
+
+
+class CancellationJob(db.Model):
+    """Cancels the flights from an airport or a list of flights over a range
+    of dates.
+
+    The flight dates to cancel are saved when the job is planned so flights
+    added or changed later don't shift its progress. Flights are cancelled
+    in batches that each get their own transaction and the progress is saved
+    with every batch so it can be watched through the api. A job that failed
+    or hasn't saved any progress in CANCELLATION_JOB_TIMEOUT seconds because
+    its process died can be resumed through the api or with
+    `flask resume-cancellations`. Customers get one email once the job is
+    done listing all of their flights that were cancelled.
+    """
+
+    __tablename__ = "cancellation_job"
+    __endpoint__ = "api.flightcancellationjob"
+
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETE = "complete"
+    FAILED = "failed"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    created_by = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    airport_id = db.Column(db.Integer, db.ForeignKey("airport.id"))
+    # JSON encoded list of flight ids
+    flight_ids = db.Column(db.Text)
+    start = db.Column(db.Date, nullable=False)
+    end = db.Column(db.Date, nullable=False)
+
+    status = db.Column(db.String(10), nullable=False, default=PENDING)
+    # JSON encoded [flight id, date] pairs to cancel in the order they're processed
+    pairs = db.Column(db.Text)
+    # Number of flight dates to cancel and how many are done
+    total = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    cancelled = db.Column(db.Integer, nullable=False, default=0)
+    passengers = db.Column(db.Integer, nullable=False, default=0)
+    refund_total = db.Column(db.Float, nullable=False, default=0)
+    # Emails held until the job is done so each customer only gets one.
+    notifications = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    # Updated with every batch so jobs whose process died can be found.
+    updated = db.Column(db.DateTime, default=dt.datetime.utcnow)
+    finished = db.Column(db.DateTime)
+
+    def to_dict(self) -> Dict[str, Any]:
+        finished = self.finished
+        if finished:
+            finished = finished.isoformat()
+
+        return {
+            "self": url_for_id(self.__endpoint__, self.id),
+            "status": self.status,
+            "airport": url_for_id(Airport.__endpoint__, self.airport_id)
+            if self.airport_id is not None
+            else None,
+            "flights": [
+                url_for_id(Flight.__endpoint__, id)
+                for id in json.loads(self.flight_ids or "[]")
+            ],
+            "start": self.start,
+            "end": self.end,
+            "total": self.total,
+            "processed": self.processed,
+            "cancelled": self.cancelled,
+            "passengers": self.passengers,
+            "refund_total": round(self.refund_total, 2),
+            "error": self.error,
+            "created": self.created.isoformat(),
+            "finished": finished,
+        }
+
+    @staticmethod
+    def resumable(timeout: int):
+        """Filter for jobs that failed or whose process died."""
+        stale = dt.datetime.utcnow() - dt.timedelta(seconds=timeout)
+        return sql.or_(
+            CancellationJob.status == CancellationJob.FAILED,
+            and_(
+                CancellationJob.status.in_(
+                    (CancellationJob.PENDING, CancellationJob.RUNNING)
+                ),
+                sql.or_(CancellationJob.updated == None, CancellationJob.updated < stale),
+            ),
+        )
+
+    def claim(self, timeout: int) -> bool:
+        """Mark the job as running if it can be resumed.
+        Checking in the UPDATE means only one caller wins each job.
+        """
+        claimed = CancellationJob.query.filter(
+            CancellationJob.id == self.id, CancellationJob.resumable(timeout)
+        ).update(
+            {
+                CancellationJob.status: CancellationJob.RUNNING,
+                CancellationJob.updated: dt.datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+        db.session.refresh(self)
+        return bool(claimed)
+
+    def plan(self) -> None:
+        """Save every flight id and date to cancel."""
+        pairs = self._find_pairs()
+        self.pairs = json.dumps([[id, date.isoformat()] for id, date in pairs])
+        self.total = len(pairs)
+
+    def _planned_pairs(self) -> List[Tuple[int, dt.date]]:
+        return [(id, dt.date.fromisoformat(date)) for id, date in json.loads(self.pairs)]
+
+    def _find_pairs(self) -> List[Tuple[int, dt.date]]:
+        """Every flight id and date to cancel in the order they're processed."""
+        query = Flight.query.with_entities(Flight.id, Flight.start, Flight.end).filter(
+            Flight.start <= self.end, Flight.end >= self.start
+        )
+        if self.airport_id is not None:
+            query = query.filter(
+                sql.or_(
+                    Flight.departure_id == self.airport_id,
+                    Flight.arrival_id == self.airport_id,
+                )
+            )
+        if self.flight_ids:
+            query = query.filter(Flight.id.in_(json.loads(self.flight_ids)))
+        flights = query.order_by(Flight.id).all()
+
+        pairs = []
+        date = self.start
+        while date <= self.end:
+            pairs.extend((id, date) for id, start, end in flights if start <= date <= end)
+            date += dt.timedelta(days=1)
+        return pairs
+
+    def _cancel(self, batch: List[Tuple[int, dt.date]]) -> None:
+        ids = {id for id, _ in batch}
+        flights = {
+            flight.id: flight
+            for flight in Flight.query.options(joinedload(Flight.airplane)).filter(
+                Flight.id.in_(ids)
+            )
+        }
+        # Flights that were already cancelled don't need to be cancelled again
+        cancelled = set(
+            db.session.query(FlightCancellation.flight_id, FlightCancellation.date)
+            .filter(FlightCancellation.flight_id.in_(ids))
+            .filter(FlightCancellation.date.in_({date for _, date in batch}))
+        )
+
+        notifications = json.loads(self.notifications or "{}")
+        for id, date in batch:
+            if (id, date) in cancelled or id not in flights:
+                continue
+            # The flight's dates could have changed since the job was planned.
+            if not flights[id].start <= date <= flights[id].end:
+                continue
+            summary = flights[id].cancel(date, self.created_by, commit=False, notify=False)
+            self.cancelled += 1
+            self.passengers += summary.passengers
+            self.refund_total += summary.refund_total
+            for transaction, _, refund in summary.refunds:
+                purchases = notifications.setdefault(transaction.email, {})
+                purchase = purchases.setdefault(
+                    str(transaction.id), {"flights": [], "refund_amount": 0}
+                )
+                purchase["flights"].append([id, date.isoformat()])
+                purchase["refund_amount"] += refund
+        self.notifications = json.dumps(notifications)
+
+    def _notify(self) -> None:
+        """Email each customer once about every flight of theirs that was cancelled."""
+        notifications = json.loads(self.notifications or "{}")
+        transaction_ids = {
+            int(id) for purchases in notifications.values() for id in purchases
+        }
+        flight_ids = {
+            id
+            for purchases in notifications.values()
+            for purchase in purchases.values()
+            for id, _ in purchase["flights"]
+        }
+        transactions = {
+            transaction.id: transaction
+            for transaction in PurchaseTransaction.query.filter(
+                PurchaseTransaction.id.in_(transaction_ids)
+            )
+        }
+        flights = {
+            flight.id: flight
+            for flight in Flight.query.filter(Flight.id.in_(flight_ids))
+        }
+
+        emails = []
+        for email, purchases in notifications.items():
+            context = []
+            for id, purchase in purchases.items():
+                context.append(
+                    {
+                        "transaction": transactions[int(id)],
+                        "flights": [
+                            {"flight": flights[flight_id], "date": dt.date.fromisoformat(date)}
+                            for flight_id, date in purchase["flights"]
+                        ],
+                        "refund_amount": purchase["refund_amount"],
+                    }
+                )
+            emails.append((email, {"purchases": context}))
+        queue_bulk_email("Flight Cancellation", "email/bulk_cancellation", emails)
+        self.notifications = None
+
+    def run(self, batch_size: int = 20) -> None:
+        """Cancel the flights that haven't been processed yet."""
+        try:
+            if self.pairs is None:
+                self.plan()
+            pairs = self._planned_pairs()
+            self.status = CancellationJob.RUNNING
+            self.error = None
+            self.updated = dt.datetime.utcnow()
+            db.session.commit()
+
+            # The pairs are saved so processed is always where to pick up.
+            while self.processed < len(pairs):
+                batch = pairs[self.processed : self.processed + batch_size]
+                self._cancel(batch)
+                self.processed += len(batch)
+                self.updated = dt.datetime.utcnow()
+                db.session.commit()
+                search_cache.invalidate_flights({id for id, _ in batch})
+
+            self._notify()
+            self.status = CancellationJob.COMPLETE
+            self.finished = self.updated = dt.datetime.utcnow()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self.status = CancellationJob.FAILED
+            self.error = str(e)
+            db.session.commit()
+            current_app.logger.error("Cancellation job %s failed", self.id, exc_info=e)
+        outbox.notify()
+
+    def submit(self) -> None:
+        """Run the job in a background thread.
+        Runs right away instead when CANCELLATION_JOBS_EAGER is set.
+        """
+        app = current_app._get_current_object()
+        batch_size = app.config.get("CANCELLATION_JOB_BATCH_SIZE", 20)
+        if app.config.get("CANCELLATION_JOBS_EAGER", False):
+            self.run(batch_size)
+            return
+
+        thread = threading.Thread(
+            target=_run_cancellation_job,
+            args=(app, self.id, batch_size),
+            name="cancellation-job",
+            daemon=True,
+        )
+        thread.start()
+
+
+def _run_cancellation_job(app, id: int, batch_size: int) -> None:
+    with app.app_context():
+        try:
+            job = db.session.get(CancellationJob, id)
+            if job is not None:
+                job.run(batch_size)
+        finally:
+            db.session.remove()
+
+
+@click.command("resume-cancellations")
+def resume_cancellations() -> None:
+    """Run the cancellation jobs that failed or whose process died."""
+    timeout = current_app.config.get("CANCELLATION_JOB_TIMEOUT", 300)
+    batch_size = current_app.config.get("CANCELLATION_JOB_BATCH_SIZE", 20)
+    ids = [
+        id
+        for id, in db.session.query(CancellationJob.id)
+        .filter(CancellationJob.resumable(timeout))
+        .order_by(CancellationJob.id)
+    ]
+    for id in ids:
+        job = db.session.get(CancellationJob, id)
+        if not job.claim(timeout):
+            continue
+        click.echo(f"Resuming cancellation job {id}")
+        job.run(batch_size)
+        click.echo(f"Cancellation job {id} {job.status}")
+
+
+class ItineraryQuote(db.Model):
+    """An itinerary quoted to a session. See app.quotes."""
+
+    __tablename__ = "itinerary_quote"
+
+    # The itinerary id
+    id = db.Column(db.String(32), primary_key=True)
+    # The token in the session the quote belongs to
+    owner = db.Column(db.String(32), nullable=False)
+    # date|flight ids|price in cents
+    value = db.Column(db.String(255), nullable=False)
+    expires = db.Column(db.DateTime, index=True, nullable=False)
+
+
+class EmailOutbox(db.Model):
+    """An email waiting to be sent by the outbox workers. See app.outbox."""
+
+    __tablename__ = "email_outbox"
+
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    subject = db.Column(db.String(255), nullable=False)
+    recipient = db.Column(db.String(120), nullable=False)
+    # Template name without the extension
+    template = db.Column(db.String(120), nullable=False)
+    # JSON encoded template variables
+    context = db.Column(db.Text, nullable=False)
+    base_url = db.Column(db.String(255))
+
+    status = db.Column(db.String(10), index=True, nullable=False, default=PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    next_attempt = db.Column(
+        db.DateTime, index=True, nullable=False, default=dt.datetime.utcnow
+    )
+    # Which worker is sending the email and when it started
+    claimed_by = db.Column(db.String(32))
+    claimed_at = db.Column(db.DateTime)
+    created = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    sent_timestamp = db.Column(db.DateTime)
+
+    def failed(self, error: str, max_attempts: int, retry_delay: int) -> None:
+        """Schedule another attempt with an exponential backoff
+        or give up after max_attempts.
+        """
+        self.attempts += 1
+        self.last_error = error
+        self.claimed_by = None
+        self.claimed_at = None
+        if self.attempts >= max_attempts:
+            self.status = EmailOutbox.FAILED
+        else:
+            self.status = EmailOutbox.PENDING
+            delay = retry_delay * 2 ** (self.attempts - 1)
+            self.next_attempt = dt.datetime.utcnow() + dt.timedelta(seconds=delay)
+
+    def sent(self) -> None:
+        self.attempts += 1
+        self.status = EmailOutbox.SENT
+        self.sent_timestamp = dt.datetime.utcnow()
+        self.claimed_by = None
+        self.claimed_at = None
+
+
 class PurchaseTransaction(PaginatedAPIMixin, db.Model):
     __endpoint__ = "api.purchase"
     __searchable__ = ["email", "confirmation_number"]
@@ -536,6 +1484,18 @@ class PurchaseTransaction(PaginatedAPIMixin, db.Model):
         )
         return query.first()[0]
 
+    @classmethod
+    def load_plan(cls, expand: bool = False) -> List:
+        tickets = selectinload(PurchaseTransaction.tickets)
+        options = [tickets.options(*PurchasedTicket.load_plan(expand))]
+        if expand:
+            options += [
+                joinedload(PurchaseTransaction.departure_airport),
+                joinedload(PurchaseTransaction.destination_airport),
+                joinedload(PurchaseTransaction.agent),
+            ]
+        return options
+
     def to_dict(self, expand=False) -> Dict[str, Any]:
         data = super().to_dict(expand)
 
@@ -552,14 +1512,12 @@ class PurchaseTransaction(PaginatedAPIMixin, db.Model):
             if self.agent:
                 data["agent"] = f"{self.agent.first_name} {self.agent.last_name}"
         else:
-            data["departure_airport"] = url_for(
-                self.departure_airport.__endpoint__, id=self.departure_id
+            data["departure_airport"] = url_for_id(Airport.__endpoint__, self.departure_id)
+            data["destination_airport"] = url_for_id(
+                Airport.__endpoint__, self.destination_id
             )
-            data["destination_airport"] = url_for(
-                self.destination_airport.__endpoint__, id=self.destination_id
-            )
-            if self.agent:
-                data["agent"] = url_for("api.agents", id=self.assisted_by)
+            if self.assisted_by is not None:
+                data["agent"] = url_for_id("api.agents", self.assisted_by)
 
         data["tickets"] = [ticket.to_dict(expand) for ticket in self.tickets]
         return data
@@ -585,25 +1543,33 @@ class PurchasedTicket(db.Model):
     flight = db.relationship("Flight", backref="tickets")
     agent = db.relationship("Agent", backref="refunds")
 
+    @staticmethod
+    def load_plan(expand: bool = False) -> List:
+        options = [joinedload(PurchasedTicket.agent)]
+        if expand:
+            flight = joinedload(PurchasedTicket.flight)
+            options.append(flight.options(*Flight.load_plan(expand)))
+        return options
+
     def to_dict(self, expand=False):
         refund = self.refund_timestamp
         if refund:
             refund = refund.isoformat()
 
         agent = None
-        if self.agent:
+        if self.refunded_by is not None:
             agent = f"{self.agent.first_name} {self.agent.last_name}"
 
         return {
-            "self": url_for("api.purchase", id=self.id),
+            "self": url_for_id("api.purchase", self.id),
             "flight": self.flight.to_dict(expand)
             if expand
-            else url_for("api.flight", id=self.flight_id),
-            "transaction": url_for("api.purchase", id=self.transaction_id),
+            else url_for_id("api.flight", self.flight_id),
+            "transaction": url_for_id("api.purchase", self.transaction_id),
             "first_name": self.first_name,
             "middle_name": self.middle_name,
             "last_name": self.last_name,
-            "date_of_birth": self.date_of_birth.strftime("%Y-%m-%d"),
+            "date_of_birth": self.date_of_birth,
             "gender": self.gender,
             "purchase_price": self.purchase_price,
             "refund_timestamp": refund,
@@ -639,6 +1605,9 @@ class TripFlight:
         return data
 
 
+SEARCH_ENGINES = ("dfs", "csa")
+
+
 class TripItinerary:
     def __init__(
         self,
@@ -816,144 +1785,67 @@ class TripItinerary:
         min_layover_time: dt.timedelta = dt.timedelta(minutes=45),
         max_layover_time: dt.timedelta = dt.timedelta(hours=12),
         max_trip_time: dt.timedelta = dt.timedelta(days=1),
-        previous_flight: "Flight" = None,
-        current_itinerary: "TripItinerary" = None,
-        trip_itinerarys: List["TripItinerary"] = None,
+        engine: str = "dfs",
     ) -> List["TripItinerary"]:
-        """Recursive function to create TripItineraries from departing_airport to final_airport.
-        Final return value is a list of TripItineraries.
-        """
-        # If this is the first call to this function
-        # we need to initialize the lists.
-        if current_itinerary is None:
-            current_itinerary = TripItinerary(departure_dt.date())
-
-        if trip_itinerarys is None:
-            trip_itinerarys = []
-
-        query = Flight.query
-
-        if previous_flight:
-            # If a previous flight was given, add it to the current path.
-            current_itinerary.add_flight(previous_flight)
-            if current_itinerary.total_time > max_trip_time:
-                return
-            # If the previous flight ended at our destination
-            # that's the end of this path. Add it to the paths.
-            if previous_flight.arrival_id == final_airport:
-                trip_itinerarys.append(current_itinerary.copy())
-                current_itinerary.pop_flight()
-                return
-
-            departure_dt = current_itinerary.arrival_datetime.astimezone(dt.timezone.utc)
-            departure_dt += min_layover_time
-
-        departure_date = departure_dt.date()
-        departure_time = departure_dt.time()
-        # Filter out flights that depart before our departure_time
-        if previous_flight:
-            # Not our first time calling the function so use the normal departure time
-            query = query.filter(Flight.departure_time >= departure_time)
-        else:
-            # First time calling our function so we need to handle situations where the timezone wraps
-            # around past midnight in the airports timezone. Fixes issues where some flights aren't retrieved
-            # because they are "before" the departure time.
-            airport = Airport.query.get(departing_airport)
-            tz = ZoneInfo(airport.timezone)
-            midnight = dt.datetime.combine(departure_date, dt.time(0, 0, 0, tzinfo=tz)).astimezone(dt.timezone.utc)
-            if departure_time > dt.time(0,0,0,0) and departure_time < midnight.time():
-                query = query.filter(and_(Flight.departure_time >= departure_time, Flight.departure_time < midnight.time()))
-            else:
-                query = query.filter(or_(Flight.departure_time >= departure_time, Flight.departure_time < midnight.time()))
-                
-        # Find flights departing from our current airport.
-        query = query.filter_by(departure_id=departing_airport)
-        # Make sure flights fall within the departure date.
-        query = query.filter(Flight.start <= departure_date)
-        query = query.filter(departure_date <= Flight.end)
-        # Make sure we avoid any cancelled flights.
-        query = query.filter(
-            ~Flight.cancellations.any(FlightCancellation.date == departure_date)
-        )
-        # If we are at our max layovers, only get flights
-        # that go straight to our destination
-        if current_itinerary.layovers == max_layovers - 1:
-            query = query.filter_by(arrival_id=final_airport)
-
-        # Make sure this flight doesn't backtrack to an airport we've already been to.
-        prev_ids = [flight.flight.departure_id for flight in current_itinerary._flights]
-        query = query.filter(~Flight.arrival_id.in_(prev_ids))
+        """Create TripItineraries from departing_airport to final_airport.
+        The search walks the in memory route graph and only goes to the
+        database to check seat availability and to load the resulting flights.
 
-        # Create a subquery which counts the total number of tickets sold for each flight
-        subquery = (
-            db.session.query(
-                PurchasedTicket.flight_id,
-                PurchaseTransaction.departure_date,
-                func.count(PurchasedTicket.id).label("purchased_tickets"),
-            )
-            .join(
-                PurchaseTransaction,
-                PurchasedTicket.transaction_id == PurchaseTransaction.id,
-            )
-            .filter(PurchaseTransaction.departure_date == departure_date)
-            .filter(PurchasedTicket.refund_timestamp == None)
-            .group_by(PurchasedTicket.flight_id)
-            .group_by(PurchaseTransaction.departure_date)
-            .subquery()
-        )
-        # Outer join ensures that results without purchased tickets are still retrieved
-        query = query.outerjoin(subquery, Flight.id == subquery.c.flight_id)
-        # We need to know the capacity of the plane
-        query = query.join(Airplane)
-        # Filter out flights without enough available seats or that have no tickets sold (purchased_tickets == None)
-        query = query.filter(
-            or_(
-                (Airplane.capacity - subquery.c.purchased_tickets) >= num_of_passengers,
-                subquery.c.purchased_tickets == None,
-            )
+        engine can either be "dfs" for a depth first search of the graph or "csa"
+        to use the Connection Scan Algorithm which scales much better with more layovers.
+        """
+        if engine not in SEARCH_ENGINES:
+            raise ValueError(f"engine must be one of {', '.join(SEARCH_ENGINES)}")
+
+        search = route_graph.scan if engine == "csa" else route_graph.search
+        paths = search(
+            departing_airport=departing_airport,
+            final_airport=final_airport,
+            departure_dt=departure_dt,
+            num_of_passengers=num_of_passengers,
+            max_layovers=max_layovers,
+            limit=limit,
+            min_layover_time=min_layover_time,
+            max_layover_time=max_layover_time,
+            max_trip_time=max_trip_time,
         )
+        return TripItinerary.from_paths(paths)
 
-        # Prioritize direct flights by placing them first.
-        query = query.order_by(desc(func.field(Flight.arrival_id, final_airport)))
-        # Then order by departure time.
-        query = query.order_by(desc(Flight.departure_time))
-
-        potential_flights: List[Flight] = query.all()
-        for flight in potential_flights:
-            # Enforce a maximum layover length
-            if previous_flight:
-                start = dt.datetime.combine(
-                    departure_date, previous_flight.arrival_time
-                )
-                end = dt.datetime.combine(departure_date, flight.departure_time)
-                if end < start:
-                    end += dt.timedelta(days=1)
-                delta = end - start
-                if delta > max_layover_time:
-                    continue
-
-            TripItinerary.search(
-                departing_airport=flight.arrival_id,
-                final_airport=final_airport,
-                departure_dt=departure_dt,
-                num_of_passengers=num_of_passengers,
-                max_layovers=max_layovers,
-                limit=limit,
-                min_layover_time=min_layover_time,
-                max_layover_time=max_layover_time,
-                max_trip_time=max_trip_time,
-                previous_flight=flight,
-                current_itinerary=current_itinerary,
-                trip_itinerarys=trip_itinerarys,
-                
-            )
-
-            if len(trip_itinerarys) >= limit:
-                break
-
-        # When we exit this context it means we are done with this
-        # branch of the "tree". Remove this flight from the path.
-        if len(current_itinerary):
-            current_itinerary.pop_flight()
+    @staticmethod
+    def from_paths(
+        paths: List["SearchPath"], keep_missing: bool = False
+    ) -> List[Optional["TripItinerary"]]:
+        """Convert route graph search results into TripItineraries
+        loading all of the flights with a single query.
+
+        Paths from a stale graph can use flights another process deleted.
+        They're dropped, or returned as None with keep_missing so the
+        results still line up with paths.
+        """
+        ids = {id for path in paths for id in path.flight_ids}
+        if not ids:
+            return []
 
-        return trip_itinerarys
+        flights = {
+            flight.id: flight
+            for flight in Flight.query.filter(Flight.id.in_(ids)).all()
+        }
+        # The airports and airplanes come from the reference cache instead of a join.
+        for flight in flights.values():
+            for key, model, id in (
+                ("airplane", Airplane, flight.airplane_id),
+                ("departure_airport", Airport, flight.departure_id),
+                ("arrival_airport", Airport, flight.arrival_id),
+            ):
+                item = reference_cache.get(model, id)
+                if item is not None:
+                    set_committed_value(flight, key, item)
+        itineraries = [
+            TripItinerary(path.date, [flights[id] for id in path.flight_ids])
+            if all(id in flights for id in path.flight_ids)
+            else None
+            for path in paths
+        ]
+        if keep_missing:
+            return itineraries
+        return [itinerary for itinerary in itineraries if itinerary is not None]
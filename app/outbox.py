@@ -0,0 +1,202 @@
+import datetime as dt
+import logging
+import threading
+import uuid
+from typing import List, Optional
+
+import click
+from flask import current_app
+from sqlalchemy import and_, or_
+
+logger = logging.getLogger(__name__)
+
+
+class _OutboxState:
+    def __init__(self, app) -> None:
+        config = app.config
+        self.app = app
+        # Send emails in the request instead of in the background.
+        self.eager = config.get("EMAIL_OUTBOX_EAGER", False)
+        self.workers = config.get("EMAIL_OUTBOX_WORKERS", 2)
+        self.batch_size = config.get("EMAIL_OUTBOX_BATCH_SIZE", 50)
+        self.max_attempts = config.get("EMAIL_OUTBOX_MAX_ATTEMPTS", 5)
+        # Seconds before the first retry, doubled after every failed attempt.
+        self.retry_delay = config.get("EMAIL_OUTBOX_RETRY_DELAY", 30)
+        # Seconds between checking for retries and emails queued by other processes.
+        self.poll_interval = config.get("EMAIL_OUTBOX_POLL_INTERVAL", 10)
+        # Emails that have been sending this long belong to a worker that died.
+        self.claim_timeout = config.get("EMAIL_OUTBOX_CLAIM_TIMEOUT", 300)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.threads: List[threading.Thread] = []
+
+
+class Outbox:
+    """Delivers the emails in the email_outbox table.
+
+    Requests add emails to the outbox with app.email.queue_email as part of
+    their transaction and call notify after committing. A pool of worker
+    threads is started the first time notify is called in each process.
+    Each worker claims a batch of emails, renders them and sends the whole
+    batch over a single SMTP connection. Failed emails are retried with an
+    exponential backoff until EMAIL_OUTBOX_MAX_ATTEMPTS is reached.
+
+    The workers can also run in their own process with `flask send-emails`.
+    """
+
+    def __init__(self, app=None) -> None:
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        app.extensions["outbox"] = _OutboxState(app)
+        app.cli.add_command(_send_emails)
+
+    @property
+    def _state(self) -> _OutboxState:
+        return current_app.extensions["outbox"]
+
+    def notify(self) -> None:
+        """Let the workers know there are new emails in the outbox."""
+        state = self._state
+        if state.eager:
+            while self.process():
+                pass
+            return
+
+        self.start()
+        state.wake.set()
+
+    def start(self) -> None:
+        state = self._state
+        with state.lock:
+            state.threads = [thread for thread in state.threads if thread.is_alive()]
+            state.stopping.clear()
+            for _ in range(state.workers - len(state.threads)):
+                thread = threading.Thread(
+                    target=self._run, args=(state,), name="outbox", daemon=True
+                )
+                thread.start()
+                state.threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        state = self._state
+        state.stopping.set()
+        state.wake.set()
+        with state.lock:
+            for thread in state.threads:
+                thread.join(timeout)
+            state.threads = []
+
+    def _run(self, state: _OutboxState) -> None:
+        from app import db
+
+        with state.app.app_context():
+            while not state.stopping.is_set():
+                try:
+                    count = self.process()
+                except Exception as e:
+                    logger.error("Unable to process the email outbox", exc_info=e)
+                    db.session.rollback()
+                    count = 0
+                finally:
+                    db.session.remove()
+
+                if not count:
+                    state.wake.wait(state.poll_interval)
+                    state.wake.clear()
+
+    def _claim(self, state: _OutboxState) -> List["EmailOutbox"]:
+        """Mark a batch of emails as sending so no other worker sends them."""
+        from app import db
+        from app.models import EmailOutbox
+
+        now = dt.datetime.utcnow()
+        claimable = or_(
+            and_(
+                EmailOutbox.status == EmailOutbox.PENDING,
+                EmailOutbox.next_attempt <= now,
+            ),
+            and_(
+                EmailOutbox.status == EmailOutbox.SENDING,
+                EmailOutbox.claimed_at < now - dt.timedelta(seconds=state.claim_timeout),
+            ),
+        )
+        ids = [
+            id
+            for id, in db.session.query(EmailOutbox.id)
+            .filter(claimable)
+            .order_by(EmailOutbox.id)
+            .limit(state.batch_size)
+        ]
+        if not ids:
+            db.session.commit()
+            return []
+
+        # Checking claimable again means only one worker wins each email.
+        token = uuid.uuid4().hex
+        EmailOutbox.query.filter(EmailOutbox.id.in_(ids), claimable).update(
+            {
+                EmailOutbox.status: EmailOutbox.SENDING,
+                EmailOutbox.claimed_by: token,
+                EmailOutbox.claimed_at: now,
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+        return (
+            EmailOutbox.query.filter_by(claimed_by=token)
+            .order_by(EmailOutbox.id)
+            .all()
+        )
+
+    def process(self) -> int:
+        """Send one batch of emails. Returns the number of emails attempted."""
+        from app import db, mail
+        from app.email import render_email
+
+        state = self._state
+        emails = self._claim(state)
+        if not emails:
+            return 0
+
+        try:
+            with mail.connect() as conn:
+                for email in emails:
+                    try:
+                        conn.send(render_email(email))
+                    except Exception as e:
+                        logger.warning("Unable to send email %s: %s", email.id, e)
+                        email.failed(str(e), state.max_attempts, state.retry_delay)
+                    else:
+                        email.sent()
+        except Exception as e:
+            # Couldn't connect to the server or the connection was lost
+            logger.error("Unable to send emails", exc_info=e)
+            for email in emails:
+                if email.status == email.SENDING:
+                    email.failed(str(e), state.max_attempts, state.retry_delay)
+
+        db.session.commit()
+        return len(emails)
+
+
+@click.command("send-emails")
+@click.option("--once", is_flag=True, help="Send the emails that are due and exit.")
+def _send_emails(once: bool) -> None:
+    """Send the emails in the outbox."""
+    from app import outbox
+
+    if once:
+        while outbox.process():
+            pass
+        return
+
+    state = outbox._state
+    outbox.start()
+    try:
+        for thread in state.threads:
+            thread.join()
+    except KeyboardInterrupt:
+        outbox.stop()
@@ -0,0 +1,168 @@
+import datetime as dt
+import logging
+import threading
+import time
+import uuid
+from collections import namedtuple
+from typing import Iterable, Optional
+
+from cachelib import BaseCache
+from flask import current_app, session
+from sqlalchemy import delete, insert, select
+
+from app.cache import create_backend
+
+logger = logging.getLogger(__name__)
+
+# What a customer was quoted for an itinerary. Price is in cents.
+Quote = namedtuple("Quote", ["date", "flight_ids", "price"])
+
+
+class _QuoteStoreState:
+    def __init__(
+        self, backend: Optional[BaseCache], timeout: int, sweep_interval: int
+    ) -> None:
+        # None stores the quotes in the itinerary_quote table.
+        self.backend = backend
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+        self.next_sweep = time.monotonic() + sweep_interval
+        self.sweep_lock = threading.Lock()
+
+
+class QuoteStore:
+    """Keeps the itineraries customers were quoted until they check out.
+
+    Quotes are stored in the itinerary_quote table by default so every
+    process can see them. Redis and memcached can be used instead, the
+    memory backend only works with a single process since checkout can land
+    on a different worker than the search. Each quote has its own timeout
+    and expired rows are deleted every QUOTE_STORE_SWEEP_INTERVAL seconds.
+    The session only holds a random token naming the quotes that belong to
+    it so searching doesn't rewrite the session. Each quote is encoded as
+    the departure date, the flight ids and the price, everything else comes
+    from the flights.
+    """
+
+    SESSION_KEY = "quotes"
+
+    def __init__(self, app=None) -> None:
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        cache_type = app.config.get("QUOTE_STORE_TYPE", "database")
+        url = app.config.get("QUOTE_STORE_URL")
+        threshold = app.config.get("QUOTE_STORE_SIZE", 10000)
+        timeout = app.config.get("QUOTE_STORE_TIMEOUT", 1800)
+        sweep_interval = app.config.get("QUOTE_STORE_SWEEP_INTERVAL", 300)
+        backend = None
+        if cache_type != "database":
+            backend = create_backend(cache_type, url, threshold, timeout)
+        app.extensions["quote_store"] = _QuoteStoreState(backend, timeout, sweep_interval)
+
+    @property
+    def _state(self) -> _QuoteStoreState:
+        return current_app.extensions["quote_store"]
+
+    @staticmethod
+    def _key(owner: str, quote_id: str) -> str:
+        return f"quote:{owner}:{quote_id}"
+
+    @staticmethod
+    def encode(itinerary) -> str:
+        ids = ",".join(str(flight.flight.id) for flight in itinerary.flights)
+        price = round(itinerary.cost * 100)
+        return f"{itinerary.departure_datetime.date().isoformat()}|{ids}|{price}"
+
+    @staticmethod
+    def decode(value: str) -> Quote:
+        date, ids, price = value.split("|")
+        return Quote(
+            dt.date.fromisoformat(date), [int(id) for id in ids.split(",")], int(price)
+        )
+
+    def add(self, itineraries: Iterable) -> None:
+        """Quote itineraries to the current session."""
+        owner = session.get(self.SESSION_KEY)
+        if owner is None:
+            # Only the first search in a session modifies it.
+            owner = session[self.SESSION_KEY] = uuid.uuid4().hex
+
+        state = self._state
+        quotes = {itinerary.id: self.encode(itinerary) for itinerary in itineraries}
+        if not quotes:
+            return
+
+        if state.backend is not None:
+            state.backend.set_many(
+                {self._key(owner, id): value for id, value in quotes.items()},
+                timeout=state.timeout,
+            )
+            return
+
+        from app import db
+        from app.models import ItineraryQuote
+
+        self._maybe_sweep(state)
+        expires = dt.datetime.utcnow() + dt.timedelta(seconds=state.timeout)
+        with db.engine.begin() as conn:
+            conn.execute(
+                insert(ItineraryQuote.__table__),
+                [
+                    {"id": id, "owner": owner, "value": value, "expires": expires}
+                    for id, value in quotes.items()
+                ],
+            )
+
+    def get(self, quote_id: str) -> Optional[Quote]:
+        """The quote if it was made to the current session and hasn't expired."""
+        owner = session.get(self.SESSION_KEY)
+        if owner is None:
+            return None
+
+        state = self._state
+        if state.backend is not None:
+            value = state.backend.get(self._key(owner, quote_id))
+        else:
+            from app import db
+            from app.models import ItineraryQuote
+
+            table = ItineraryQuote.__table__
+            with db.engine.connect() as conn:
+                value = conn.execute(
+                    select(table.c.value).where(
+                        table.c.id == quote_id,
+                        table.c.owner == owner,
+                        table.c.expires > dt.datetime.utcnow(),
+                    )
+                ).scalar()
+        return self.decode(value) if value is not None else None
+
+    def sweep(self) -> int:
+        """Delete expired quotes from the table. Returns how many were deleted."""
+        from app import db
+        from app.models import ItineraryQuote
+
+        table = ItineraryQuote.__table__
+        with db.engine.begin() as conn:
+            result = conn.execute(
+                delete(table).where(table.c.expires <= dt.datetime.utcnow())
+            )
+        return result.rowcount
+
+    def _maybe_sweep(self, state: _QuoteStoreState) -> None:
+        if not state.sweep_interval or time.monotonic() < state.next_sweep:
+            return
+        # Only one request sweeps, everyone else carries on.
+        if not state.sweep_lock.acquire(blocking=False):
+            return
+        try:
+            state.next_sweep = time.monotonic() + state.sweep_interval
+            deleted = self.sweep()
+            if deleted:
+                logger.info("Deleted %s expired quotes", deleted)
+        except Exception as e:
+            logger.error("Unable to delete expired quotes", exc_info=e)
+        finally:
+            state.sweep_lock.release()
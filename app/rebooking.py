@@ -0,0 +1,178 @@
+import datetime as dt
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import contains_eager
+
+from app.graph import Availability, SearchPath, route_graph
+from app.models import (
+    Flight,
+    FlightCancellation,
+    PurchasedTicket,
+    PurchaseTransaction,
+    TripItinerary,
+)
+from app.urls import url_for_id
+
+
+class RebookingProposal:
+    """A new itinerary for the passengers of one purchase on a cancelled flight.
+    itinerary is None if no seats could be found for them.
+    """
+
+    __slots__ = ("transaction", "tickets", "path", "itinerary")
+
+    def __init__(
+        self, transaction: PurchaseTransaction, tickets: List[PurchasedTicket]
+    ) -> None:
+        self.transaction = transaction
+        self.tickets = tickets
+        self.path: Optional[SearchPath] = None
+        self.itinerary: Optional[TripItinerary] = None
+
+    def to_dict(self, expand: bool = False) -> Dict[str, Any]:
+        return {
+            "purchase": url_for_id(PurchaseTransaction.__endpoint__, self.transaction.id),
+            "confirmation_number": self.transaction.confirmation_number,
+            "email": self.transaction.email,
+            "passengers": [
+                f"{ticket.first_name} {ticket.last_name}" for ticket in self.tickets
+            ],
+            "itinerary": self.itinerary.to_dict(expand=expand)
+            if self.itinerary is not None
+            else None,
+        }
+
+
+class RebookingPlanner:
+    """Finds new itineraries for every passenger on a cancelled flight.
+
+    Passengers are rebooked from the cancelled flight's departure airport to
+    their final destination, keeping everyone on the same purchase together.
+    Every search shares the route graph and a single availability snapshot
+    and results are reused for purchases going to the same place. Seats are
+    allocated greedily in the order the purchases were made and reserved in
+    the snapshot so no flight is ever overbooked. Nothing is written to the
+    database, the proposals still need to be booked.
+    """
+
+    # Each day searched is another search per destination so the api caps it.
+    MAX_DAYS = 7
+
+    def __init__(
+        self,
+        flight: Flight,
+        date: dt.date,
+        max_days: int = 2,
+        max_layovers: int = 2,
+        limit: int = 10,
+    ) -> None:
+        self.flight = flight
+        self.date = date
+        # How many days after the cancelled flight passengers can be moved to
+        self.max_days = max_days
+        self.max_layovers = max_layovers
+        self.limit = limit
+        self.max_trip_time = dt.timedelta(days=1)
+        self.searches = 0
+        self._paths: Dict[Tuple[int, int], List[SearchPath]] = {}
+        self._availability: Optional[Availability] = None
+
+    def _affected(self) -> "OrderedDict[PurchaseTransaction, List[PurchasedTicket]]":
+        """The tickets refunded by the cancellation, or that would be if the
+        flight hasn't been cancelled yet. Passengers who asked for a refund
+        themselves don't need to be rebooked.
+        """
+        cancellation = FlightCancellation.query.filter_by(
+            flight_id=self.flight.id, date=self.date
+        ).first()
+        refund_timestamp = cancellation.timestamp if cancellation is not None else None
+        tickets = (
+            PurchasedTicket.query.join(PurchasedTicket.transaction)
+            .options(contains_eager(PurchasedTicket.transaction))
+            .filter(PurchasedTicket.flight_id == self.flight.id)
+            .filter(PurchaseTransaction.departure_date == self.date)
+            .filter(PurchasedTicket.refund_timestamp == refund_timestamp)
+            .order_by(
+                PurchaseTransaction.purchase_timestamp,
+                PurchaseTransaction.id,
+                PurchasedTicket.id,
+            )
+            .all()
+        )
+        groups = OrderedDict()
+        for ticket in tickets:
+            groups.setdefault(ticket.transaction, []).append(ticket)
+        return groups
+
+    def _search(self, destination: int, day: int, passengers: int) -> List[SearchPath]:
+        self.searches += 1
+        paths = route_graph.search(
+            departing_airport=self.flight.departure_id,
+            final_airport=destination,
+            departure_dt=dt.datetime.combine(self.date + dt.timedelta(days=day), dt.time()),
+            num_of_passengers=passengers,
+            max_layovers=self.max_layovers,
+            limit=self.limit,
+            max_trip_time=self.max_trip_time,
+            availability=self._availability,
+        )
+        if day == 0:
+            # Passengers can't make flights that left before the cancelled one.
+            earliest = self.flight.departure_time.hour * 60 + self.flight.departure_time.minute
+            paths = [path for path in paths if path.edges[0].departure_minute >= earliest]
+        return paths
+
+    def _fits(self, path: SearchPath, passengers: int) -> bool:
+        # Checkout sells every leg on the trip's departure date so do the same here.
+        return all(
+            self._availability.seats(edge, path.date) >= passengers
+            for edge in path.edges
+        )
+
+    def _allocate(self, destination: int, passengers: int) -> Optional[SearchPath]:
+        for day in range(self.max_days + 1):
+            key = (destination, day)
+            paths = self._paths.get(key)
+            if paths is None:
+                paths = self._paths[key] = self._search(destination, day, 1)
+
+            path = next((p for p in paths if self._fits(p, passengers)), None)
+            if path is None and paths:
+                # The results we have are full, search again with what's left.
+                # Keep the old results since smaller groups may still fit.
+                found = self._search(destination, day, passengers)
+                seen = {tuple(p.flight_ids) for p in found}
+                paths = found + [p for p in paths if tuple(p.flight_ids) not in seen]
+                self._paths[key] = paths
+                path = next((p for p in found if self._fits(p, passengers)), None)
+
+            if path is not None:
+                for edge in path.edges:
+                    self._availability.reserve(edge, path.date, passengers)
+                return path
+        return None
+
+    def plan(self) -> List[RebookingProposal]:
+        self._availability = Availability.load(
+            self.date,
+            self.date + dt.timedelta(days=self.max_days + self.max_trip_time.days + 1),
+        )
+        # The cancelled flight can't be used even if it hasn't been cancelled yet.
+        self._availability.close(self.flight.id, self.date)
+
+        proposals = []
+        for transaction, tickets in self._affected().items():
+            proposal = RebookingProposal(transaction, tickets)
+            if transaction.destination_id != self.flight.departure_id:
+                proposal.path = self._allocate(transaction.destination_id, len(tickets))
+            proposals.append(proposal)
+
+        # Load all of the flights for the new itineraries at once.
+        booked = [proposal for proposal in proposals if proposal.path is not None]
+        itineraries = TripItinerary.from_paths(
+            [proposal.path for proposal in booked], keep_missing=True
+        )
+        for proposal, itinerary in zip(booked, itineraries):
+            proposal.itinerary = itinerary
+        return proposals
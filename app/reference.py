@@ -0,0 +1,152 @@
+import threading
+import time
+from typing import Dict, List, Optional, Type
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+
+class _ReferenceState:
+    def __init__(self, timeout: int) -> None:
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # When the tables have to be loaded again. 0 means they aren't loaded.
+        self.expires = 0.0
+        self.loads = 0
+        self.by_id: Dict[Type, Dict[int, object]] = {}
+        self.airport_codes: Dict[str, object] = {}
+        self.registrations: Dict[str, object] = {}
+
+
+class ReferenceCache:
+    """Process local copy of the airport and airplane tables.
+
+    Both tables are loaded in bulk the first time anything is looked up and
+    the cached rows are attached to the current session with
+    merge(load=False) so lookups never query the database. Committing any
+    change to an airport or airplane reloads the tables on the next lookup.
+    Other processes don't know about the change so they reload every
+    REFERENCE_CACHE_TIMEOUT seconds and check the database before
+    reporting something doesn't exist.
+    """
+
+    def __init__(self, app=None) -> None:
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        timeout = app.config.get("REFERENCE_CACHE_TIMEOUT", 300)
+        app.extensions["reference_cache"] = _ReferenceState(timeout)
+
+    @property
+    def _state(self) -> _ReferenceState:
+        state = current_app.extensions["reference_cache"]
+        if state.expires <= time.monotonic():
+            with state.lock:
+                if state.expires <= time.monotonic():
+                    self._load(state)
+        return state
+
+    @staticmethod
+    def _rows(model: Type) -> List:
+        """Every row of model's table as detached instances."""
+        from app import db
+
+        columns = [(prop.key, prop.columns[0]) for prop in inspect(model).column_attrs]
+        items = []
+        # A plain select so nothing is added to the request's session.
+        for row in db.session.execute(model.__table__.select()):
+            item = model(**{key: row._mapping[column] for key, column in columns})
+            make_transient_to_detached(item)
+            items.append(item)
+        return items
+
+    def _load(self, state: _ReferenceState) -> None:
+        from app.models import Airplane, Airport
+
+        airports = self._rows(Airport)
+        airplanes = self._rows(Airplane)
+        state.by_id = {
+            Airport: {airport.id: airport for airport in airports},
+            Airplane: {airplane.id: airplane for airplane in airplanes},
+        }
+        state.airport_codes = {
+            airport.code.upper(): airport for airport in airports if airport.code
+        }
+        state.registrations = {
+            airplane.registration_number.upper(): airplane
+            for airplane in airplanes
+            if airplane.registration_number
+        }
+        state.loads += 1
+        state.expires = time.monotonic() + state.timeout
+
+    @staticmethod
+    def _attach(item):
+        if item is None:
+            return None
+        from app import db
+
+        # Don't overwrite a copy the session already has, it may have changes.
+        existing = db.session.identity_map.get(identity_key(type(item), item.id))
+        if existing is not None:
+            return existing
+        return db.session.merge(item, load=False)
+
+    def caches(self, model: Type) -> bool:
+        from app.models import Airplane, Airport
+
+        return model in (Airport, Airplane)
+
+    def _missing(self, item):
+        # Added by another process since the tables were loaded.
+        if item is not None:
+            self.invalidate()
+        return item
+
+    def get(self, model: Type, id: int):
+        """The airport or airplane with this id."""
+        item = self._state.by_id[model].get(id)
+        if item is None:
+            return self._missing(model.query.get(id))
+        return self._attach(item)
+
+    def airport_by_code(self, code: str) -> Optional["Airport"]:
+        from app.models import Airport
+
+        if not code:
+            return None
+        item = self._state.airport_codes.get(str(code).upper())
+        if item is None:
+            return self._missing(Airport.query.filter_by(code=code).first())
+        return self._attach(item)
+
+    def airplane_by_registration(self, registration_number: str) -> Optional["Airplane"]:
+        from app.models import Airplane
+
+        if not registration_number:
+            return None
+        item = self._state.registrations.get(str(registration_number).upper())
+        if item is None:
+            return self._missing(
+                Airplane.query.filter_by(registration_number=registration_number).first()
+            )
+        return self._attach(item)
+
+    def changed(self, session: Optional[Session]) -> None:
+        """Reload the tables once session commits."""
+        if session is not None:
+            session.info["reference_changed"] = True
+
+    def invalidate(self) -> None:
+        current_app.extensions["reference_cache"].expires = 0.0
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session: Session) -> None:
+    if not session.info.pop("reference_changed", False):
+        return
+    if has_app_context() and "reference_cache" in current_app.extensions:
+        current_app.extensions["reference_cache"].expires = 0.0
@@ -0,0 +1,236 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Optional, Tuple
+
+from cachelib import BaseCache, NullCache
+from flask_session.sessions import SqlAlchemySession, SqlAlchemySessionInterface
+from itsdangerous import BadSignature, want_bytes
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+
+from app.cache import MemoryCache
+
+logger = logging.getLogger(__name__)
+
+# Models can only be declared once for each table.
+_models = {}
+
+
+def _session_model(db, table: str):
+    model = _models.get((db, table))
+    if model is not None:
+        return model
+
+    if table in db.metadata.tables:
+        # Already declared by flask_session's interface.
+        attrs = {"__table__": db.metadata.tables[table]}
+    else:
+        attrs = {
+            "__tablename__": table,
+            "__table_args__": (db.Index(f"ix_{table}_expiry", "expiry"),),
+            "id": db.Column(db.Integer, primary_key=True),
+            "session_id": db.Column(db.String(255), unique=True),
+            "data": db.Column(db.LargeBinary),
+            "expiry": db.Column(db.DateTime),
+        }
+    model = _models[(db, table)] = type("StoredSession", (db.Model,), attrs)
+    return model
+
+
+class CachedSqlAlchemySession(SqlAlchemySession):
+    def __init__(self, initial=None, sid=None, permanent=None, expiry=None):
+        super().__init__(initial, sid, permanent)
+        # When the stored copy expires. None if it hasn't been stored.
+        self.expiry: Optional[datetime] = expiry
+
+
+class CachedSqlAlchemySessionInterface(SqlAlchemySessionInterface):
+    """Stores sessions in the same table as flask_session's sqlalchemy
+    interface but only writes them when they change.
+
+    Setting SESSION_CACHE_SIZE keeps recently used sessions in an
+    in-process LRU cache so most requests don't read the table either. The
+    cache isn't shared between processes so another process can keep using
+    a session for up to SESSION_CACHE_TIMEOUT seconds after it was changed
+    or logged out. It's off by default and should only be turned on with a
+    single process or sticky sessions.
+
+    Unmodified sessions are only rewritten to extend their expiry once it
+    has fallen SESSION_REFRESH_INTERVAL seconds behind. Expired sessions
+    are deleted in batches every SESSION_SWEEP_INTERVAL seconds.
+    """
+
+    session_class = CachedSqlAlchemySession
+
+    def __init__(
+        self, app, db, table="sessions", key_prefix="session:", use_signer=False, permanent=True
+    ):
+        self.db = db
+        self.key_prefix = key_prefix
+        self.use_signer = use_signer
+        self.permanent = permanent
+        self.has_same_site_capability = hasattr(self, "get_cookie_samesite")
+        self.sql_session_model = _session_model(db, table)
+
+        config = app.config
+        cache_size = config.get("SESSION_CACHE_SIZE", 0)
+        cache_timeout = config.get("SESSION_CACHE_TIMEOUT", 30)
+        if cache_size:
+            self.cache: BaseCache = MemoryCache(cache_size, cache_timeout)
+        else:
+            self.cache = NullCache()
+        self.refresh_interval = config.get("SESSION_REFRESH_INTERVAL", 3600)
+        self.sweep_interval = config.get("SESSION_SWEEP_INTERVAL", 300)
+        self.sweep_batch_size = config.get("SESSION_SWEEP_BATCH_SIZE", 1000)
+        self._next_sweep = time.monotonic() + self.sweep_interval
+        self._sweep_lock = threading.Lock()
+
+    def _new_session(self, sid: str = None) -> CachedSqlAlchemySession:
+        return self.session_class(sid=sid or self._generate_sid(), permanent=self.permanent)
+
+    def _load(self, store_id: str) -> Optional[Tuple[bytes, datetime]]:
+        entry = self.cache.get(store_id)
+        if entry is None:
+            model = self.sql_session_model
+            row = (
+                self.db.session.query(model.data, model.expiry)
+                .filter(model.session_id == store_id)
+                .first()
+            )
+            if row is None or row.expiry is None:
+                return None
+            entry = (row.data, row.expiry)
+            self.cache.set(store_id, entry)
+        return entry
+
+    def open_session(self, app, request):
+        self._maybe_sweep()
+
+        sid = request.cookies.get(app.session_cookie_name)
+        if not sid:
+            return self._new_session()
+        if self.use_signer:
+            signer = self._get_signer(app)
+            if signer is None:
+                return None
+            try:
+                sid = signer.unsign(sid).decode()
+            except BadSignature:
+                return self._new_session()
+
+        entry = self._load(self.key_prefix + sid)
+        if entry is None:
+            return self._new_session(sid)
+        data, expiry = entry
+        # Expired rows are left for the sweep.
+        if expiry <= datetime.utcnow():
+            return self._new_session(sid)
+        try:
+            return self.session_class(
+                self.serializer.loads(want_bytes(data)), sid=sid, expiry=expiry
+            )
+        except Exception:
+            return self._new_session(sid)
+
+    def _store(self, store_id: str, data: bytes, expiry: datetime) -> None:
+        model = self.sql_session_model
+        values = {"data": data, "expiry": expiry}
+        query = model.query.filter(model.session_id == store_id)
+        if not query.update(values, synchronize_session=False):
+            try:
+                with self.db.session.begin_nested():
+                    self.db.session.add(model(session_id=store_id, **values))
+            except IntegrityError:
+                # Someone else created it first
+                query.update(values, synchronize_session=False)
+        self.db.session.commit()
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        store_id = self.key_prefix + session.sid
+        # Permanent sessions always have _permanent set so it doesn't count.
+        if not any(key != "_permanent" for key in session):
+            if session.modified and session.expiry is not None:
+                model = self.sql_session_model
+                model.query.filter(model.session_id == store_id).delete()
+                self.db.session.commit()
+                self.cache.delete(store_id)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        expires = self.get_expiration_time(app, session)
+        if expires is None:
+            # Browser sessions still need to expire from the table eventually.
+            expires = datetime.utcnow() + app.permanent_session_lifetime
+
+        stale = (
+            session.expiry is None
+            or (expires - session.expiry).total_seconds() >= self.refresh_interval
+        )
+        if not session.modified and not stale:
+            # The cookie already has the stored expiry.
+            return
+
+        data = self.serializer.dumps(dict(session))
+        self._store(store_id, data, expires)
+        self.cache.set(store_id, (data, expires))
+        session.expiry = expires
+
+        conditional_cookie_kwargs = {}
+        if self.has_same_site_capability:
+            conditional_cookie_kwargs["samesite"] = self.get_cookie_samesite(app)
+        if self.use_signer:
+            session_id = self._get_signer(app).sign(want_bytes(session.sid))
+        else:
+            session_id = session.sid
+        response.set_cookie(
+            app.session_cookie_name,
+            session_id,
+            expires=expires,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            **conditional_cookie_kwargs,
+        )
+
+    def sweep(self) -> int:
+        """Delete expired sessions. Returns how many were deleted."""
+        table = self.sql_session_model.__table__
+        now = datetime.utcnow()
+        total = 0
+        while True:
+            # Separate transactions so each batch only holds its locks briefly.
+            with self.db.engine.begin() as conn:
+                ids = [
+                    id
+                    for id, in conn.execute(
+                        select(table.c.id)
+                        .where(table.c.expiry <= now)
+                        .limit(self.sweep_batch_size)
+                    )
+                ]
+                if ids:
+                    conn.execute(delete(table).where(table.c.id.in_(ids)))
+            total += len(ids)
+            if len(ids) < self.sweep_batch_size:
+                return total
+
+    def _maybe_sweep(self) -> None:
+        if not self.sweep_interval or time.monotonic() < self._next_sweep:
+            return
+        # Only one request sweeps, everyone else carries on.
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sweep = time.monotonic() + self.sweep_interval
+            deleted = self.sweep()
+            if deleted:
+                logger.info("Deleted %s expired sessions", deleted)
+        except Exception as e:
+            logger.error("Unable to delete expired sessions", exc_info=e)
+        finally:
+            self._sweep_lock.release()
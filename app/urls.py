@@ -0,0 +1,32 @@
+from typing import Any, Dict, Tuple
+
+from flask import current_app, has_request_context, request, url_for
+
+# Any number works as long as it won't show up anywhere else in a url.
+# It has to be a number so it matches both <id> and <int:id> rules.
+_SENTINEL = 918273645546372819
+
+
+def url_for_id(endpoint: str, id: Any) -> str:
+    """Same as url_for(endpoint, id=id) without building the url every time.
+
+    The url is built once for each endpoint with a placeholder id and
+    the real id is formatted into it after that. Only integer ids use the
+    template since anything else may need to be escaped.
+    """
+    # Outside of a request urls are external so just use url_for.
+    if type(id) is not int or not has_request_context():
+        return url_for(endpoint, id=id)
+
+    templates: Dict[Tuple[str, str], Tuple[str, str]] = current_app.extensions.setdefault(
+        "url_templates", {}
+    )
+    # Apps mounted under a prefix need their own templates.
+    key = (endpoint, request.root_path)
+    template = templates.get(key)
+    if template is None:
+        url = url_for(endpoint, id=_SENTINEL)
+        template = templates[key] = tuple(url.split(str(_SENTINEL), 1))
+
+    prefix, suffix = template
+    return f"{prefix}{id}{suffix}"
@@ -1,6 +1,7 @@
 from wtforms.validators import ValidationError
 
-from app.models import Airplane, Airport, Flight, User
+from app import reference_cache
+from app.models import Flight, User
 
 
 class ModelValidator:
@@ -32,7 +33,7 @@ class UserValidator(ModelValidator):
 
 class AirplaneValidator(ModelValidator):
     def __call__(self, form, field):
-        airplane = Airplane.query.filter_by(registration_number=field.data).first()
+        airplane = reference_cache.airplane_by_registration(field.data)
         if not airplane:
             message = self.message or "No plane with that registration number exists"
             raise ValidationError(message)
@@ -43,7 +44,7 @@ class AirplaneValidator(ModelValidator):
 
 class AirportValidator(ModelValidator):
     def __call__(self, form, field):
-        airport = Airport.query.filter_by(code=field.data).first()
+        airport = reference_cache.airport_by_code(field.data)
         if not airport:
             message = self.message or "No airport with that code exists"
             raise ValidationError(message)
@@ -0,0 +1,349 @@
+"""Time the busiest endpoints and models against a generated database.
+
+A SQLite database is seeded with init_db's generators and each case is
+timed on a fresh copy of it. The p50 and p95 times and the number of SQL
+queries are reported for every case. Run from the root of the repository
+with python -m benchmarks.endpoints
+
+Pass --save to write the results as a baseline and --baseline to compare
+against one. Comparing exits with 1 if a case got slower than the
+threshold allows or runs more queries.
+"""
+import datetime as dt
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+from flask import url_for
+from flask_login import FlaskLoginClient
+from sqlalchemy import event
+
+import init_db
+from app import create_app, db, search_cache
+from app.models import Admin, Agent, Airport, Flight, FlightInstance, PurchaseTransaction
+from benchmarks.json_encoding import BenchmarkConfig
+
+# Changing these changes the database so they're saved with the baseline.
+SETTINGS = ("seed", "planes", "transactions", "number")
+
+
+class Result(NamedTuple):
+    name: str
+    p50: float
+    p95: float
+    queries: int
+
+    def to_dict(self) -> Dict:
+        return {"p50": self.p50, "p95": self.p95, "queries": self.queries}
+
+
+def _config(database: str, index: str):
+    class Config(BenchmarkConfig):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{database}"
+        MSEARCH_ENABLE = True
+        MSEARCH_BACKEND = "whoosh"
+        MSEARCH_INDEX_NAME = index
+        # Leave the emails in the outbox.
+        EMAIL_OUTBOX_WORKERS = 0
+
+    return Config
+
+
+def seed(database: str, settings: Dict) -> None:
+    """Create the database with init_db's generators."""
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(_config(database, os.path.join(directory, "msearch")))
+        with app.app_context():
+            db.create_all()
+            random.seed(settings["seed"])
+            init_db.populate_airports(us_only=True)
+            db.session.commit()
+            init_db.create_airplanes(count=settings["planes"])
+            db.session.commit()
+            init_db.create_flights()
+            db.session.commit()
+            init_db.create_workload(
+                transactions=settings["transactions"], seed=settings["seed"]
+            )
+            admin = Admin(email="admin@benchmark.example.com", first_name="Admin")
+            admin.set_password("benchmark")
+            db.session.add(admin)
+            db.session.commit()
+
+
+class EndpointBenchmark:
+    """Runs the cases against a copy of a seeded database.
+
+    Each case returns a function that prepares an iteration and returns
+    what should be timed so setup like clearing the search cache and
+    finding a quote isn't counted.
+    """
+
+    def __init__(self, app, number: int) -> None:
+        self.app = app
+        self.number = number
+        self.queries = 0
+        admin = Admin.query.filter_by(email="admin@benchmark.example.com").one()
+        self.admin = self.app.test_client(user=admin)
+        self.customer = self.app.test_client()
+
+        home_airports = db.session.query(Airport.id).filter(
+            Airport.code.in_(init_db.HOME_AIRPORT_CODES)
+        )
+        self.flight = (
+            Flight.query.filter(Flight.departure_id.in_(home_airports))
+            .filter(Flight.arrival_id.in_(home_airports))
+            .order_by(Flight.id)
+            .first()
+        )
+        self.date = dt.date.today() + dt.timedelta(days=1)
+
+    def _count(self, *args) -> None:
+        self.queries += 1
+
+    def _search_url(self, max_layovers: int) -> str:
+        return url_for(
+            "api.flightsearch",
+            departure_code=self.flight.departure_airport.code,
+            arrival_code=self.flight.arrival_airport.code,
+            departure_datetime=self.date.isoformat(),
+            max_layovers=max_layovers,
+        )
+
+    def _get(self, client, url: str) -> Callable[[], None]:
+        def request() -> None:
+            response = client.get(url)
+            assert response.status_code == 200, response.data
+
+        return request
+
+    def search(self, max_layovers: int):
+        url = self._search_url(max_layovers)
+
+        def prepare(i: int):
+            # Every search has to find its itineraries.
+            search_cache.clear()
+            return self._get(self.customer, url)
+
+        return prepare
+
+    def checkout(self):
+        url = self._search_url(0)
+        data = {
+            "email": "customer@benchmark.example.com",
+            "street_address": "1 Main St",
+            "city": "City",
+            "state": "VA",
+            "zip_code": "12345",
+            "card_number": "4111111111111111",
+            "card_expiration": "01/2099",
+            "card_cvc": "123",
+            "passengers-0-first_name": "Fake",
+            "passengers-0-last_name": "Person",
+            "passengers-0-date_of_birth": "2000-01-01",
+            "passengers-0-gender": "male",
+        }
+
+        def prepare(i: int):
+            items = self.customer.get(url).json["items"]
+            assert items, "No itineraries to buy"
+            quote = items[0]["id"]
+
+            def request() -> None:
+                response = self.customer.post(
+                    url_for("api.checkout"), json=dict(data, **{"itineraries-0": quote})
+                )
+                assert response.status_code == 200, response.data
+
+            return request
+
+        return prepare
+
+    def get(self, endpoint: str, **kwargs):
+        url = url_for(endpoint, **kwargs)
+        return lambda i: self._get(self.admin, url)
+
+    def cancel(self):
+        agent_id = db.session.query(Agent.id).order_by(Agent.id).limit(1).scalar()
+        # A different flight with passengers every time.
+        instances = (
+            db.session.query(FlightInstance.flight_id, FlightInstance.date)
+            .filter(FlightInstance.sold > 0, FlightInstance.cancelled == False)
+            .filter(FlightInstance.date >= dt.date.today())
+            .order_by(FlightInstance.flight_id, FlightInstance.date)
+            .limit(self.number + 1)
+            .all()
+        )
+
+        def prepare(i: int):
+            flight_id, date = instances[i]
+            flight = Flight.query.get(flight_id)
+            return lambda: flight.cancel(date, agent_id)
+
+        return prepare
+
+    def sales_by_date(self):
+        agent_id = (
+            db.session.query(PurchaseTransaction.assisted_by)
+            .filter(PurchaseTransaction.assisted_by != None)
+            .order_by(PurchaseTransaction.assisted_by)
+            .limit(1)
+            .scalar()
+        )
+        today = dt.date.today()
+
+        def prepare(i: int):
+            agent = Agent.query.get(agent_id)
+            return lambda: agent.sales_by_date(
+                today - dt.timedelta(days=365), today + dt.timedelta(days=180)
+            )
+
+        return prepare
+
+    def cases(self) -> Dict[str, Callable]:
+        # Cancelling changes the most so it goes last.
+        return {
+            "search max_layovers=0": self.search(0),
+            "search max_layovers=1": self.search(1),
+            "search max_layovers=2": self.search(2),
+            "checkout": self.checkout(),
+            "flights expand": self.get("api.flights", expand=True, per_page=100),
+            "purchases": self.get("api.purchases", per_page=100),
+            "sales_by_date": self.sales_by_date(),
+            "cancel": self.cancel(),
+        }
+
+    def time(self, name: str, prepare: Callable) -> Result:
+        times = []
+        queries = []
+        # The first run warms up the caches and isn't counted.
+        for i in range(self.number + 1):
+            timed = prepare(i)
+            self.queries = 0
+            event.listen(db.engine, "before_cursor_execute", self._count)
+            try:
+                start = time.perf_counter()
+                timed()
+                elapsed = time.perf_counter() - start
+            finally:
+                event.remove(db.engine, "before_cursor_execute", self._count)
+            if i:
+                times.append(elapsed * 1000)
+                queries.append(self.queries)
+        return Result(
+            name,
+            float(np.percentile(times, 50)),
+            float(np.percentile(times, 95)),
+            int(np.median(queries)),
+        )
+
+    def run(self) -> List[Result]:
+        results = []
+        for name, prepare in self.cases().items():
+            result = self.time(name, prepare)
+            print(
+                f"{name:>22}: p50 {result.p50:8.2f} ms  p95 {result.p95:8.2f} ms  "
+                f"{result.queries:4} queries"
+            )
+            results.append(result)
+        return results
+
+
+def run(settings: Dict, database: Optional[str] = None) -> List[Result]:
+    """Seed the database if it doesn't exist and time every case on a copy of it."""
+    with tempfile.TemporaryDirectory() as directory:
+        if database is None:
+            database = os.path.join(directory, "seed.db")
+        if not os.path.exists(database):
+            seed(database, settings)
+
+        copy = os.path.join(directory, "benchmark.db")
+        shutil.copyfile(database, copy)
+        app = create_app(_config(copy, os.path.join(directory, "msearch")))
+        app.test_client_class = FlaskLoginClient
+        with app.test_request_context():
+            return EndpointBenchmark(app, settings["number"]).run()
+
+
+def compare(results: List[Result], baseline: Dict, threshold: float) -> List[str]:
+    """The regressions from baseline. Times are compared at p50."""
+    regressions = []
+    for result in results:
+        previous = baseline["results"].get(result.name)
+        if previous is None:
+            continue
+        if result.p50 > previous["p50"] * (1 + threshold):
+            regressions.append(
+                f"{result.name}: p50 {result.p50:.2f} ms was {previous['p50']:.2f} ms"
+            )
+        if result.queries > previous["queries"]:
+            regressions.append(
+                f"{result.name}: {result.queries} queries was {previous['queries']}"
+            )
+    return regressions
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=30, help="Runs of each case")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated data")
+    parser.add_argument("--planes", type=int, default=200, help="Airplanes to generate")
+    parser.add_argument(
+        "--transactions", type=int, default=50_000, help="Purchases to generate"
+    )
+    parser.add_argument(
+        "--database", help="Seeded database to reuse. Created if it doesn't exist."
+    )
+    parser.add_argument("--save", metavar="BASELINE", help="Save the results to a file")
+    parser.add_argument(
+        "--baseline",
+        help="Compare the results to a saved baseline using its settings",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="How much slower than the baseline a case can be. 0.25 is 25%%.",
+    )
+    args = parser.parse_args()
+
+    settings = {name: getattr(args, name) for name in SETTINGS}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        settings = baseline["settings"]
+
+    results = run(settings, args.database)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "settings": settings,
+                    "results": {result.name: result.to_dict() for result in results},
+                },
+                f,
+                indent=2,
+            )
+        print(f"Saved the baseline to {args.save}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Regressed from the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions from the baseline")
+
+
+if __name__ == "__main__":
+    main()
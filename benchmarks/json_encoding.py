@@ -0,0 +1,105 @@
+"""Compare the JSON encoders on /api/flights?expand=true&per_page=100.
+
+Run from the root of the repository with python -m benchmarks.json_encoding
+"""
+import datetime as dt
+import json
+import random
+import timeit
+from argparse import ArgumentParser
+
+from flask import url_for
+
+from app import create_app, db
+from app.api.representations import ENCODERS
+from app.models import Airplane, Airport, Flight
+
+
+class BenchmarkConfig:
+    SECRET_KEY = "benchmark"
+    SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    WTF_CSRF_ENABLED = False
+    TESTING = True
+    MSEARCH_ENABLE = False
+    USE_SESSION = False
+
+
+def populate(flights: int) -> None:
+    with open("data/airports.json") as f:
+        data = [a for a in json.load(f) if a["tz"] and a["name"]][:50]
+
+    airports = [
+        Airport(
+            code=a["code"],
+            name=a["name"],
+            timezone=a["tz"],
+            latitude=a["lat"],
+            longitude=a["lon"],
+            city=a["city"],
+            state=a["state"],
+        )
+        for a in data
+    ]
+    airplanes = [
+        Airplane(
+            registration_number=f"N{i}RE",
+            model_name="Boeing 737",
+            model_code="B737-800",
+            capacity=189,
+            range=1995,
+        )
+        for i in range(20)
+    ]
+    db.session.add_all(airports + airplanes)
+    db.session.commit()
+
+    today = dt.date.today()
+    for i in range(flights):
+        departure, arrival = random.sample(airports, 2)
+        db.session.add(
+            Flight(
+                number=str(i),
+                airplane_id=random.choice(airplanes).id,
+                departure_id=departure.id,
+                arrival_id=arrival.id,
+                departure_time=dt.time(hour=random.randint(0, 23), minute=30),
+                start=today,
+                end=today + dt.timedelta(days=180),
+            )
+        )
+    db.session.commit()
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=50, help="Requests per encoder")
+    args = parser.parse_args()
+
+    random.seed(0)
+    app = create_app(BenchmarkConfig)
+    with app.test_request_context():
+        db.create_all()
+        populate(flights=100)
+        url = url_for("api.flights", expand=True, per_page=100)
+
+        client = app.test_client()
+        bodies = {}
+        for name in ENCODERS:
+            app.config["API_JSON_ENCODER"] = name
+            bodies[name] = client.get(url).get_json()
+            seconds = timeit.timeit(lambda: client.get(url), number=args.number)
+            print(f"{name:>8}: {seconds / args.number * 1000:.2f} ms per request")
+
+        # Only the encoding itself
+        data = bodies["json"]
+        for name, dumps in ENCODERS.items():
+            app.config["API_JSON_ENCODER"] = name
+            seconds = timeit.timeit(lambda: dumps(data), number=args.number * 10)
+            print(f"{name:>8}: {seconds / (args.number * 10) * 1000:.3f} ms to encode")
+
+        assert all(body == bodies["json"] for body in bodies.values()), "Encoders differ"
+
+
+if __name__ == "__main__":
+    main()
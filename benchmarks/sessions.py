@@ -0,0 +1,87 @@
+"""Compare the session interfaces on /api/flights/search.
+
+Every client searches repeatedly with the same session like a customer
+comparing dates would. Run from the root of the repository with
+python -m benchmarks.sessions
+"""
+import datetime as dt
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from flask import url_for
+
+from app import create_app, db
+from app.models import Flight
+from benchmarks.json_encoding import BenchmarkConfig, populate
+
+INTERFACES = ("sqlalchemy", "cached_sqlalchemy")
+
+
+def run(interface: str, database: str, clients: int, number: int) -> float:
+    """Returns the requests per second."""
+
+    class Config(BenchmarkConfig):
+        # Shared with the process that populated it so it can't be in memory.
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{database}"
+        USE_SESSION = True
+        SESSION_TYPE = interface
+
+    app = create_app(Config)
+    with app.test_request_context():
+        # Creates the sessions table the first time
+        db.create_all()
+        flight = Flight.query.first()
+        url = url_for(
+            "api.flightsearch",
+            departure_code=flight.departure_airport.code,
+            arrival_code=flight.arrival_airport.code,
+            departure_datetime=(dt.date.today() + dt.timedelta(days=1)).isoformat(),
+        )
+
+    test_clients = [app.test_client() for _ in range(clients)]
+    # Warm up the route graph and search cache
+    for client in test_clients:
+        client.get(url)
+
+    start = time.perf_counter()
+    for _ in range(number):
+        for client in test_clients:
+            response = client.get(url)
+            assert response.status_code == 200, response.data
+    return clients * number / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("-c", "--clients", type=int, default=10, help="Sessions")
+    parser.add_argument("-n", "--number", type=int, default=20, help="Requests per session")
+    args = parser.parse_args()
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "benchmark.db")
+        app = create_app(
+            type(
+                "Config",
+                (BenchmarkConfig,),
+                {"SQLALCHEMY_DATABASE_URI": f"sqlite:///{database}"},
+            )
+        )
+        with app.app_context():
+            db.create_all()
+            populate(flights=500)
+
+        # The session table can only be declared once per process.
+        context = multiprocessing.get_context("spawn")
+        for interface in INTERFACES:
+            with context.Pool(1) as pool:
+                rate = pool.apply(run, (interface, database, args.clients, args.number))
+            print(f"{interface:>17}: {rate:.1f} requests per second")
+
+
+if __name__ == "__main__":
+    main()
@@ -26,5 +26,59 @@ class Config(object):
     REMEMBER_COOKIE_DOMAIN = None
     # Fix for MySQL connection timeout  
     SQLALCHEMY_POOL_RECYCLE = 280
-    SESSION_TYPE = 'sqlalchemy'
-    
\ No newline at end of file
+    # sqlalchemy or cached_sqlalchemy. See app.sessions.
+    SESSION_TYPE = os.environ.get('SESSION_TYPE', 'sqlalchemy')
+    # Per process cache of sessions. Only safe with one process or sticky
+    # sessions since logging out doesn't evict it in other processes.
+    SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE') or 0)
+    SESSION_CACHE_TIMEOUT = int(os.environ.get('SESSION_CACHE_TIMEOUT') or 30)
+    SESSION_REFRESH_INTERVAL = int(os.environ.get('SESSION_REFRESH_INTERVAL') or 3600)
+    SESSION_SWEEP_INTERVAL = int(os.environ.get('SESSION_SWEEP_INTERVAL') or 300)
+    SESSION_SWEEP_BATCH_SIZE = int(os.environ.get('SESSION_SWEEP_BATCH_SIZE') or 1000)
+    # Memory mapped airport distance matrix. Kept in memory if not set.
+    # Build it with init_db.py --create-distances before starting the workers.
+    DISTANCE_MATRIX_PATH = os.environ.get('DISTANCE_MATRIX_PATH')
+    # Itinerary search result cache. Can be memory, redis, memcached or null.
+    SEARCH_CACHE_TYPE = os.environ.get('SEARCH_CACHE_TYPE', 'memory')
+    SEARCH_CACHE_URL = os.environ.get('SEARCH_CACHE_URL')
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1024)
+    SEARCH_CACHE_TIMEOUT = int(os.environ.get('SEARCH_CACHE_TIMEOUT') or 300)
+    # Itineraries quoted to customers. Can be database, redis or memcached.
+    # memory only works with a single process since checkout can be handled
+    # by a different worker than the search.
+    QUOTE_STORE_TYPE = os.environ.get('QUOTE_STORE_TYPE', 'database')
+    QUOTE_STORE_URL = os.environ.get('QUOTE_STORE_URL')
+    QUOTE_STORE_SIZE = int(os.environ.get('QUOTE_STORE_SIZE') or 10000)
+    QUOTE_STORE_TIMEOUT = int(os.environ.get('QUOTE_STORE_TIMEOUT') or 1800)
+    # Seconds between deleting expired quotes from the database. 0 disables.
+    QUOTE_STORE_SWEEP_INTERVAL = int(os.environ.get('QUOTE_STORE_SWEEP_INTERVAL') or 300)
+    # Identity of logged in users cached by load_user. 0 disables the cache.
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 1024)
+    USER_CACHE_TIMEOUT = int(os.environ.get('USER_CACHE_TIMEOUT') or 60)
+    # Seconds before each process reloads its copy of the airports and airplanes.
+    REFERENCE_CACHE_TIMEOUT = int(os.environ.get('REFERENCE_CACHE_TIMEOUT') or 300)
+    # Seconds before each process rebuilds its route graph from the flights.
+    ROUTE_GRAPH_TIMEOUT = int(os.environ.get('ROUTE_GRAPH_TIMEOUT') or 60)
+    # JSON encoder for the api. Can be orjson or json, defaults to orjson if installed.
+    API_JSON_ENCODER = os.environ.get('API_JSON_ENCODER')
+    # Collections with more items than this are streamed.
+    API_JSON_STREAM_THRESHOLD = int(os.environ.get('API_JSON_STREAM_THRESHOLD') or 1000)
+    # Background email delivery. See app.outbox.
+    EMAIL_OUTBOX_WORKERS = int(os.environ.get('EMAIL_OUTBOX_WORKERS') or 2)
+    EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_BATCH_SIZE') or 50)
+    EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS') or 5)
+    EMAIL_OUTBOX_RETRY_DELAY = int(os.environ.get('EMAIL_OUTBOX_RETRY_DELAY') or 30)
+    # Per request SQL statement counts and times. See app.instrumentation.
+    SQL_INSTRUMENTATION = bool(strtobool(os.environ.get('SQL_INSTRUMENTATION', 'True')))
+    # Server-Timing headers with the database time. Only in debug mode if not set.
+    SQL_SERVER_TIMING = bool(strtobool(os.environ['SQL_SERVER_TIMING'])) \
+        if os.environ.get('SQL_SERVER_TIMING') else None
+    SQL_SLOWEST_STATEMENTS = int(os.environ.get('SQL_SLOWEST_STATEMENTS') or 3)
+    # Requests over these limits are logged. Time is in milliseconds, 0 disables.
+    SQL_LOG_QUERY_COUNT = int(os.environ.get('SQL_LOG_QUERY_COUNT') or 50)
+    SQL_LOG_QUERY_TIME = int(os.environ.get('SQL_LOG_QUERY_TIME') or 500)
+    SQL_LOG_REPEATED_STATEMENTS = int(os.environ.get('SQL_LOG_REPEATED_STATEMENTS') or 10)
+    # Flight dates cancelled in each transaction by bulk cancellations.
+    CANCELLATION_JOB_BATCH_SIZE = int(os.environ.get('CANCELLATION_JOB_BATCH_SIZE') or 20)
+    # Seconds without progress before a running job is assumed to have died.
+    CANCELLATION_JOB_TIMEOUT = int(os.environ.get('CANCELLATION_JOB_TIMEOUT') or 300)
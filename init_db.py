@@ -1,19 +1,38 @@
 import json
+import multiprocessing
+import os
 import random
+import re
 from argparse import ArgumentParser
 from datetime import date, datetime, time, timedelta, timezone
 from getpass import getpass
+from itertools import islice
+from time import perf_counter
 from traceback import print_exc
-from typing import List
-from zoneinfo import ZoneInfo
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, TextIO, Tuple
+from zoneinfo import ZoneInfo, available_timezones
 
 import flask_migrate
-from alive_progress import alive_it
+import numpy as np
+from alive_progress import alive_bar, alive_it
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 from config import Config
-from app import create_app, db, search
-from app.models import Admin, Airplane, Airport, Flight, PurchaseTransaction, PurchasedTicket
+from app import create_app, db, distance_matrix, search
+from app.helpers import calculate_taxes
+from app.models import (
+    Admin,
+    Agent,
+    AgentDailySales,
+    Airplane,
+    Airport,
+    Flight,
+    FlightCancellation,
+    FlightInstance,
+    PurchaseTransaction,
+    PurchasedTicket,
+)
 
 
 def create_db() -> None:
@@ -41,42 +60,128 @@ def create_user() -> None:
             print(f"User with that email already exists... Try again.")
 
 
-def populate_airports(us_only: bool = False) -> None:
-    print("Populating database with airports from data/airports.json.")
+_WHITESPACE = re.compile(r"[\s,]*")
 
-    with open("data/airports.json") as f:
-        data = f.read()
-        json_data = json.loads(data)
+
+def iter_json_array(file: TextIO, buffer_size: int = 64 * 1024) -> Iterator[Any]:
+    """Yield the objects in a JSON array one at a time
+    without reading the whole file into memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    eof = False
+    while not buffer and not eof:
+        chunk = file.read(buffer_size)
+        buffer = chunk.lstrip()
+        eof = not chunk
+    if not buffer.startswith("["):
+        raise ValueError("Expected a JSON array")
+    pos = 1
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        if buffer.startswith("]", pos):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+            # Items in an array are always followed by a separator. Without
+            # one a number at the end of the buffer could still have more digits.
+            complete = eof or buffer[end:end + 1] in (" ", "\t", "\r", "\n", ",", "]")
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            complete = False
+        if not complete:
+            # The object continues past the end of the buffer.
+            chunk = file.read(buffer_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+        pos = end
+
+
+def _airport_rows(airports: Iterable[Dict], us_only: bool) -> Iterator[Dict]:
+    """Convert the rows from data/airports.json to airport table rows
+    skipping anything the app can't use.
+    """
+    timezones = available_timezones()
+    codes = set()
+    for airport in airports:
+        if us_only and airport["country"] != "United States":
+            continue
+
+        # Some airports are missing timezones and names.
+        # This info is required so just ignore them.
+        if not airport["tz"] or not airport["name"]:
+            continue
+
+        code = airport["code"]
+        if not code or len(code) != 3 or code in codes:
+            continue
+        if airport["tz"] not in timezones:
+            continue
+        try:
+            latitude = float(airport["lat"])
+            longitude = float(airport["lon"])
+        except (TypeError, ValueError):
+            continue
+
+        codes.add(code)
+        yield {
+            "code": code,
+            "name": airport["name"],
+            "timezone": airport["tz"],
+            "latitude": latitude,
+            "longitude": longitude,
+            "city": airport["city"],
+            "state": airport["state"],
+        }
+
+
+def populate_airports(us_only: bool = False, chunk_size: int = 1000) -> None:
+    print("Populating database with airports from data/airports.json.")
 
     PurchasedTicket.query.delete()
     PurchaseTransaction.query.delete()
+    AgentDailySales.query.delete()
+    FlightInstance.query.delete()
     Flight.query.delete()
+    # Bulk deletes don't update the search index so remove them from it here.
+    index = search.index(Airport)
+    for id, in db.session.query(Airport.id):
+        index.delete(fieldname=index.pk, text=str(id))
     Airport.query.delete()
 
+    start = perf_counter()
     count = 0
-    total_airports = len(json_data)
-    for airport in alive_it(json_data):
-        if us_only and airport["country"] != 'United States':
-            continue
+    total_airports = 0
+    insert = Airport.__table__.insert()
+    with open("data/airports.json") as f:
+        airports = iter_json_array(f)
 
-        # Some airports are missing timezones and names.
-        # This info is required so just ignore them.
-        if not airport["tz"] or not airport["name"]:
-            continue
+        def counted():
+            nonlocal total_airports
+            for airport in airports:
+                total_airports += 1
+                yield airport
 
-        db.session.add(
-            Airport(
-                code=airport["code"],
-                name=airport["name"],
-                timezone=airport["tz"],
-                latitude=airport["lat"],
-                longitude=airport["lon"],
-                city=airport["city"],
-                state=airport["state"],
-            )
-        )
-        count += 1
-    print(f"Successfully added {count} airports out of {total_airports}")
+        rows = _airport_rows(alive_it(counted()), us_only)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            # A list of parameters is sent as a single executemany
+            db.session.execute(insert, chunk)
+            count += len(chunk)
+
+    # Index everything at once instead of on every commit.
+    search.create_index(Airport)
+    elapsed = perf_counter() - start
+    print(
+        f"Successfully added {count} airports out of {total_airports} "
+        f"in {elapsed:.2f}s ({count / elapsed:.0f} rows per second)"
+    )
 
 
 def create_airplanes(count: int = 500) -> None:
@@ -108,10 +213,13 @@ def create_airplanes(count: int = 500) -> None:
 
     # Since the flights rely on the planes
     # the flights have to be deleted.
+    FlightInstance.query.delete()
     Flight.query.delete()
     Airplane.query.delete()
 
-    registration_numbers = []
+    registration_numbers = set()
+    # Leave room for every plane to get a unique number.
+    highest_number = max(999, count * 2)
     for _ in alive_it(range(count)):
         # Start with a random base model
         model = random.choice(models)
@@ -120,13 +228,14 @@ def create_airplanes(count: int = 500) -> None:
         while True:
             # Aircraft registration numbers in the US start with an N
             # and can end with a two letter code representing the airline.
-            # There can be up to 3 numbers in between for a range of 1 to 999.
+            # There can be up to 3 numbers in between for a range of 1 to 999
+            # or more for large fleets.
             # We will use RE for Red Eye as the last two letters.
-            number = random.randint(1, 999)
+            number = random.randint(1, highest_number)
             registration_number = f"N{number}RE"
             # Make sure we don't have any repeating registration numbers.
             if registration_number not in registration_numbers:
-                registration_numbers.append(registration_number)
+                registration_numbers.add(registration_number)
                 break
 
         airplane = Airplane(
@@ -140,132 +249,537 @@ def create_airplanes(count: int = 500) -> None:
     print(f"Successfully created {count} airplanes.")
 
 
-def create_flights(percentage: int = 90) -> None:
+# Red Eye's home airports. These are the main hubs and
+# all planes will return to one by the end of the day.
+HOME_AIRPORT_CODES = ["DTW", "JFK", "SFO", "ORD", "IAD"]
+
+# A standard amount of time we want to set aside between
+# flights for deboarding, cleaning the plane, and boarding.
+BOARDING_BUFFER = 90
+
+# Planes scheduled by each worker task. The schedule for a
+# seed only stays the same if this does.
+SCHEDULE_TASK_SIZE = 100
+
+
+class PlaneSchedule(NamedTuple):
+    airplane_id: int
+    range: int
+    # Row of the home airport in the distance tables.
+    home: int
+    # Minutes after midnight UTC of the plane's first flight.
+    departure: int
+    # Column of the airport it flies back and forth to. None to pick random ones.
+    visiting: Optional[int]
+
+
+# (airplane_id, departure column, arrival column, departure minute, distance)
+ScheduledFlight = Tuple[int, int, int, int, float]
+
+# Set in each worker by _init_schedule_worker
+_schedule_tables: Dict[str, Any] = {}
+
+
+def _travel_minutes(distances: np.ndarray) -> np.ndarray:
+    """Vectorized Airport.time_to in minutes."""
+    travel_time = distances / 500
+    hours = np.floor(travel_time)
+    return (hours * 60 + np.floor((travel_time - hours) * 60)).astype(np.int64)
+
+
+def _init_schedule_worker(distances: np.ndarray, columns: Dict[int, int]) -> None:
+    _schedule_tables["distances"] = distances
+    _schedule_tables["minutes"] = _travel_minutes(distances)
+    _schedule_tables["columns"] = columns
+
+
+def _schedule_planes(task: Tuple[int, int, List[PlaneSchedule]]) -> List[ScheduledFlight]:
+    """Fill each plane's day with round trips from its home airport.
+
+    Runs in the worker processes using the distance tables from the home
+    airports to every airport. Each task gets its own random generator
+    seeded from the task number so the results don't depend on which
+    worker runs it.
+    """
+    seed, number, planes = task
+    rng = np.random.default_rng([seed, number])
+    distances = _schedule_tables["distances"]
+    minutes = _schedule_tables["minutes"]
+    columns = _schedule_tables["columns"]
+
+    flights = []
+    for plane in planes:
+        home = columns[plane.home]
+        if plane.visiting is not None:
+            candidates = np.array([plane.visiting])
+        else:
+            # Every airport the plane can reach that isn't
+            # the home airport or less than a 30 minute flight away.
+            row = distances[plane.home]
+            candidates = np.flatnonzero((row <= plane.range) & (row >= 250))
+        if not candidates.size:
+            continue
+
+        departure = plane.departure
+        # Back in time for this plane's usual morning flight the next day.
+        end = plane.departure + 24 * 60
+        retrys = 10
+        while retrys:
+            visiting = candidates[rng.integers(candidates.size)]
+            flight_time = int(minutes[plane.home, visiting])
+            # Make sure we have enough time to complete this flight and the return flight.
+            if departure + (flight_time + BOARDING_BUFFER) * 2 > end:
+                # Just because this flight was too long doesn't mean
+                # they all would be. Try again a few times and see
+                # if we can find a flight that will fit in this time slot.
+                retrys -= 1
+                continue
+
+            distance = float(distances[plane.home, visiting])
+            flights.append((plane.airplane_id, home, visiting, departure, distance))
+            departure += flight_time + BOARDING_BUFFER
+            flights.append((plane.airplane_id, visiting, home, departure, distance))
+            # Set the departure time for the next loop.
+            departure += flight_time + BOARDING_BUFFER
+    return flights
+
+
+def create_flights(
+    percentage: int = 90, workers: Optional[int] = None, chunk_size: int = 1000
+) -> None:
     print(
         f"Populating database with randomly generated flights using {percentage}% of the planes"
     )
 
     PurchasedTicket.query.delete()
+    FlightCancellation.query.delete()
+    FlightInstance.query.delete()
+    old_ids = [id for id, in db.session.query(Flight.id)]
     Flight.query.delete()
-    all_airports = list(Airport.query.all())
-    airports = all_airports.copy()
-    planes = Airplane.query.all()
+
+    start = perf_counter()
+    airport_ids = [id for id, in db.session.query(Airport.id).order_by(Airport.id)]
+    home_airports = (
+        Airport.query.filter(Airport.code.in_(HOME_AIRPORT_CODES))
+        .order_by(Airport.id)
+        .all()
+    )
+    if not home_airports:
+        print("None of the home airports exist so no flights can be created.")
+        return
+
+    planes = Airplane.query.order_by(Airplane.id).all()
     # Grab a random list of planes to use based on the percentage given.
     # This allows us to have some spares that can be used as backups.
     total_flights = len(planes) * (percentage / 100)
-
     planes = random.sample(planes, k=int(total_flights))
-    # A standard amount of time we want to set aside between
-    # flights for deboarding, cleaning the plane, and boarding.
-    boarding_buffer = timedelta(hours=1, minutes=30)
 
-    start_date = date.today()
-    # Make all of our flights last about 6 months.
-    end_date = (datetime.today() + timedelta(days=180)).date()
-
-    # Create a list of Red Eyes home airports. These will be the main
-    # hubs for Red Eye and all planes will return here by the end of the day.
-    home_airports = []
-    home_airport_codes = ["DTW", "JFK", "SFO", "ORD", "IAD"]
-    for code in home_airport_codes:
-        airport = Airport.query.filter_by(code=code).first()
-        if airport:
-            home_airports.append(airport)
+    # Only the distances from the home airports are needed since
+    # every flight starts or ends at one.
+    distances = distance_matrix.distances([a.id for a in home_airports], airport_ids)
+    columns = {id: column for column, id in enumerate(airport_ids)}
+    homes = {airport.id: row for row, airport in enumerate(home_airports)}
+    home_columns = {row: columns[airport.id] for row, airport in enumerate(home_airports)}
 
     # Creates a list of pairs of airports covering all possible combinations.
     # This will allow us to create flights from every hub to every other hub
     # which will help with creating more available connecting flights.
-    #home_flights = list(combinations(home_airports, 2))
-    home_flights = [(a, b) for idx, a in enumerate(home_airports) for b in home_airports[idx + 1:]]
+    home_flights = [
+        (a, b) for idx, a in enumerate(home_airports) for b in home_airports[idx + 1 :]
+    ]
 
-    flight_number = 1
-    for plane in alive_it(planes):
-        use_random = True
+    schedules = []
+    for plane in planes:
+        visiting = None
         if home_flights:
             home_airport, visiting_airport = home_flights.pop()
-            miles = home_airport.distance_to(visiting_airport)
-            if miles < plane.range:
-                use_random = False
+            if distances[homes[home_airport.id], columns[visiting_airport.id]] < plane.range:
+                visiting = columns[visiting_airport.id]
             else:
                 home_flights.append((home_airport, visiting_airport))
-                
         else:
             # Select a random home airport as our starting point
             home_airport = random.choice(home_airports)
 
-        # Our earliest flights will always be between 5 and 7 am.
+        # Our earliest flights will always be between 5 and 7 am
+        # in the timezone of the home airport.
         hour = random.randint(5, 7)
         minute = random.choice([0, 15, 20, 30, 40, 45, 50])
-        # Construst our time and make sure it's in the timezone of the home airport.
         departure_time = time(
             hour=hour, minute=minute, tzinfo=ZoneInfo(home_airport.timezone)
         )
         departure_dt = datetime.combine(date.today(), departure_time).astimezone(
             timezone.utc
         )
-        # Datetime of the morning flight the next day.
-        home_dt = departure_dt + timedelta(days=1)
+        schedules.append(
+            PlaneSchedule(
+                airplane_id=plane.id,
+                range=plane.range,
+                home=homes[home_airport.id],
+                departure=departure_dt.hour * 60 + departure_dt.minute,
+                visiting=visiting,
+            )
+        )
 
-        retrys = 10
-        while retrys:
-            # If we are out of home flights start randomly grabbing airports
-            if use_random:
-                if not airports:
-                    airports = all_airports.copy()
-
-                visiting_airport = random.sample(airports, 1)[0]
-            
-            distance = home_airport.distance_to(visiting_airport)
-            # If the plane can't fly that far, start over and choose a new destination.
-            if distance > plane.range:
-                continue
+    seed = random.getrandbits(64)
+    tasks = [
+        (seed, number, schedules[i : i + SCHEDULE_TASK_SIZE])
+        for number, i in enumerate(range(0, len(schedules), SCHEDULE_TASK_SIZE))
+    ]
 
-            # Covers cases where the home and visiting airport are the same
-            # and where airports would be less than a 30 minute flight away.
-            if use_random and distance < 250:
-                continue
+    start_date = date.today()
+    # Make all of our flights last about 6 months.
+    end_date = (datetime.today() + timedelta(days=180)).date()
 
-            flight_time = home_airport.time_to(visiting_airport)
-            # Make sure we have enough time to complete this flight and the return flight
-            # before this planes usual morning flight the next day.
-            total_flight_time = (flight_time * 2) + (boarding_buffer * 2)
-            remaining_time = home_dt - (departure_dt + total_flight_time)
-            if remaining_time.total_seconds() < 0:
-                # Just because this flight was too long doesn't mean
-                # they all would be. Try again a few times and see
-                # if we can find a flight that will fit in this time slot.
-                retrys -= 1
-                continue
+    count = 0
+    workers = workers or os.cpu_count() or 1
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_schedule_worker, initargs=(distances, home_columns)
+    )
+    with pool, alive_bar(len(schedules)) as bar:
+        for task, flights in zip(tasks, pool.imap(_schedule_planes, tasks)):
+            rows = []
+            for airplane_id, departure, arrival, minutes, distance in flights:
+                count += 1
+                departure_time = time(hour=minutes // 60 % 24, minute=minutes % 60)
+                rows.append(
+                    {
+                        "number": f"{count}",
+                        "airplane_id": airplane_id,
+                        "departure_id": airport_ids[departure],
+                        "arrival_id": airport_ids[arrival],
+                        "departure_time": departure_time,
+                        "start": start_date,
+                        "end": end_date,
+                        # Calculated here since bulk inserts skip _store_route.
+                        **Flight.route_values(distance, departure_time),
+                    }
+                )
+            for i in range(0, len(rows), chunk_size):
+                db.session.bulk_insert_mappings(Flight, rows[i : i + chunk_size])
+            bar(len(task[2]))
+
+    # Bulk deletes don't update the search index so remove them from it here.
+    index = search.index(Flight)
+    for id in old_ids:
+        index.delete(fieldname=index.pk, text=str(id))
+    # Index everything at once instead of on every commit.
+    search.create_index(Flight)
+    elapsed = perf_counter() - start
+    print(
+        f"Successfully created {count} flights in {elapsed:.2f}s "
+        f"({count / elapsed:.0f} rows per second)"
+    )
 
+# How many passengers book together and how often.
+PARTY_SIZES = (1, 2, 3, 4, 5, 6)
+PARTY_WEIGHTS = (0.55, 0.25, 0.09, 0.07, 0.02, 0.02)
+
+FIRST_NAMES = (
+    "James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda",
+    "David", "Elizabeth", "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica",
+    "Thomas", "Sarah", "Carlos", "Maria", "Wei", "Mei", "Ahmed", "Fatima",
+)
+LAST_NAMES = (
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis",
+    "Rodriguez", "Martinez", "Hernandez", "Lopez", "Wilson", "Anderson", "Thomas",
+    "Taylor", "Moore", "Jackson", "Martin", "Lee", "Nguyen", "Chen", "Patel", "Kim",
+)
+
+# Flights generated by each worker task. The data for a seed only stays
+# the same if this does.
+WORKLOAD_TASK_SIZE = 50
+
+CONFIRMATION_CHARACTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+
+class WorkloadSettings(NamedTuple):
+    seed: int
+    load_factor: float
+    assisted: float
+    refunds: float
+    cancellations: float
+    customers: int
+    agent_ids: List[int]
+
+
+# flight_id, date, departure datetime, departure_id, arrival_id, capacity, fare
+FlightDate = Tuple[int, date, datetime, int, int, int, float]
+
+
+class WorkloadChunk(NamedTuple):
+    """The rows for a set of flight dates. Tickets reference their
+    transaction by its position in transactions.
+    """
+
+    transactions: List[Dict]
+    tickets: List[Dict]
+    instances: List[Dict]
+    cancellations: List[Dict]
+
+
+def _confirmation_number(id: int) -> str:
+    # Multiplying by a number coprime with 36 ** 6 shuffles the ids
+    # so the confirmation numbers are unique but don't look sequential.
+    value = (id * 1_000_003) % 36 ** 6
+    characters = []
+    for _ in range(6):
+        value, remainder = divmod(value, 36)
+        characters.append(CONFIRMATION_CHARACTERS[remainder])
+    return "".join(characters)
+
+
+def _generate_workload(task: Tuple[WorkloadSettings, int, List[FlightDate]]) -> WorkloadChunk:
+    """Generate the purchases for a set of flight dates.
+
+    Runs in the worker processes so it only uses the settings and flight
+    dates it's given. Each task gets its own random generator seeded from
+    the task number so the results don't depend on which worker runs it.
+    """
+    settings, number, flight_dates = task
+    rng = random.Random(f"{settings.seed}:{number}")
+    chunk = WorkloadChunk([], [], [], [])
+    # Load factors follow a beta distribution around the average
+    # so most flights are nearly full and a few hardly sell.
+    alpha = settings.load_factor * 10
+    beta = (1 - settings.load_factor) * 10
+
+    for flight_id, day, departure, departure_id, arrival_id, capacity, fare in flight_dates:
+        cancelled_at = None
+        cancelled_by = None
+        if settings.agent_ids and rng.random() < settings.cancellations:
+            cancelled_at = departure - timedelta(hours=rng.uniform(2, 48))
+            cancelled_by = rng.choice(settings.agent_ids)
+            chunk.cancellations.append(
+                {
+                    "flight_id": flight_id,
+                    "cancelled_by": cancelled_by,
+                    "date": day,
+                    # The cancelled tickets are refunded at the same time.
+                    "timestamp": cancelled_at,
+                }
+            )
+        # Nothing can be sold after the flight is cancelled.
+        last_sale = cancelled_at or departure
+
+        remaining = int(capacity * rng.betavariate(alpha, beta))
+        sold = 0
+        while remaining > 0:
+            party = min(remaining, rng.choices(PARTY_SIZES, PARTY_WEIGHTS)[0])
+            remaining -= party
+
+            # The booking curve. Most seats sell in the last few weeks
+            # with a long tail of people booking months ahead.
+            lead = min(rng.gammavariate(1.5, 20), 330)
+            purchased = last_sale - timedelta(days=lead, hours=1)
+            base_fare = fare * party
+
+            assisted_by = None
+            if settings.agent_ids and rng.random() < settings.assisted:
+                assisted_by = rng.choice(settings.agent_ids)
+
+            transaction = len(chunk.transactions)
+            chunk.transactions.append(
+                {
+                    "email": f"customer{rng.randrange(settings.customers)}@workload.example.com",
+                    "departure_id": departure_id,
+                    "destination_id": arrival_id,
+                    "departure_date": day,
+                    "purchase_timestamp": purchased,
+                    "purchase_price": base_fare + calculate_taxes(base_fare, 1),
+                    "assisted_by": assisted_by,
+                }
+            )
 
-            arrival_dt = departure_dt + flight_time
-            flight = Flight(
-                number=f"{flight_number}",
-                airplane_id=plane.id,
-                departure_id=home_airport.id,
-                arrival_id=visiting_airport.id,
-                departure_time=departure_dt.time(),
-                start=start_date,
-                end=end_date
+            last_name = rng.choice(LAST_NAMES)
+            for _ in range(party):
+                refund_timestamp = cancelled_at
+                refunded_by = cancelled_by
+                if cancelled_at is None and rng.random() < settings.refunds:
+                    refund_timestamp = purchased + (departure - purchased) * rng.random()
+                    # Customers can refund online or call an agent.
+                    if assisted_by is not None or (
+                        settings.agent_ids and rng.random() < settings.assisted
+                    ):
+                        refunded_by = assisted_by or rng.choice(settings.agent_ids)
+                if refund_timestamp is None:
+                    sold += 1
+
+                chunk.tickets.append(
+                    {
+                        "transaction_id": transaction,
+                        "flight_id": flight_id,
+                        "first_name": rng.choice(FIRST_NAMES),
+                        "middle_name": None,
+                        "last_name": last_name,
+                        "date_of_birth": date(1940, 1, 1) + timedelta(days=rng.randrange(29200)),
+                        "gender": rng.choice(("male", "female")),
+                        "purchase_price": fare,
+                        "refund_timestamp": refund_timestamp,
+                        "refunded_by": refunded_by,
+                    }
+                )
+
+        chunk.instances.append(
+            {
+                "flight_id": flight_id,
+                "date": day,
+                "capacity": capacity,
+                "sold": sold,
+                "cancelled": cancelled_at is not None,
+            }
+        )
+    return chunk
+
+
+def _workload_agents(count: int) -> List[int]:
+    """The ids of the agents credited with sales, creating any that are missing."""
+    emails = [f"agent{number}@workload.example.com" for number in range(1, count + 1)]
+    ids = {
+        email: id
+        for id, email in db.session.query(Agent.id, Agent.email).filter(Agent.email.in_(emails))
+    }
+    missing = [email for email in emails if email not in ids]
+    if missing:
+        # Hashing is slow so every agent gets the same password.
+        template = Agent()
+        template.set_password("workload")
+        for email in missing:
+            agent = Agent(
+                email=email,
+                first_name="Workload",
+                last_name=email.split("@")[0].title(),
+                password_hash=template.password_hash,
             )
-            db.session.add(flight)
-            flight_number += 1
+            db.session.add(agent)
+            db.session.flush()
+            ids[email] = agent.id
+    return [ids[email] for email in emails]
 
-            departure_dt = arrival_dt + boarding_buffer
-            arrival_dt = departure_dt + flight_time
-            flight = Flight(
-                number=f"{flight_number}",
-                airplane_id=plane.id,
-                departure_id=visiting_airport.id,
-                arrival_id=home_airport.id,
-                departure_time=departure_dt.time(),
-                start=start_date,
-                end=end_date
+
+def _workload_flight_dates(seed: int) -> List[FlightDate]:
+    flight_dates = []
+    flights = Flight.query.options(joinedload(Flight.airplane)).order_by(Flight.id)
+    for flight in flights:
+        if flight.airplane is None:
+            continue
+        fare = flight.base_fare
+        day = flight.start
+        while day <= flight.end:
+            flight_dates.append(
+                (
+                    flight.id,
+                    day,
+                    datetime.combine(day, flight.departure_time),
+                    flight.departure_id,
+                    flight.arrival_id,
+                    flight.airplane.capacity,
+                    fare,
+                )
             )
-            db.session.add(flight)
-            flight_number += 1
-            # Set the departure time for the next loop.
-            departure_dt = arrival_dt + boarding_buffer
+            day += timedelta(days=1)
+    # Spread the purchases over every route and date instead of filling
+    # the first flights.
+    random.Random(seed).shuffle(flight_dates)
+    return flight_dates
+
+
+def create_workload(
+    transactions: int = 1_000_000,
+    seed: int = 0,
+    workers: Optional[int] = None,
+    chunk_size: int = 1000,
+    agents: int = 50,
+    customers: int = 100_000,
+    load_factor: float = 0.82,
+    assisted: float = 0.15,
+    refunds: float = 0.04,
+    cancellations: float = 0.002,
+) -> None:
+    """Replace every purchase with synthetic ones for load testing.
+
+    Flight dates are filled one at a time until at least transactions
+    purchases have been made. The purchases are generated by a pool of
+    worker processes and inserted by this one with executemany. The same
+    seed and flights always generate the same rows.
+    """
+    workers = workers or os.cpu_count() or 1
+    print(
+        f"Populating database with at least {transactions} generated purchases "
+        f"using {workers} workers and seed {seed}"
+    )
+
+    PurchasedTicket.query.delete()
+    PurchaseTransaction.query.delete()
+    FlightCancellation.query.delete()
+    FlightInstance.query.delete()
+    AgentDailySales.query.delete()
+
+    settings = WorkloadSettings(
+        seed=seed,
+        load_factor=load_factor,
+        assisted=assisted,
+        refunds=refunds,
+        cancellations=cancellations,
+        customers=customers,
+        agent_ids=_workload_agents(agents),
+    )
+    flight_dates = _workload_flight_dates(seed)
+    db.session.commit()
+
+    tasks = (
+        (settings, number, flight_dates[i : i + WORKLOAD_TASK_SIZE])
+        for number, i in enumerate(range(0, len(flight_dates), WORKLOAD_TASK_SIZE))
+    )
+    inserts = (
+        (PurchasedTicket.__table__.insert(), "tickets"),
+        (FlightInstance.__table__.insert(), "instances"),
+        (FlightCancellation.__table__.insert(), "cancellations"),
+    )
+    transaction_insert = PurchaseTransaction.__table__.insert()
+
+    start = perf_counter()
+    count = 0
+    tickets = 0
+    with multiprocessing.Pool(workers) as pool, alive_bar(transactions) as bar:
+        while count < transactions:
+            # Only hand out a few tasks at a time so the
+            # workers don't generate more than is needed.
+            batch = list(islice(tasks, workers * 2))
+            if not batch:
+                print("Ran out of flights before reaching the number of purchases.")
+                break
+
+            for chunk in pool.imap(_generate_workload, batch):
+                for i, row in enumerate(chunk.transactions, start=count + 1):
+                    row["id"] = i
+                    row["confirmation_number"] = _confirmation_number(i)
+                for ticket in chunk.tickets:
+                    ticket["transaction_id"] += count + 1
+
+                for i in range(0, len(chunk.transactions), chunk_size):
+                    db.session.execute(transaction_insert, chunk.transactions[i : i + chunk_size])
+                for insert, name in inserts:
+                    rows = getattr(chunk, name)
+                    for i in range(0, len(rows), chunk_size):
+                        db.session.execute(insert, rows[i : i + chunk_size])
+                db.session.commit()
+
+                count += len(chunk.transactions)
+                tickets += len(chunk.tickets)
+                bar(len(chunk.transactions))
+                if count >= transactions:
+                    break
+
+    print("Rebuilding agent sales")
+    AgentDailySales.rebuild()
+
+    elapsed = perf_counter() - start
+    print(
+        f"Successfully added {count} purchases with {tickets} tickets in {elapsed:.2f}s "
+        f"({(count + tickets) / elapsed:.0f} rows per second). "
+        "Run with --create-indexes to make them searchable."
+    )
 
 
 if __name__ == "__main__":
@@ -281,6 +795,12 @@ if __name__ == "__main__":
         action="store_true",
         help="Populate the database with airports from data/airports.json.",
     )
+    parser.add_argument(
+        "-d",
+        "--create-distances",
+        action="store_true",
+        help="Build the airport distance matrix saved to DISTANCE_MATRIX_PATH.",
+    )
     parser.add_argument(
         "-b",
         "--create-airplanes",
@@ -314,6 +834,51 @@ if __name__ == "__main__":
         help="Only populate with US airports"
     )
 
+    parser.add_argument(
+        "--chunk-size",
+        default=1000,
+        type=int,
+        help="Number of rows inserted at a time.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--create-workload",
+        action="store_true",
+        help="""Replace the purchases with randomly generated ones for load testing.
+        This is only done when asked for.
+        """,
+    )
+    parser.add_argument(
+        "--transactions",
+        default=1_000_000,
+        type=int,
+        help="Minimum number of purchases to generate.",
+    )
+    parser.add_argument(
+        "--seed",
+        default=0,
+        type=int,
+        help="Seed for the generated purchases. The same seed generates the same purchases.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes generating flights and purchases. Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--agents",
+        default=50,
+        type=int,
+        help="Number of agents credited with sales.",
+    )
+    parser.add_argument(
+        "--load-factor",
+        default=0.82,
+        type=float,
+        help="Average share of seats sold on each flight.",
+    )
+
     parser.add_argument(
         "-i",
         "--create-indexes",
@@ -329,9 +894,11 @@ if __name__ == "__main__":
     no_args = not (
         args.create_user
         or args.create_airports
+        or args.create_distances
         or args.create_airplanes
         or args.create_flights
         or args.create_indexes
+        or args.create_workload
     )
 
     config = Config
@@ -356,7 +923,7 @@ if __name__ == "__main__":
 
         if no_args or args.create_airports:
             try:
-                populate_airports(args.us_only)
+                populate_airports(args.us_only, args.chunk_size)
                 db.session.commit()
             except (KeyboardInterrupt, Exception) as e:
                 db.session.rollback()
@@ -365,6 +932,13 @@ if __name__ == "__main__":
                 else:
                     print_exc()
 
+        if no_args or args.create_distances:
+            if app.config.get("DISTANCE_MATRIX_PATH"):
+                print("Building the airport distance matrix")
+                distance_matrix.build()
+            else:
+                print("DISTANCE_MATRIX_PATH isn't set so each worker builds its own matrix.")
+
         if no_args or args.create_airplanes:
             try:
                 create_airplanes(count=args.total_planes)
@@ -379,7 +953,9 @@ if __name__ == "__main__":
         if no_args or args.create_flights:
             percentage = 100 - args.spare_percentage
             try:
-                create_flights(percentage=percentage)
+                create_flights(
+                    percentage=percentage, workers=args.workers, chunk_size=args.chunk_size
+                )
                 db.session.commit()
             except (KeyboardInterrupt, Exception) as e:
                 db.session.rollback()
@@ -388,6 +964,23 @@ if __name__ == "__main__":
                 else:
                     print_exc()
 
+        if args.create_workload:
+            try:
+                create_workload(
+                    transactions=args.transactions,
+                    seed=args.seed,
+                    workers=args.workers,
+                    chunk_size=args.chunk_size,
+                    agents=args.agents,
+                    load_factor=args.load_factor,
+                )
+            except (KeyboardInterrupt, Exception) as e:
+                db.session.rollback()
+                if isinstance(e, KeyboardInterrupt):
+                    print("Creating workload cancelled")
+                else:
+                    print_exc()
+
         if no_args or args.create_indexes:
             print("Creating search indexes")
             search.create_index()
@@ -1,4 +1,6 @@
 from argparse import ArgumentParser
+import subprocess
+import sys
 import unittest
 
 import xmlrunner
@@ -11,6 +13,18 @@ if __name__ == "__main__":
     parser.add_argument(
         "-o", "--output", default="results.xml", help="File to output the results to"
     )
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        metavar="BASELINE",
+        help="Also run the benchmarks and fail if they regressed from this baseline",
+    )
+    parser.add_argument(
+        "--threshold",
+        default=0.25,
+        type=float,
+        help="How much slower than the baseline a benchmark can be. 0.25 is 25%%.",
+    )
     args = parser.parse_args()
 
     with open(args.output, "wb") as output:
@@ -18,3 +32,19 @@ if __name__ == "__main__":
         results = runner.run(suite)
         if not results.wasSuccessful():
             exit(1)
+
+    if args.benchmark:
+        # In its own process so the test apps don't affect the timings.
+        benchmark = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.endpoints",
+                "--baseline",
+                args.benchmark,
+                "--threshold",
+                str(args.threshold),
+            ]
+        )
+        if benchmark.returncode:
+            exit(1)
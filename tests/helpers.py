@@ -1,10 +1,15 @@
+import email
 import json
 import random
+import socketserver
+import threading
 from typing import Dict, List, Union
 import unittest
 
 from flask_login import FlaskLoginClient
+from sqlalchemy import event
 from app import create_app, db
+from app.api.representations import output_json
 
 from app.models import Admin, Agent, Airplane, Airport, Customer, User
 
@@ -21,12 +26,18 @@ class TestConfig:
     MSEARCH_BACKEND = "whoosh"
     MSEARCH_INDEX_NAME = "msearch_test"
     EMAIL_ADDR = "no-reply@workoutbuddy.app"
+    MAIL_DEFAULT_SENDER = EMAIL_ADDR
     USE_SESSION = False
+    # Send queued emails as soon as the request commits.
+    EMAIL_OUTBOX_EAGER = True
+    CANCELLATION_JOBS_EAGER = True
 
 
 class FlaskTestCase(unittest.TestCase):
+    config = TestConfig
+
     def setUp(self) -> None:
-        self.app = create_app(TestConfig)
+        self.app = create_app(self.config)
         self.app.test_client_class = FlaskLoginClient
         self.ctx = self.app.test_request_context()
         self.ctx.push()
@@ -38,6 +49,90 @@ class FlaskTestCase(unittest.TestCase):
         self.ctx.pop()
 
 
+def as_json(data: Dict) -> Dict:
+    """data as the api would send it."""
+    return json.loads(output_json(data, 200).data)
+
+
+class QueryCounter:
+    """Counts the SQL statements executed inside the with block."""
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def _increment(self, *args) -> None:
+        self.count += 1
+
+    def __enter__(self) -> "QueryCounter":
+        event.listen(db.engine, "before_cursor_execute", self._increment)
+        return self
+
+    def __exit__(self, *args) -> None:
+        event.remove(db.engine, "before_cursor_execute", self._increment)
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str) -> None:
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self) -> None:
+        sink: "SMTPSink" = self.server.sink
+        self.reply("220 localhost SMTP sink")
+        sender, recipients = None, []
+        for line in self.rfile:
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                sender, recipients = command.split(":", 1)[1].strip(), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip().strip("<>"))
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = b""
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    data += data_line
+                if sink.failures:
+                    sink.failures -= 1
+                    self.reply("451 Try again later")
+                else:
+                    sink.messages.append((recipients, email.message_from_bytes(data)))
+                    self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class SMTPSink:
+    """A local SMTP server that keeps every message it receives.
+
+    The first `failures` messages are rejected with a temporary error.
+    """
+
+    def __init__(self, failures: int = 0) -> None:
+        self.failures = failures
+        self.messages: List = []
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _SMTPHandler)
+        self.server.daemon_threads = True
+        self.server.sink = self
+        self.port = self.server.server_address[1]
+
+    def __enter__(self) -> "SMTPSink":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
 def add_to_db(items):
     if isinstance(items, db.Model):
         items = [items]
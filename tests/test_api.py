@@ -1,5 +1,9 @@
 import datetime as dt
+from typing import List
+from unittest import mock
 
+from app import db, mail, quote_store, reference_cache, search_cache
+from app.api.representations import ENCODERS, output_json
 from app.api.helpers import (
     code_to_airport,
     get_or_404,
@@ -8,15 +12,33 @@ from app.api.helpers import (
     owner_or_role_required,
     role_required,
 )
-from app.models import Airplane, Airport, User, Flight
-from flask import url_for
+from app.models import (
+    Agent,
+    AgentDailySales,
+    Airplane,
+    Airport,
+    CancellationJob,
+    Flight,
+    ItineraryQuote,
+    PurchasedTicket,
+    PurchaseTransaction,
+    TripItinerary,
+    User,
+    load_user,
+)
+from app.rebooking import RebookingPlanner
+from app.urls import url_for_id
+from flask import session, url_for
 from flask_login import login_user
 from werkzeug.exceptions import HTTPException
 from werkzeug.test import TestResponse
 
 from helpers import (
     FlaskTestCase,
+    TestConfig,
+    QueryCounter,
     add_to_db,
+    as_json,
     create_airplanes,
     create_airports,
     create_users,
@@ -95,6 +117,32 @@ class ApiTestCase(FlaskTestCase):
                 "Incorrect number of items in api response",
             )
 
+    def assertCursorPages(self, client, url: str, expected: List[str], per_page: int):
+        """Follows the next links from url and then the prev links back again,
+        asserting every page is the same both ways and expected is seen in order.
+        """
+        pages = []
+        while url:
+            response = client.get(url)
+            self.assertApiResponse(response)
+            pages.append(response.json)
+            url = response.json["_links"]["next"]
+
+        self.assertIsNone(pages[0]["_links"]["prev"])
+        self.assertEqual(
+            expected, [item["self"] for page in pages for item in page["items"]]
+        )
+        for page in pages[:-1]:
+            self.assertEqual(per_page, len(page["items"]))
+
+        url = pages[-1]["_links"]["prev"]
+        for page in reversed(pages[:-1]):
+            response = client.get(url)
+            self.assertApiResponse(response)
+            self.assertEqual(page["items"], response.json["items"])
+            url = response.json["_links"]["prev"]
+        self.assertIsNone(url)
+
 
 class TestHelpers(ApiTestCase):
     def test_json_abort(self):
@@ -233,6 +281,36 @@ class TestHelpers(ApiTestCase):
             self.assertTrue(f())
 
 
+    def test_identity_cache(self):
+        agent_id = self.agent_user.id
+        with QueryCounter() as counter:
+            identity = load_user(str(agent_id))
+            self.assertEqual(1, counter.count)
+            # Checking permissions doesn't need the database
+            identity = load_user(str(agent_id))
+            self.assertEqual("agent", identity.role)
+            self.assertEqual(self.agent_user.email, identity.email)
+            self.assertEqual(1, counter.count)
+        # Anything else loads the whole user
+        self.assertEqual([], identity.purchases())
+        self.assertIsNone(load_user("218712"))
+
+        with self.app.test_client(user=self.admin_user) as client:
+            response = client.patch(
+                url_for("api.agent", id=agent_id),
+                json={
+                    "email": self.agent_user.email,
+                    "first_name": "changed",
+                    "last_name": self.agent_user.last_name,
+                },
+            )
+            self.assertApiResponse(response)
+            self.assertEqual("changed", load_user(str(agent_id)).first_name)
+
+            response = client.delete(url_for("api.agent", id=agent_id))
+            self.assertEqual(204, response.status_code)
+            self.assertIsNone(load_user(str(agent_id)))
+
     def test_get_or_404(self):
         with self.assertRaises(HTTPException) as cm:
             get_or_404(User, 5)
@@ -254,6 +332,78 @@ class TestHelpers(ApiTestCase):
 
         self.assertEquals(airport1.id, airport2.id)
 
+    def test_reference_cache(self):
+        airport = list(create_airports(count=2).values())[0]
+        airplane = create_airplanes(count=1)[0]
+
+        code_to_airport(airport.code)
+        db.session.expunge_all()
+        with QueryCounter() as counter:
+            found = code_to_airport(airport.code.lower())
+            self.assertEqual(airport.id, found.id)
+            self.assertEqual(airport.id, get_or_404(Airport, airport.id).id)
+            self.assertEqual(
+                airplane.id,
+                reference_cache.airplane_by_registration(airplane.registration_number).id,
+            )
+        self.assertEqual(0, counter.count)
+
+        # Cached rows are attached to the session like any other
+        found.name = "Changed"
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertEqual("Changed", code_to_airport(airport.code).name)
+
+        Airport.query.filter_by(id=airport.id).update({"name": "Bulk"})
+        db.session.commit()
+        self.assertEqual("Bulk", code_to_airport(airport.code).name)
+
+        # Nothing is reloaded until the change is committed
+        found = code_to_airport(airport.code)
+        found.name = "Rolled back"
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual("Bulk", code_to_airport(airport.code).name)
+
+    def test_query_instrumentation(self):
+        user_ids = [self.admin_user.id, self.agent_user.id, self.customer_user.id]
+
+        def n_plus_one():
+            db.session.expunge_all()
+            return {"names": [User.query.get(id).first_name for id in user_ids]}
+
+        self.app.add_url_rule("/n_plus_one", view_func=n_plus_one)
+        state = self.app.extensions["query_instrumentation"]
+
+        with self.app.test_client() as client:
+            # Only added in debug mode by default
+            response = client.get("/n_plus_one")
+            self.assertEqual(200, response.status_code)
+            self.assertNotIn("Server-Timing", response.headers)
+
+            state.server_timing = True
+            state.repeated = 3
+            with self.assertLogs("app.instrumentation", "WARNING") as logs:
+                response = client.get("/n_plus_one")
+            timing = response.headers["Server-Timing"]
+            self.assertTrue(timing.startswith("db;dur="))
+            self.assertIn('desc="3 queries"', timing)
+            self.assertIn("db-1;dur=", timing)
+            self.assertIn("/n_plus_one ran 3 queries", logs.output[0])
+            self.assertIn("Possible N+1, ran 3 times", logs.output[0])
+
+    def test_url_for_id(self):
+        endpoints = ["api.flight", "api.purchase", "api.flightstatus", "api.agents"]
+        for endpoint in endpoints:
+            for id in (1, 42, 123456):
+                self.assertEqual(url_for(endpoint, id=id), url_for_id(endpoint, id))
+            self.assertEqual(url_for(endpoint, id="a b"), url_for_id(endpoint, "a b"))
+
+        # Apps mounted under a prefix need their own templates
+        with self.app.test_request_context(base_url="http://localhost/redeye/"):
+            for endpoint in endpoints:
+                self.assertEqual(url_for(endpoint, id=7), url_for_id(endpoint, 7))
+
 
 class TestAirports(ApiTestCase):
     def test_get_airports(self):
@@ -690,7 +840,872 @@ class TestFlights(ApiTestCase):
         )
         airplane_data = response.json["items"][0]
         self.assertDictEqual(
-            flight.to_dict(),
+            as_json(flight.to_dict()),
             airplane_data,
             "Api response doesn't match flight data",
         )
+
+    def test_get_flights_cursor(self):
+        # Identical apart from the id so every page boundary is a tie on the
+        # other columns.
+        flights = [
+            Flight(
+                number="1",
+                airplane_id=self.airplanes[0].id,
+                departure_id=self.airports[0].id,
+                arrival_id=self.airports[1].id,
+                departure_time=dt.time(hour=8, minute=30),
+                start=dt.date.today(),
+                end=dt.date.today(),
+            )
+            for _ in range(7)
+        ]
+        add_to_db(flights)
+        expected = [url_for_id(Flight.__endpoint__, flight.id) for flight in flights]
+
+        with self.app.test_client() as client:
+            for per_page in (1, 3, 7):
+                self.assertCursorPages(
+                    client,
+                    url_for("api.flights", per_page=per_page, cursor=""),
+                    expected,
+                    per_page,
+                )
+
+    def test_search_flights(self):
+        today = dt.date.today()
+        search_args = {
+            "departure_code": self.airports[1].code,
+            "arrival_code": self.airports[2].code,
+            "departure_datetime": today.isoformat(),
+        }
+        flight_data = {
+            "number": "1",
+            "airplane": self.airplanes[0].registration_number,
+            "departure_airport": self.airports[1].code,
+            "arrival_airport": self.airports[2].code,
+            "departure_time": "08:30",
+            "start": today.isoformat(),
+            "end": (today + dt.timedelta(days=1)).isoformat(),
+        }
+
+        # No flights yet. This also loads the route graph.
+        with self.app.test_client() as client:
+            response = client.get(url_for("api.flightsearch", **search_args))
+        self.assertApiResponse(response)
+        self.assertEqual(0, response.json["_meta"]["total_items"])
+
+        # Flights created through the api should show up in search results right away.
+        with self.app.test_client(user=self.admin_user) as client:
+            response = client.post(url_for("api.flights"), json=flight_data)
+        self.assertApiResponse(response, 201)
+        flight = Flight.query.first()
+
+        with self.app.test_client() as client:
+            response = client.get(url_for("api.flightsearch", **search_args))
+        self.assertApiResponse(response)
+        self.assertEqual(1, response.json["_meta"]["total_items"])
+
+        # Same for deleted flights
+        with self.app.test_client(user=self.admin_user) as client:
+            response = client.delete(url_for("api.flight", id=flight.id))
+        self.assertApiResponse(response, 204)
+
+        with self.app.test_client() as client:
+            response = client.get(url_for("api.flightsearch", **search_args))
+        self.assertApiResponse(response)
+        self.assertEqual(0, response.json["_meta"]["total_items"])
+
+    def test_search_cache(self):
+        today = dt.date.today()
+        search_args = {
+            "departure_code": self.airports[1].code,
+            "arrival_code": self.airports[2].code,
+            "departure_datetime": today.isoformat(),
+        }
+        flight_data = {
+            "number": "1",
+            "airplane": self.airplanes[0].registration_number,
+            "departure_airport": self.airports[1].code,
+            "arrival_airport": self.airports[2].code,
+            "departure_time": "08:30",
+            "start": today.isoformat(),
+            "end": (today + dt.timedelta(days=1)).isoformat(),
+        }
+
+        with self.app.test_client(user=self.admin_user) as client:
+            response = client.post(url_for("api.flights"), json=flight_data)
+        self.assertApiResponse(response, 201)
+        flight = Flight.query.first()
+
+        # The second search should come from the cache
+        with self.app.test_client() as client:
+            first = client.get(url_for("api.flightsearch", **search_args))
+            second = client.get(url_for("api.flightsearch", **search_args))
+        self.assertApiResponse(first)
+        self.assertApiResponse(second)
+        # Itinerary ids are unique per search so they can't be compared
+        first, second = first.json["items"], second.json["items"]
+        for item in first + second:
+            del item["id"]
+        self.assertEqual(first, second)
+
+        with self.app.test_client(user=self.admin_user) as client:
+            response = client.get(url_for("api.flightsearchcache"))
+        self.assertApiResponse(response)
+        self.assertEqual(1, response.json["hits"])
+        self.assertEqual(1, response.json["misses"])
+
+        # Cancelling the flight has to invalidate the cached result
+        with self.app.test_client(user=self.admin_user) as client:
+            response = client.post(
+                url_for("api.flightcancellation", id=flight.id),
+                json={"date": today.isoformat()},
+            )
+        self.assertApiResponse(response)
+
+        with self.app.test_client() as client:
+            response = client.get(url_for("api.flightsearch", **search_args))
+        self.assertApiResponse(response)
+        self.assertEqual(0, response.json["_meta"]["total_items"])
+
+        # Only admins can look at or clear the cache
+        with self.app.test_client(user=self.agent_user) as client:
+            response = client.delete(url_for("api.flightsearchcache"))
+        self.assertApiResponse(response, 403)
+
+        with self.app.test_client(user=self.admin_user) as client:
+            response = client.delete(url_for("api.flightsearchcache"))
+        self.assertApiResponse(response, 204)
+
+    def test_search_cache_invalidated_during_search(self):
+        today = dt.date.today()
+        flight = Flight(
+            number="1",
+            airplane_id=self.airplanes[0].id,
+            departure_id=self.airports[1].id,
+            arrival_id=self.airports[2].id,
+            departure_time=dt.time(hour=20),
+            start=today,
+            end=today,
+        )
+        add_to_db(flight)
+        search_args = {
+            "departure_code": self.airports[1].code,
+            "arrival_code": self.airports[2].code,
+            "departure_datetime": today.isoformat(),
+        }
+        search = TripItinerary.search
+
+        def purchase_during_search(*args, **kwargs):
+            itineraries = search(*args, **kwargs)
+            # Someone buys a seat after the search read the availability
+            search_cache.invalidate_flights([flight.id])
+            return itineraries
+
+        with self.app.test_client() as client:
+            with mock.patch.object(TripItinerary, "search", purchase_during_search):
+                response = client.get(url_for("api.flightsearch", **search_args))
+            self.assertApiResponse(response)
+            response = client.get(url_for("api.flightsearch", **search_args))
+            self.assertApiResponse(response)
+
+        # The first result wasn't cached so both searches missed
+        self.assertEqual(0, search_cache.stats()["hits"])
+        self.assertEqual(2, search_cache.stats()["misses"])
+
+    def test_search_new_airport(self):
+        today = dt.date.today()
+        search_args = {
+            "departure_code": self.airports[1].code,
+            "arrival_code": self.airports[2].code,
+            "departure_datetime": today.isoformat(),
+        }
+        # Build the route graph before the airport exists
+        with self.app.test_client() as client:
+            response = client.get(url_for("api.flightsearch", **search_args))
+        self.assertApiResponse(response)
+
+        airport_data = {
+            "code": "NEW",
+            "name": "New",
+            "timezone": "America/New_York",
+            "latitude": 36.5,
+            "longitude": -76.5,
+        }
+        with self.app.test_client(user=self.admin_user) as client:
+            response = client.post(url_for("api.airports"), json=airport_data)
+        self.assertApiResponse(response, 201)
+
+        search_args["departure_code"] = "NEW"
+        with self.app.test_client() as client:
+            response = client.get(url_for("api.flightsearch", **search_args))
+        self.assertApiResponse(response)
+        self.assertEqual(0, response.json["_meta"]["total_items"])
+
+    def test_rebooking_max_days(self):
+        today = dt.date.today()
+        flight = Flight(
+            number="1",
+            airplane_id=self.airplanes[0].id,
+            departure_id=self.airports[1].id,
+            arrival_id=self.airports[2].id,
+            departure_time=dt.time(hour=8),
+            start=today,
+            end=today,
+        )
+        add_to_db(flight)
+        url = url_for("api.flightrebooking", id=flight.id)
+
+        with self.app.test_client(user=self.agent_user) as client:
+            response = client.get(
+                url, query_string={"date": today.isoformat(), "max_days": 1}
+            )
+            self.assertApiResponse(response)
+            self.assertEqual(0, response.json["_meta"]["total_items"])
+
+            # Every extra day is more searches so it's capped
+            for max_days in (-1, RebookingPlanner.MAX_DAYS + 1):
+                response = client.get(
+                    url, query_string={"date": today.isoformat(), "max_days": max_days}
+                )
+                self.assertApiResponse(response, 400)
+
+    def test_cancel_flight(self):
+        today = dt.date.today()
+        flight = Flight(
+            number="1",
+            airplane_id=self.airplanes[0].id,
+            departure_id=self.airports[1].id,
+            arrival_id=self.airports[2].id,
+            departure_time=dt.time(hour=8),
+            start=today,
+            end=today,
+        )
+        add_to_db(flight)
+        transaction = PurchaseTransaction(
+            email="someone@redeye.app",
+            confirmation_number="ABC123",
+            departure_id=flight.departure_id,
+            destination_id=flight.arrival_id,
+            departure_date=today,
+            purchase_price=220,
+        )
+        for _ in range(2):
+            transaction.tickets.append(
+                PurchasedTicket(
+                    flight_id=flight.id,
+                    first_name="Fake",
+                    last_name="Person",
+                    date_of_birth=today,
+                    gender="no",
+                    purchase_price=100,
+                )
+            )
+        add_to_db(transaction)
+
+        with self.app.test_client(user=self.agent_user) as client:
+            response = client.post(
+                url_for("api.flightcancellation", id=flight.id),
+                json={"date": today.isoformat()},
+            )
+        self.assertApiResponse(response)
+        self.assertEqual(
+            {
+                "flight": url_for_id(Flight.__endpoint__, flight.id),
+                "date": today.isoformat(),
+                "passengers": 2,
+                "purchases": [
+                    {
+                        "confirmation_number": "ABC123",
+                        "email": "someone@redeye.app",
+                        "passengers": 2,
+                        "refund_amount": 220,
+                    }
+                ],
+                "refund_total": 220,
+            },
+            response.json,
+        )
+
+    def test_checkout_quotes(self):
+        today = dt.date.today()
+        flight = Flight(
+            number="1",
+            airplane_id=self.airplanes[0].id,
+            departure_id=self.airports[1].id,
+            arrival_id=self.airports[2].id,
+            departure_time=dt.time(hour=23, minute=30),
+            start=today,
+            end=today,
+        )
+        add_to_db(flight)
+        search_args = {
+            "departure_code": self.airports[1].code,
+            "arrival_code": self.airports[2].code,
+            "departure_datetime": today.isoformat(),
+        }
+        data = {
+            "email": "someone@redeye.app",
+            "street_address": "1 Main St",
+            "city": "City",
+            "state": "VA",
+            "zip_code": "12345",
+            "card_number": "4111111111111111",
+            "card_expiration": "01/2099",
+            "card_cvc": "123",
+            "passengers-0-first_name": "Fake",
+            "passengers-0-last_name": "Person",
+            "passengers-0-date_of_birth": "2000-01-01",
+            "passengers-0-gender": "male",
+        }
+
+        with self.app.test_client() as client:
+            for _ in range(3):
+                response = client.get(url_for("api.flightsearch", **search_args))
+                self.assertApiResponse(response)
+            quote = response.json["items"][0]["id"]
+            # The session only references the quotes
+            with client.session_transaction() as session:
+                self.assertEqual(["quotes"], list(session.keys()))
+                self.assertEqual(32, len(session["quotes"]))
+
+            # Quotes belong to the session that searched for them
+            with self.app.test_client() as other:
+                response = other.post(
+                    url_for("api.checkout"), json=dict(data, **{"itineraries-0": quote})
+                )
+            self.assertApiResponse(response, 404)
+
+            response = client.post(
+                url_for("api.checkout"), json=dict(data, **{"itineraries-0": quote})
+            )
+            self.assertApiResponse(response)
+            purchase = PurchaseTransaction.query.one()
+            self.assertEqual(today, purchase.departure_date)
+            self.assertEqual(self.airports[1].id, purchase.departure_id)
+            self.assertEqual(self.airports[2].id, purchase.destination_id)
+            self.assertEqual(flight.id, purchase.tickets[0].flight_id)
+
+            response = client.post(
+                url_for("api.checkout"), json=dict(data, **{"itineraries-0": "unknown"})
+            )
+            self.assertApiResponse(response, 404)
+
+            # Quotes are kept in the database so every worker can see them
+            self.assertEqual(3, ItineraryQuote.query.count())
+            ItineraryQuote.query.update(
+                {"expires": dt.datetime.utcnow() - dt.timedelta(seconds=1)}
+            )
+            db.session.commit()
+            response = client.post(
+                url_for("api.checkout"), json=dict(data, **{"itineraries-0": quote})
+            )
+            self.assertApiResponse(response, 404)
+            self.assertEqual(3, quote_store.sweep())
+            self.assertEqual(0, ItineraryQuote.query.count())
+
+    def test_bulk_cancellation(self):
+        today = dt.date.today()
+        hub = self.airports[1]
+        routes = [(hub, self.airports[2]), (self.airports[0], hub), (self.airports[3], self.airports[4])]
+        flights = [
+            Flight(
+                number=str(i + 1),
+                airplane_id=self.airplanes[i].id,
+                departure_id=departure.id,
+                arrival_id=arrival.id,
+                departure_time=dt.time(hour=8 + i),
+                start=today,
+                end=today + dt.timedelta(days=2),
+            )
+            for i, (departure, arrival) in enumerate(routes)
+        ]
+        add_to_db(flights)
+
+        def purchase(email, date, *flights):
+            transaction = PurchaseTransaction(
+                email=email,
+                confirmation_number=email[:6].upper(),
+                departure_id=flights[0].departure_id,
+                destination_id=flights[-1].arrival_id,
+                departure_date=date,
+                purchase_price=100 * len(flights) + 20,
+            )
+            for flight in flights:
+                transaction.tickets.append(
+                    PurchasedTicket(
+                        flight_id=flight.id,
+                        first_name="Fake",
+                        last_name="Person",
+                        date_of_birth=today,
+                        gender="no",
+                        purchase_price=100,
+                    )
+                )
+            return transaction
+
+        # Both of the first customer's flights go through the hub
+        add_to_db(
+            [
+                purchase("first@redeye.app", today, flights[1], flights[0]),
+                purchase("second@redeye.app", today + dt.timedelta(days=1), flights[0]),
+                purchase("third@redeye.app", today, flights[2]),
+            ]
+        )
+
+        # Use small batches so the job takes more than one transaction
+        self.app.config["CANCELLATION_JOB_BATCH_SIZE"] = 3
+        data = {
+            "airport": hub.code,
+            "start": today.isoformat(),
+            "end": (today + dt.timedelta(days=1)).isoformat(),
+        }
+        with self.app.test_client(user=self.customer_user) as client:
+            response = client.post(url_for("api.flightcancellations"), json=data)
+        self.assertApiResponse(response, 403)
+
+        with self.app.test_client(user=self.agent_user) as client:
+            response = client.post(
+                url_for("api.flightcancellations"), json={"start": today.isoformat()}
+            )
+        self.assertApiResponse(response, 400)
+
+        with mail.record_messages() as messages:
+            with self.app.test_client(user=self.agent_user) as client:
+                response = client.post(url_for("api.flightcancellations"), json=data)
+        self.assertApiResponse(response, 202)
+        job = response.json
+        self.assertEqual("complete", job["status"])
+        self.assertEqual(4, job["total"])
+        self.assertEqual(4, job["processed"])
+        self.assertEqual(4, job["cancelled"])
+        self.assertEqual(3, job["passengers"])
+        self.assertEqual(340, job["refund_total"])
+
+        # One email per customer no matter how many of their flights were cancelled
+        self.assertEqual(
+            ["first@redeye.app", "second@redeye.app"],
+            sorted(message.recipients[0] for message in messages),
+        )
+        first = next(m for m in messages if m.recipients == ["first@redeye.app"])
+        self.assertIn("Flight Number: 1", first.body)
+        self.assertIn("Flight Number: 2", first.body)
+
+        for flight in flights:
+            db.session.refresh(flight)
+        self.assertTrue(flights[0].is_cancelled(today + dt.timedelta(days=1)))
+        self.assertFalse(flights[0].is_cancelled(today + dt.timedelta(days=2)))
+        self.assertFalse(flights[2].is_cancelled(today))
+
+        with self.app.test_client(user=self.agent_user) as client:
+            response = client.get(job["self"])
+            self.assertApiResponse(response)
+            self.assertEqual(job, response.json)
+
+            # Only failed or stalled jobs can be resumed
+            response = client.post(job["self"])
+            self.assertApiResponse(response, 409)
+
+    def test_resume_cancellation(self):
+        today = dt.date.today()
+        hub = self.airports[1]
+
+        def flight(number, airplane):
+            return Flight(
+                number=number,
+                airplane_id=airplane.id,
+                departure_id=hub.id,
+                arrival_id=self.airports[2].id,
+                departure_time=dt.time(hour=8),
+                start=today,
+                end=today + dt.timedelta(days=1),
+            )
+
+        add_to_db([flight("1", self.airplanes[0]), flight("2", self.airplanes[1])])
+        job = CancellationJob(
+            created_by=self.agent_user.id,
+            airport_id=hub.id,
+            start=today,
+            end=today + dt.timedelta(days=1),
+        )
+        job.plan()
+        # The job died while it was running the first batch.
+        job.status = CancellationJob.RUNNING
+        add_to_db(job)
+        url = url_for_id(CancellationJob.__endpoint__, job.id)
+
+        # Flights added after the job was planned aren't cancelled.
+        added = flight("3", self.airplanes[2])
+        add_to_db(added)
+
+        with self.app.test_client(user=self.agent_user) as client:
+            # It could still be running
+            response = client.post(url)
+            self.assertApiResponse(response, 409)
+
+            job.updated = dt.datetime.utcnow() - dt.timedelta(hours=1)
+            db.session.commit()
+            response = client.post(url)
+            self.assertApiResponse(response, 202)
+        self.assertEqual("complete", response.json["status"])
+        self.assertEqual(4, response.json["total"])
+        self.assertEqual(4, response.json["cancelled"])
+        self.assertFalse(added.is_cancelled(today))
+
+
+class TestPurchases(ApiTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.airports = list(create_airports(count=5).values())
+        self.airplanes = create_airplanes()
+
+    def create_purchases(self, count: int):
+        today = dt.date.today()
+        flights = []
+        for i, airplane in enumerate(self.airplanes):
+            flights.append(
+                Flight(
+                    number=str(i),
+                    airplane_id=airplane.id,
+                    departure_id=self.airports[i % 2].id,
+                    arrival_id=self.airports[2 + i % 3].id,
+                    departure_time=dt.time(hour=5 + i),
+                    start=today,
+                    end=today,
+                )
+            )
+        add_to_db(flights)
+
+        purchases = []
+        for i in range(count):
+            flight = flights[i % len(flights)]
+            purchase = PurchaseTransaction(
+                email=f"customer{i}@redeye.app",
+                confirmation_number=f"{i:06}",
+                departure_id=flight.departure_id,
+                destination_id=flight.arrival_id,
+                departure_date=today,
+                purchase_price=250,
+                assisted_by=self.agent_user.id,
+            )
+            for _ in range(2):
+                purchase.tickets.append(
+                    PurchasedTicket(
+                        flight_id=flight.id,
+                        first_name="Fake",
+                        last_name="Person",
+                        date_of_birth=today,
+                        gender="no",
+                        purchase_price=100,
+                        refund_timestamp=dt.datetime.now(),
+                        refunded_by=self.agent_user.id,
+                    )
+                )
+            purchases.append(purchase)
+        add_to_db(purchases)
+        # Start with an empty session like a new request would
+        db.session.expunge_all()
+
+    def test_get_purchases_query_count(self):
+        self.create_purchases(25)
+
+        # The number of queries for a page shouldn't depend on how many items it has.
+        for expand in (False, True):
+            for per_page in (5, 25):
+                with self.app.test_client() as client, QueryCounter() as counter:
+                    response = client.get(
+                        url_for("api.purchases", per_page=per_page, expand=expand)
+                    )
+                self.assertPaginatedResponse(
+                    response, expected_per_page=per_page, expected_total_pages=25 // per_page
+                )
+                self.assertEqual(per_page, len(response.json["items"]))
+                self.assertLessEqual(
+                    counter.count, 5, f"Too many queries with expand={expand}"
+                )
+
+    def test_get_purchases_cursor(self):
+        self.create_purchases(12)
+
+        with self.app.test_client() as client:
+            # Walk forward through all of the pages
+            pages = []
+            url = url_for("api.purchases", per_page=5, cursor="")
+            while url:
+                response = client.get(url)
+                self.assertApiResponse(response)
+                self.assertNotIn("total_items", response.json["_meta"])
+                pages.append(response.json)
+                url = response.json["_links"]["next"]
+
+            self.assertEqual([5, 5, 2], [len(page["items"]) for page in pages])
+            self.assertIsNone(pages[0]["_links"]["prev"])
+            purchases = [item["self"] for page in pages for item in page["items"]]
+            self.assertEqual(12, len(set(purchases)))
+
+            # And back again
+            response = client.get(pages[-1]["_links"]["prev"])
+            self.assertApiResponse(response)
+            self.assertEqual(pages[1]["items"], response.json["items"])
+
+            # The total is only counted when asked for
+            response = client.get(url_for("api.purchases", cursor="", count=True))
+            self.assertApiResponse(response)
+            self.assertEqual(12, response.json["_meta"]["total_items"])
+
+            response = client.get(url_for("api.purchases", cursor="not a cursor"))
+            self.assertApiResponse(response, 400)
+
+
+    def test_get_user_purchases_cursor(self):
+        today = dt.date.today()
+        purchases = [
+            PurchaseTransaction(
+                email=self.customer_user.email if i % 3 else "someone@redeye.app",
+                confirmation_number=f"{i:06}",
+                departure_id=self.airports[0].id,
+                destination_id=self.airports[1].id,
+                departure_date=today,
+                purchase_price=250,
+            )
+            for i in range(12)
+        ]
+        add_to_db(purchases)
+        # Other customer's purchases are between theirs so the ids skip
+        expected = [
+            url_for_id(PurchaseTransaction.__endpoint__, purchase.id)
+            for purchase in purchases
+            if purchase.email == self.customer_user.email
+        ]
+        self.assertEqual(8, len(expected))
+
+        with self.app.test_client(user=self.customer_user) as client:
+            for per_page in (2, 3):
+                self.assertCursorPages(
+                    client,
+                    url_for(
+                        "api.userpurchases",
+                        id=self.customer_user.id,
+                        per_page=per_page,
+                        cursor="",
+                    ),
+                    expected,
+                    per_page,
+                )
+
+    def test_agents_sales(self):
+        agents = [self.agent_user]
+        for i in range(3):
+            agents.append(
+                Agent(first_name="agent", last_name=str(i), email=f"agent{i}@redeye.app")
+            )
+        add_to_db(agents[1:])
+
+        # Two agents tie for second and the last one hasn't sold anything
+        jan, feb = dt.date(2022, 1, 31), dt.date(2022, 2, 1)
+        AgentDailySales.record(agents[0].id, jan, sales=100, transactions=1)
+        AgentDailySales.record(agents[1].id, jan, sales=150, transactions=1)
+        AgentDailySales.record(agents[1].id, feb, sales=250, transactions=1)
+        AgentDailySales.record(agents[2].id, feb, sales=100, transactions=1)
+        # Outside of the range
+        AgentDailySales.record(agents[0].id, dt.date(2022, 3, 1), sales=999)
+        db.session.commit()
+
+        args = {"start": "2022-01-15", "end": "2022-02-15"}
+        with self.app.test_client(user=self.agent_user) as client:
+            response = client.get(url_for("api.agentssales", **args))
+            self.assertApiResponse(response, 403)
+
+        with self.app.test_client(user=self.admin_user) as client, QueryCounter() as counter:
+            response = client.get(url_for("api.agentssales", group="month", **args))
+        self.assertApiResponse(response)
+        self.assertLessEqual(counter.count, 2)
+        items = response.json["items"]
+        self.assertEqual(4, response.json["_meta"]["total_items"])
+        self.assertEqual([agent.id for agent in agents], [
+            int(item["agent"]["self"].rsplit("/", 1)[-1]) for item in items
+        ])
+        self.assertEqual({"2022-01-01": 150, "2022-02-01": 250}, items[1]["sales"])
+        self.assertEqual({"2022-01-01": 0, "2022-02-01": 0}, items[3]["sales"])
+        self.assertNotIn("rank", items[0])
+
+        with self.app.test_client(user=self.admin_user) as client:
+            response = client.get(url_for("api.agentssales", rank=True, **args))
+            self.assertApiResponse(response)
+            items = response.json["items"]
+            self.assertEqual([400, 100, 100, 0], [item["total"] for item in items])
+            self.assertEqual([1, 2, 2, 4], [item["rank"] for item in items])
+            self.assertEqual(32, len(items[0]["sales"]))
+            self.assertEqual(250, items[0]["sales"]["2022-02-01"])
+
+            response = client.get(url_for("api.agentssales", top=2, **args))
+            self.assertApiResponse(response)
+            items = response.json["items"]
+            self.assertEqual([400, 100], [item["total"] for item in items])
+            self.assertEqual(agents[0].id, int(items[1]["agent"]["self"].rsplit("/", 1)[-1]))
+
+            response = client.get(url_for("api.agentssales", group="week", **args))
+            self.assertApiResponse(response, 400)
+
+class TestRepresentations(ApiTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.airports = list(create_airports(count=5).values())
+        self.airplanes = create_airplanes()
+        today = dt.date.today()
+        flights = [
+            Flight(
+                number=str(i),
+                airplane_id=airplane.id,
+                departure_id=self.airports[0].id,
+                arrival_id=self.airports[i + 1].id,
+                departure_time=dt.time(hour=5 + i, minute=15),
+                start=today,
+                end=today + dt.timedelta(days=30),
+            )
+            for i, airplane in enumerate(self.airplanes[:4])
+        ]
+        add_to_db(flights)
+
+    def get_flights(self, **config):
+        self.app.config.update(config)
+        with self.app.test_client() as client:
+            response = client.get(url_for("api.flights", expand=True))
+        self.assertApiResponse(response)
+        return response
+
+    def test_encoders(self):
+        expected = self.get_flights(API_JSON_ENCODER="json")
+        for encoder in ENCODERS:
+            response = self.get_flights(API_JSON_ENCODER=encoder)
+            self.assertEqual(expected.json, response.json, f"{encoder} output differs")
+
+    def test_native_types(self):
+        data = {
+            "date": dt.date(2022, 7, 4),
+            "time": dt.time(hour=8, minute=30),
+            "datetime": dt.datetime(2022, 7, 4, 8, 30, tzinfo=dt.timezone.utc),
+            "timedelta": dt.timedelta(hours=2, minutes=5),
+        }
+        for encoder in ENCODERS:
+            self.app.config["API_JSON_ENCODER"] = encoder
+            response = output_json(data, 200)
+            self.assertEqual(
+                {
+                    "date": "2022-07-04",
+                    "time": "08:30:00",
+                    "datetime": "2022-07-04T08:30:00+00:00",
+                    "timedelta": "2:05:00",
+                },
+                response.json,
+            )
+
+    def test_streaming(self):
+        data = {"items": [{"id": i} for i in range(3)], "_meta": {"page": 1}}
+        self.app.config["API_JSON_STREAM_THRESHOLD"] = 3
+        self.assertFalse(output_json(data, 200).is_streamed)
+        self.app.config["API_JSON_STREAM_THRESHOLD"] = 2
+        self.assertTrue(output_json(data, 200).is_streamed)
+
+        expected = self.get_flights(API_JSON_STREAM_THRESHOLD=0)
+        response = self.get_flights(API_JSON_STREAM_THRESHOLD=2)
+        self.assertEqual(expected.json, response.json)
+
+
+class SessionConfig(TestConfig):
+    USE_SESSION = True
+    SESSION_TYPE = "cached_sqlalchemy"
+    SESSION_CACHE_SIZE = 1024
+    SESSION_SWEEP_INTERVAL = 0
+    SESSION_SWEEP_BATCH_SIZE = 2
+
+
+class UncachedSessionConfig(SessionConfig):
+    SESSION_CACHE_SIZE = 0
+
+
+class TestSessions(FlaskTestCase):
+    config = SessionConfig
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        @self.app.route("/session/<value>")
+        def set_session(value):
+            if value != "same":
+                session["value"] = value
+            return session.get("value", "")
+
+        self.interface = self.app.session_interface
+        self.model = self.interface.sql_session_model
+
+    def test_write_on_change(self):
+        with self.app.test_client() as client, mock.patch.object(
+            self.interface, "_store", wraps=self.interface._store
+        ) as store:
+            # Nothing is stored until something is put in the session
+            self.assertEqual(b"", client.get("/session/same").data)
+            self.assertEqual(0, self.model.query.count())
+
+            response = client.get("/session/one")
+            self.assertIn("Set-Cookie", response.headers)
+            self.assertEqual(1, store.call_count)
+
+            # Unchanged sessions come from the cache and aren't written
+            with QueryCounter() as counter:
+                response = client.get("/session/same")
+            self.assertEqual(b"one", response.data)
+            self.assertNotIn("Set-Cookie", response.headers)
+            self.assertEqual(0, counter.count)
+            self.assertEqual(1, store.call_count)
+
+            # Or from the table if they aren't cached
+            self.interface.cache.clear()
+            self.assertEqual(b"one", client.get("/session/same").data)
+            self.assertEqual(1, store.call_count)
+
+            client.get("/session/two")
+            self.assertEqual(2, store.call_count)
+            self.interface.cache.clear()
+            self.assertEqual(b"two", client.get("/session/same").data)
+            self.assertEqual(1, self.model.query.count())
+
+    def test_sweep(self):
+        now = dt.datetime.utcnow()
+        for i in range(5):
+            db.session.add(
+                self.model(
+                    session_id=f"session:{i}",
+                    data=b"",
+                    expiry=now + dt.timedelta(days=-1 if i < 3 else 1),
+                )
+            )
+        db.session.commit()
+
+        self.assertEqual(3, self.interface.sweep())
+        self.assertEqual(
+            ["session:3", "session:4"],
+            sorted(id for id, in db.session.query(self.model.session_id)),
+        )
+
+
+class TestUncachedSessions(FlaskTestCase):
+    config = UncachedSessionConfig
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.app.route("/session/<value>")(
+            lambda value: session.setdefault("value", value)
+        )
+        self.model = self.app.session_interface.sql_session_model
+
+    def test_logout_elsewhere(self):
+        with self.app.test_client() as client:
+            self.assertEqual(b"one", client.get("/session/one").data)
+            self.assertEqual(b"one", client.get("/session/two").data)
+
+            # Deleted by another process so it isn't used again
+            self.model.query.delete()
+            db.session.commit()
+            self.assertEqual(b"three", client.get("/session/three").data)
@@ -0,0 +1,103 @@
+import io
+import json
+import unittest
+
+from init_db import _airport_rows, iter_json_array
+
+
+def airport(**kwargs):
+    row = {
+        "code": "ABC",
+        "lat": "40.5",
+        "lon": "-75.25",
+        "name": "Some Airport",
+        "city": "Some City",
+        "state": "Some State",
+        "country": "United States",
+        "tz": "America/New_York",
+    }
+    row.update(kwargs)
+    return row
+
+
+class TestIterJsonArray(unittest.TestCase):
+    def test_chunk_boundaries(self):
+        items = [
+            airport(),
+            airport(name='The "Quoted" Airport, {not} [json]'),
+            airport(name="Escaped \\ slash é \\\""),
+            {"nested": {"list": [1, 2.5, None, True]}, "empty": {}},
+            airport(code="XYZ", name=" " * 40),
+        ]
+        text = json.dumps(items, indent=2)
+        # Every size splits the objects and strings at a different point.
+        for buffer_size in range(1, 20):
+            with self.subTest(buffer_size=buffer_size):
+                parsed = list(iter_json_array(io.StringIO(text), buffer_size))
+                self.assertEqual(items, parsed)
+
+    def test_numbers(self):
+        items = [123456, -7.25e10, 0, 98765.4321]
+        text = json.dumps(items)
+        for buffer_size in range(1, 12):
+            with self.subTest(buffer_size=buffer_size):
+                parsed = list(iter_json_array(io.StringIO(text), buffer_size))
+                self.assertEqual(items, parsed)
+
+    def test_empty(self):
+        for text in ("[]", "  [ \n ]  "):
+            self.assertEqual([], list(iter_json_array(io.StringIO(text), 1)))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(io.StringIO('{"code": "ABC"}')))
+        # Truncated files fail instead of stopping early
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_json_array(io.StringIO('[{"code": "ABC"}, {"code": "D'), 4))
+
+
+class TestAirportRows(unittest.TestCase):
+    def test_rows(self):
+        rows = list(_airport_rows([airport()], us_only=True))
+        self.assertEqual(
+            [
+                {
+                    "code": "ABC",
+                    "name": "Some Airport",
+                    "timezone": "America/New_York",
+                    "latitude": 40.5,
+                    "longitude": -75.25,
+                    "city": "Some City",
+                    "state": "Some State",
+                }
+            ],
+            rows,
+        )
+
+    def test_malformed(self):
+        malformed = [
+            airport(tz=""),
+            airport(tz="Not/A_Timezone"),
+            airport(name=""),
+            airport(code=""),
+            airport(code="ABCD"),
+            airport(code="AB"),
+            airport(lat=""),
+            airport(lat=None),
+            airport(lon="east"),
+        ]
+        for row in malformed:
+            with self.subTest(row=row):
+                self.assertEqual([], list(_airport_rows([row], us_only=False)))
+
+    def test_filtered(self):
+        rows = [
+            airport(code="AAA"),
+            airport(code="BBB", country="Canada", tz="America/Toronto"),
+            # Only the first airport with a code is kept
+            airport(code="AAA", name="Duplicate"),
+        ]
+        codes = [(row["code"], row["name"]) for row in _airport_rows(rows, True)]
+        self.assertEqual([("AAA", "Some Airport")], codes)
+        codes = [row["code"] for row in _airport_rows(rows, us_only=False)]
+        self.assertEqual(["AAA", "BBB"], codes)
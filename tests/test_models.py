@@ -1,17 +1,27 @@
 import datetime as dt
+import os
+import tempfile
+import time
+from unittest import mock
 
 import pytz
-from app import db
+from app import db, distance_matrix, mail, outbox
+from app.email import queue_email
+from app.graph import route_graph
 from app.models import (
+    AgentDailySales,
     Airport,
+    EmailOutbox,
     Flight,
     FlightCancellation,
+    FlightInstance,
     PurchaseTransaction,
     PurchasedTicket,
     TripItinerary,
     User,
 )
-from helpers import FlaskTestCase
+from app.rebooking import RebookingPlanner
+from helpers import FlaskTestCase, QueryCounter, SMTPSink
 from helpers import create_users, create_airports, create_airplanes, add_to_db
 
 
@@ -70,6 +80,63 @@ class TestAirport(FlaskTestCase):
         d = self.airport2.distance_to(self.airport1)
         self.assertAlmostEquals(1574.5208, d, places=4)
 
+    def test_distance_matrix(self):
+        # The matrix is single precision so it's only compared to 2 places.
+        add_to_db([self.airport1, self.airport2])
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config["DISTANCE_MATRIX_PATH"] = os.path.join(directory, "distances.npy")
+            distance_matrix.init_app(self.app)
+
+            d = self.airport1.distance_to(self.airport2)
+            self.assertAlmostEquals(1574.5208, d, places=2)
+            self.assertTrue(os.path.exists(self.app.config["DISTANCE_MATRIX_PATH"]))
+
+            # Moved airports have to be updated in the matrix
+            self.airport2.latitude = self.airport1.latitude
+            self.airport2.longitude = self.airport1.longitude
+            add_to_db(self.airport2)
+            distance_matrix.update_airport(self.airport2)
+            self.assertEquals(0, self.airport1.distance_to(self.airport2))
+
+            # New airports get added to the existing matrix
+            airport3 = Airport(
+                code="AAC",
+                name="Test",
+                timezone="Test",
+                latitude=36.8428,
+                longitude=-76.0307,
+            )
+            add_to_db(airport3)
+            distance_matrix.update_airport(airport3)
+            d = airport3.distance_to(self.airport1)
+            self.assertAlmostEquals(1574.5208, d, places=2)
+
+            # Another worker should be able to use the saved matrix
+            distance_matrix.init_app(self.app)
+            d = self.airport1.distance_to(airport3)
+            self.assertAlmostEquals(1574.5208, d, places=2)
+
+    def test_distance_table(self):
+        add_to_db([self.airport1, self.airport2])
+        distances = distance_matrix.distances(
+            [self.airport1.id], [self.airport1.id, self.airport2.id]
+        )
+        self.assertEqual((1, 2), distances.shape)
+        self.assertEquals(0, distances[0, 0])
+        self.assertAlmostEquals(1574.5208, distances[0, 1], places=2)
+
+        # Airports added without updating the matrix are picked up
+        airport3 = Airport(
+            code="AAC",
+            name="Test",
+            timezone="Test",
+            latitude=36.8428,
+            longitude=-76.0307,
+        )
+        add_to_db(airport3)
+        distances = distance_matrix.distances([airport3.id], [self.airport1.id])
+        self.assertAlmostEquals(1574.5208, distances[0, 0], places=2)
+
     def test_time_to(self):
         t = self.airport1.time_to(self.airport1)
         self.assertEquals(dt.timedelta(), t)
@@ -112,6 +179,46 @@ class TestFlight(FlaskTestCase):
 
         self.assertTrue(flight.is_cancelled(today))
 
+    def test_route(self):
+        today = dt.date.today()
+        departure, arrival = self.airports[0], self.airports[1]
+        flight = Flight(
+            number="1",
+            airplane_id=self.airplanes[0].id,
+            departure_airport=departure,
+            arrival_airport=arrival,
+            departure_time=dt.time(hour=5, minute=30),
+            start=today,
+            end=today,
+        )
+        # Calculated from the airports until it's written
+        flight_time = departure.time_to(arrival) + dt.timedelta(minutes=45)
+        self.assertEqual(flight_time, flight.flight_time)
+        add_to_db(flight)
+
+        # The route values are stored so they can be used in queries
+        row = (
+            Flight.query.with_entities(
+                Flight.distance, Flight.duration, Flight.arrival_time, Flight.base_fare
+            )
+            .filter_by(id=flight.id)
+            .one()
+        )
+        self.assertAlmostEqual(departure.distance_to(arrival), row.distance)
+        self.assertEqual(flight_time, dt.timedelta(minutes=row.duration))
+        arrival_dt = dt.datetime.combine(today, flight.departure_time) + flight_time
+        self.assertEqual(arrival_dt.time(), row.arrival_time)
+        self.assertEqual(round(row.distance * 0.2, 2), row.base_fare)
+        self.assertEqual(row.base_fare, flight.cost(today))
+        self.assertEqual(
+            1, Flight.query.filter(Flight.arrival_time == arrival_dt.time()).count()
+        )
+
+        # Changing the route updates the values
+        flight.arrival_id = self.airports[2].id
+        add_to_db(flight)
+        self.assertAlmostEqual(departure.distance_to(self.airports[2]), flight.distance)
+
     def test_cancel(self):
         today = dt.date.today()
         plane = self.airplanes[0]
@@ -130,6 +237,82 @@ class TestFlight(FlaskTestCase):
         flight.cancel(today, self.agent.id)
         self.assertTrue(flight.is_cancelled(today))
 
+    def test_cancel_summary(self):
+        today = dt.date.today()
+        plane = self.airplanes[0]
+        flights = []
+        for i in range(3):
+            flights.append(
+                Flight(
+                    number=str(i),
+                    airplane_id=plane.id,
+                    departure_id=self.airports[i].id,
+                    arrival_id=self.airports[i + 1].id,
+                    departure_time=dt.time(hour=5 + i),
+                    start=today,
+                    end=today,
+                )
+            )
+        add_to_db(flights)
+
+        def purchase(flight, count, other=None):
+            transaction = PurchaseTransaction(email=self.customer.email)
+            transaction.departure_date = today
+            transaction.confirmation_number = transaction.generate_confirmation_number(
+                self.customer.email
+            )
+            for f in filter(None, (flight, other)):
+                for _ in range(count):
+                    transaction.tickets.append(
+                        PurchasedTicket(
+                            flight_id=f.id,
+                            first_name="Fake",
+                            last_name="Person",
+                            date_of_birth=today,
+                            gender="no",
+                            purchase_price=100,
+                        )
+                    )
+            transaction.purchase_price = 100 * len(transaction.tickets) + 10
+            FlightInstance.sell(flight, today, count)
+            add_to_db(transaction)
+            return transaction
+
+        # Two passengers with a connection on another flight
+        connection = purchase(flights[0], 2, other=flights[1])
+        single = purchase(flights[0], 1)
+
+        # Only count the cancellation, not sending the emails
+        with mock.patch.object(outbox, "notify"), QueryCounter() as small:
+            summary = flights[0].cancel(today, self.agent.id)
+
+        self.assertEqual(3, summary.passengers)
+        data = summary.to_dict()
+        self.assertEqual(2, len(data["purchases"]))
+        # Half of the tickets are refunded so they get half the taxes back
+        self.assertEqual(205, data["purchases"][0]["refund_amount"])
+        self.assertEqual(110, data["purchases"][1]["refund_amount"])
+        self.assertEqual(315, data["refund_total"])
+
+        db.session.refresh(connection)
+        db.session.refresh(single)
+        self.assertTrue(single.refunded)
+        refunded = [t for t in connection.tickets if t.refund_timestamp is not None]
+        self.assertEqual(2, len(refunded))
+        self.assertTrue(all(t.flight_id == flights[0].id for t in refunded))
+        self.assertEqual(self.agent.id, refunded[0].refunded_by)
+        # Both purchases were made by the same customer
+        self.assertEqual(1, EmailOutbox.query.count())
+        self.assertEqual(EmailOutbox.PENDING, EmailOutbox.query.first().status)
+
+        # The number of queries doesn't depend on the number of passengers
+        for _ in range(10):
+            purchase(flights[2], 3)
+        with mock.patch.object(outbox, "notify"), QueryCounter() as large:
+            summary = flights[2].cancel(today, self.agent.id)
+        self.assertEqual(30, summary.passengers)
+        self.assertEqual(small.count, large.count)
+
     def test_available_seats(self):
         today = dt.date.today()
         plane = self.airplanes[0]
@@ -166,10 +349,358 @@ class TestFlight(FlaskTestCase):
                     purchase_price=500,
                 )
             )
+        # Checkout reserves the seats in the flight's inventory
+        self.assertTrue(FlightInstance.sell(flight, today, purchases))
         add_to_db(transaction)
 
         self.assertEquals(plane.capacity - purchases, flight.available_seats(today))
 
+    def test_flight_instance(self):
+        today = dt.date.today()
+        plane = self.airplanes[0]
+        flight = Flight(
+            number="1",
+            airplane_id=plane.id,
+            departure_id=self.airports[0].id,
+            arrival_id=self.airports[1].id,
+            departure_time=dt.time(hour=5, minute=30),
+            start=today,
+            end=today,
+        )
+        add_to_db(flight)
+
+        self.assertTrue(FlightInstance.sell(flight, today, 10))
+        self.assertEqual(plane.capacity - 10, flight.available_seats(today))
+        # Can't sell more seats than are left
+        self.assertFalse(FlightInstance.sell(flight, today, plane.capacity))
+        self.assertEqual(plane.capacity - 10, flight.available_seats(today))
+
+        FlightInstance.release(flight, today, 4)
+        self.assertEqual(plane.capacity - 6, flight.available_seats(today))
+
+        # Cancelled flights don't have any seats
+        flight.cancel(today, self.agent.id)
+        self.assertEqual(0, flight.available_seats(today))
+        self.assertFalse(FlightInstance.sell(flight, today, 1))
+
+
+class TestEmailOutbox(FlaskTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        users = create_users()
+        self.customer = users["customer"]
+        self.agent = users["agent"]
+        airports = list(create_airports(count=2).values())
+        plane = create_airplanes(count=1)[0]
+        today = dt.date.today()
+        self.flight = Flight(
+            number="1",
+            airplane_id=plane.id,
+            departure_id=airports[0].id,
+            arrival_id=airports[1].id,
+            departure_time=dt.time(hour=5, minute=30),
+            start=today,
+            end=today,
+        )
+        add_to_db(self.flight)
+
+        self.transaction = PurchaseTransaction(email=self.customer.email)
+        self.transaction.purchase_price = 500
+        self.transaction.departure_id = airports[0].id
+        self.transaction.destination_id = airports[1].id
+        self.transaction.departure_date = today
+        self.transaction.confirmation_number = "ABC123"
+        for _ in range(2):
+            self.transaction.tickets.append(
+                PurchasedTicket(
+                    flight_id=self.flight.id,
+                    first_name="Fake",
+                    last_name="Person",
+                    date_of_birth=today,
+                    gender="no",
+                    purchase_price=250,
+                )
+            )
+        add_to_db(self.transaction)
+
+    def test_cancel(self):
+        transaction = PurchaseTransaction(email=self.customer.email)
+        transaction.purchase_price = 300
+        transaction.departure_id = self.transaction.departure_id
+        transaction.destination_id = self.transaction.destination_id
+        transaction.departure_date = self.transaction.departure_date
+        transaction.confirmation_number = "DEF456"
+        transaction.tickets.append(
+            PurchasedTicket(
+                flight_id=self.flight.id,
+                first_name="Other",
+                last_name="Person",
+                date_of_birth=dt.date.today(),
+                gender="no",
+                purchase_price=300,
+            )
+        )
+        add_to_db(transaction)
+
+        with mail.record_messages() as outbox_messages:
+            self.flight.cancel(dt.date.today(), self.agent.id)
+
+        # One email per customer, not one per ticket or purchase
+        self.assertEqual(1, len(outbox_messages))
+        message = outbox_messages[0]
+        self.assertEqual([self.customer.email], message.recipients)
+        self.assertEqual("Flight Cancellation", message.subject)
+        self.assertIn("$800.00", message.body)
+        for confirmation_number, refund in (("ABC123", "$500.00"), ("DEF456", "$300.00")):
+            self.assertIn(confirmation_number, message.body)
+            self.assertIn(confirmation_number, message.html)
+            self.assertIn(refund, message.html)
+        email = EmailOutbox.query.one()
+        self.assertEqual(EmailOutbox.SENT, email.status)
+        self.assertEqual(1, email.attempts)
+
+    def test_rollback(self):
+        queue_email(
+            "Your Purchase Confirmation",
+            self.customer.email,
+            "email/purchase_confirmation",
+            transaction=self.transaction,
+        )
+        db.session.rollback()
+        self.assertEqual(0, EmailOutbox.query.count())
+
+    def test_delivery(self):
+        with SMTPSink(failures=1) as sink:
+            self.app.config.update(
+                MAIL_SERVER="127.0.0.1",
+                MAIL_PORT=sink.port,
+                MAIL_USE_TLS=False,
+                MAIL_SUPPRESS_SEND=False,
+            )
+            mail.init_app(self.app)
+
+            queue_email(
+                "Your Purchase Confirmation",
+                self.customer.email,
+                "email/purchase_confirmation",
+                transaction=self.transaction,
+            )
+            db.session.commit()
+
+            # The sink rejects the first attempt so it's retried later
+            self.assertEqual(1, outbox.process())
+            email = EmailOutbox.query.one()
+            self.assertEqual(EmailOutbox.PENDING, email.status)
+            self.assertEqual(1, email.attempts)
+            self.assertGreater(email.next_attempt, dt.datetime.utcnow())
+            self.assertEqual(0, outbox.process())
+
+            email.next_attempt = dt.datetime.utcnow()
+            db.session.commit()
+            self.assertEqual(1, outbox.process())
+
+        email = EmailOutbox.query.one()
+        self.assertEqual(EmailOutbox.SENT, email.status)
+        self.assertEqual(2, email.attempts)
+        self.assertEqual(1, len(sink.messages))
+        recipients, message = sink.messages[0]
+        self.assertEqual([self.customer.email], recipients)
+        self.assertEqual("Your Purchase Confirmation", message["Subject"])
+        self.assertIn("ABC123", message.as_string())
+
+
+class TestAgentSales(FlaskTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        users = create_users()
+        self.customer = users["customer"]
+        self.agent = users["agent"]
+        airports = list(create_airports(count=2).values())
+        plane = create_airplanes(count=1)[0]
+        self.today = dt.datetime.utcnow().date()
+        self.flight = Flight(
+            number="1",
+            airplane_id=plane.id,
+            departure_id=airports[0].id,
+            arrival_id=airports[1].id,
+            departure_time=dt.time(hour=5, minute=30),
+            start=self.today,
+            end=self.today,
+        )
+        add_to_db(self.flight)
+
+    def _sell(self, purchased: dt.datetime, count: int) -> PurchaseTransaction:
+        transaction = PurchaseTransaction(email=self.customer.email)
+        transaction.assisted_by = self.agent.id
+        transaction.purchase_timestamp = purchased
+        transaction.departure_date = self.today
+        transaction.confirmation_number = transaction.generate_confirmation_number(
+            self.customer.email
+        )
+        for _ in range(count):
+            transaction.tickets.append(
+                PurchasedTicket(
+                    flight_id=self.flight.id,
+                    first_name="Fake",
+                    last_name="Person",
+                    date_of_birth=self.today,
+                    gender="no",
+                    purchase_price=100,
+                )
+            )
+        transaction.purchase_price = 100 * count + 10
+        FlightInstance.sell(self.flight, self.today, count)
+        db.session.add(transaction)
+        AgentDailySales.record_sale(transaction)
+        db.session.commit()
+        return transaction
+
+    def _totals(self):
+        return {
+            row.date: (round(row.sales, 2), row.transactions, round(row.refunds, 2))
+            for row in AgentDailySales.query.filter_by(agent_id=self.agent.id)
+        }
+
+    def test_sales(self):
+        first = dt.datetime(2022, 1, 30, 12)
+        self._sell(first, 1)
+        self._sell(first, 2)
+        self._sell(first + dt.timedelta(days=2), 1)
+
+        totals = self._totals()
+        self.assertEqual((320, 2, 0), totals[first.date()])
+        self.assertEqual((110, 1, 0), totals[dt.date(2022, 2, 1)])
+
+        sales = self.agent.sales_by_date(dt.date(2022, 1, 29), dt.date(2022, 2, 1))
+        self.assertEqual(
+            {"2022-01-29": 0, "2022-01-30": 320, "2022-01-31": 0, "2022-02-01": 110},
+            sales,
+        )
+        sales = self.agent.sales_by_month(dt.date(2022, 1, 15), dt.date(2022, 3, 1))
+        self.assertEqual(
+            {"2022-01-01": 320, "2022-02-01": 110, "2022-03-01": 0}, sales
+        )
+
+    def test_refunds(self):
+        purchased = dt.datetime.utcnow() - dt.timedelta(days=3)
+        self._sell(purchased, 2)
+        self._sell(purchased, 1)
+
+        with mock.patch.object(outbox, "notify"):
+            self.flight.cancel(self.today, self.agent.id)
+
+        totals = self._totals()
+        # Sales stay on the day they were made and refunds count on the day they happened
+        self.assertEqual((320, 2, 0), totals[purchased.date()])
+        self.assertEqual((0, 0, 320), totals[self.today])
+
+        AgentDailySales.rebuild()
+        self.assertEqual(totals, self._totals())
+
+
+class TestRebooking(FlaskTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        users = create_users()
+        self.agent = users["agent"]
+        self.airports = list(create_airports(count=3).values())
+        self.airplanes = create_airplanes(count=3)
+        # The later flight only has room for three more passengers
+        self.airplanes[1].capacity = 3
+        db.session.commit()
+
+    def test_plan(self):
+        today = dt.date.today()
+        tomorrow = today + dt.timedelta(days=1)
+        origin, destination = self.airports[0], self.airports[1]
+
+        def flight(number, airplane, hour, date):
+            return Flight(
+                number=number,
+                airplane_id=airplane.id,
+                departure_id=origin.id,
+                arrival_id=destination.id,
+                departure_time=dt.time(hour=hour),
+                start=date,
+                end=date,
+            )
+
+        cancelled = flight("1", self.airplanes[0], 8, today)
+        later = flight("2", self.airplanes[1], 14, today)
+        next_day = flight("3", self.airplanes[2], 10, tomorrow)
+        add_to_db([cancelled, later, next_day])
+
+        purchases = []
+        for i, passengers in enumerate((2, 2, 1)):
+            transaction = PurchaseTransaction(
+                email=f"customer{i}@redeye.app",
+                confirmation_number=f"{i:06}",
+                departure_id=origin.id,
+                destination_id=destination.id,
+                departure_date=today,
+                purchase_price=100 * passengers,
+                purchase_timestamp=dt.datetime(2020, 1, 1, i),
+            )
+            for _ in range(passengers):
+                transaction.tickets.append(
+                    PurchasedTicket(
+                        flight_id=cancelled.id,
+                        first_name=f"Passenger{i}",
+                        last_name="Person",
+                        date_of_birth=today,
+                        gender="no",
+                        purchase_price=100,
+                    )
+                )
+            FlightInstance.sell(cancelled, today, passengers)
+            purchases.append(transaction)
+        add_to_db(purchases)
+
+        # Bought before everyone else but refunded before the cancellation
+        refunded = PurchaseTransaction(
+            email="refunded@redeye.app",
+            confirmation_number="REFUND",
+            departure_id=origin.id,
+            destination_id=destination.id,
+            departure_date=today,
+            purchase_price=100,
+            purchase_timestamp=dt.datetime(2019, 1, 1),
+        )
+        refunded.tickets.append(
+            PurchasedTicket(
+                flight_id=cancelled.id,
+                first_name="Refunded",
+                last_name="Person",
+                date_of_birth=today,
+                gender="no",
+                purchase_price=100,
+                refund_timestamp=dt.datetime.utcnow() - dt.timedelta(hours=1),
+            )
+        )
+        add_to_db(refunded)
+        cancelled.cancel(today, self.agent.id)
+        route_graph.invalidate()
+
+        planner = RebookingPlanner(cancelled, today)
+        proposals = planner.plan()
+        self.assertEqual(
+            [purchase.id for purchase in purchases],
+            [proposal.transaction.id for proposal in proposals],
+        )
+        flights = [
+            [trip_flight.flight.id for trip_flight in proposal.itinerary.flights]
+            for proposal in proposals
+        ]
+        # The first purchase gets the later flight, the second doesn't fit
+        # in what's left so it moves to tomorrow and the last one fills the flight.
+        self.assertEqual([[later.id], [next_day.id], [later.id]], flights)
+        self.assertEqual(tomorrow, proposals[1].itinerary.departure_datetime.date())
+        # Searches are shared between purchases going to the same place
+        self.assertLessEqual(planner.searches, 3)
+
+        # Nothing is booked until an agent books it
+        self.assertEqual(3, later.available_seats(today))
+
 
 class TestTripItinerary(FlaskTestCase):
     def setUp(self) -> None:
@@ -270,3 +801,236 @@ class TestTripItinerary(FlaskTestCase):
         # Verify total time is back to nothing
         itinerary.pop_flight()
         self.assertEquals(dt.timedelta(), itinerary.total_time)
+
+    def create_east_coast_airports(self):
+        """Airports close enough together for short hops."""
+        airports = [
+            Airport(
+                code="ORF",
+                name="Norfolk",
+                timezone="America/New_York",
+                latitude=36.8977,
+                longitude=-76.2154,
+            ),
+            Airport(
+                code="CLT",
+                name="Charlotte",
+                timezone="America/New_York",
+                latitude=35.2140,
+                longitude=-80.9431,
+            ),
+            Airport(
+                code="ATL",
+                name="Atlanta",
+                timezone="America/New_York",
+                latitude=33.6367,
+                longitude=-84.4281,
+            ),
+            Airport(
+                code="JAX",
+                name="Jacksonville",
+                timezone="America/New_York",
+                latitude=30.4941,
+                longitude=-81.6879,
+            ),
+            Airport(
+                code="MIA",
+                name="Miami",
+                timezone="America/New_York",
+                latitude=25.7959,
+                longitude=-80.2870,
+            ),
+        ]
+        add_to_db(airports)
+        return airports
+
+    def test_search(self):
+        today = dt.date.today()
+        norfolk, charlotte, atlanta, _, _ = self.create_east_coast_airports()
+
+        direct = Flight(
+            number="1",
+            airplane_id=self.airplanes[0].id,
+            departure_id=norfolk.id,
+            arrival_id=atlanta.id,
+            departure_time=dt.time(hour=13),
+            start=today,
+            end=today,
+        )
+        leg1 = Flight(
+            number="2",
+            airplane_id=self.airplanes[1].id,
+            departure_id=norfolk.id,
+            arrival_id=charlotte.id,
+            departure_time=dt.time(hour=10),
+            start=today,
+            end=today,
+        )
+        leg2 = Flight(
+            number="3",
+            airplane_id=self.airplanes[2].id,
+            departure_id=charlotte.id,
+            arrival_id=atlanta.id,
+            departure_time=dt.time(hour=14),
+            start=today,
+            end=today,
+        )
+        # Departs before leg1 lands so it should never be used.
+        too_early = Flight(
+            number="4",
+            airplane_id=self.airplanes[3].id,
+            departure_id=charlotte.id,
+            arrival_id=atlanta.id,
+            departure_time=dt.time(hour=10, minute=30),
+            start=today,
+            end=today,
+        )
+        add_to_db([direct, leg1, leg2, too_early])
+
+        departure_dt = dt.datetime.combine(today, dt.time())
+        itineraries = TripItinerary.search(norfolk.id, atlanta.id, departure_dt)
+        flights = [[f.flight.id for f in i.flights] for i in itineraries]
+        # Direct flights should always come first
+        self.assertEqual([[direct.id], [leg1.id, leg2.id]], flights)
+
+        # No layovers should only give us the direct flight
+        itineraries = TripItinerary.search(
+            norfolk.id, atlanta.id, departure_dt, max_layovers=0
+        )
+        self.assertEqual([[direct.id]], [[f.flight.id for f in i.flights] for i in itineraries])
+
+        # Not enough seats on any flight
+        itineraries = TripItinerary.search(
+            norfolk.id, atlanta.id, departure_dt, num_of_passengers=151
+        )
+        self.assertEqual([], itineraries)
+
+        # Cancelled flights should be skipped
+        direct.cancel(today, self.agent.id)
+        itineraries = TripItinerary.search(norfolk.id, atlanta.id, departure_dt)
+        self.assertEqual(
+            [[leg1.id, leg2.id]], [[f.flight.id for f in i.flights] for i in itineraries]
+        )
+
+    def test_search_connection_scan(self):
+        today = dt.date.today()
+        airports = self.create_east_coast_airports()
+        norfolk, charlotte, atlanta, jacksonville, miami = airports
+
+        # A chain of flights from Norfolk to Miami with 3 layovers
+        flights = []
+        for index, hour in enumerate([6, 9, 12, 15]):
+            flights.append(
+                Flight(
+                    number=f"{index + 1}",
+                    airplane_id=self.airplanes[index].id,
+                    departure_id=airports[index].id,
+                    arrival_id=airports[index + 1].id,
+                    departure_time=dt.time(hour=hour),
+                    start=today,
+                    end=today,
+                )
+            )
+        direct = Flight(
+            number="5",
+            airplane_id=self.airplanes[4].id,
+            departure_id=norfolk.id,
+            arrival_id=atlanta.id,
+            departure_time=dt.time(hour=13),
+            start=today,
+            end=today,
+        )
+        add_to_db(flights + [direct])
+
+        departure_dt = dt.datetime.combine(today, dt.time())
+        # Both engines should agree on simple searches
+        for engine in ("dfs", "csa"):
+            itineraries = TripItinerary.search(
+                norfolk.id, atlanta.id, departure_dt, engine=engine
+            )
+            self.assertCountEqual(
+                [[direct.id], [flights[0].id, flights[1].id]],
+                [[f.flight.id for f in i.flights] for i in itineraries],
+            )
+
+        itineraries = TripItinerary.search(
+            norfolk.id, miami.id, departure_dt, engine="csa"
+        )
+        self.assertEqual([], itineraries)
+
+        itineraries = TripItinerary.search(
+            norfolk.id, miami.id, departure_dt, max_layovers=3, engine="csa"
+        )
+        self.assertEqual(
+            [[flight.id for flight in flights]],
+            [[f.flight.id for f in i.flights] for i in itineraries],
+        )
+
+        # Layovers shorter than the minimum should be ignored
+        itineraries = TripItinerary.search(
+            norfolk.id,
+            miami.id,
+            departure_dt,
+            max_layovers=3,
+            min_layover_time=dt.timedelta(hours=3),
+            engine="csa",
+        )
+        self.assertEqual([], itineraries)
+
+        with self.assertRaises(ValueError):
+            TripItinerary.search(norfolk.id, miami.id, departure_dt, engine="bfs")
+
+    def test_stale_graph(self):
+        today = dt.date.today()
+        norfolk, charlotte, atlanta, _, _ = self.create_east_coast_airports()
+
+        def flight(number, airplane, departure, arrival, hour):
+            return Flight(
+                number=number,
+                airplane_id=airplane.id,
+                departure_id=departure.id,
+                arrival_id=arrival.id,
+                departure_time=dt.time(hour=hour),
+                start=today,
+                end=today,
+            )
+
+        direct = flight("1", self.airplanes[0], norfolk, atlanta, 13)
+        leg1 = flight("2", self.airplanes[1], norfolk, charlotte, 10)
+        leg2 = flight("3", self.airplanes[2], charlotte, atlanta, 14)
+        add_to_db([direct, leg1, leg2])
+
+        departure_dt = dt.datetime.combine(today, dt.time())
+        itineraries = TripItinerary.search(norfolk.id, atlanta.id, departure_dt)
+        self.assertEqual(2, len(itineraries))
+
+        # Changes made by another process don't go through the graph.
+        db.session.delete(direct)
+        db.session.commit()
+        richmond = Airport(
+            code="RIC",
+            name="Richmond",
+            timezone="America/New_York",
+            latitude=37.5052,
+            longitude=-77.3197,
+        )
+        add_to_db(richmond)
+        add_to_db(flight("4", self.airplanes[3], richmond, atlanta, 12))
+
+        # Paths using the deleted flight are dropped
+        itineraries = TripItinerary.search(norfolk.id, atlanta.id, departure_dt)
+        self.assertEqual(
+            [[leg1.id, leg2.id]], [[f.flight.id for f in i.flights] for i in itineraries]
+        )
+        # Airports the graph doesn't know about don't have any flights yet
+        for engine in ("dfs", "csa"):
+            self.assertEqual(
+                [],
+                TripItinerary.search(richmond.id, atlanta.id, departure_dt, engine=engine),
+            )
+
+        # The graph is rebuilt once it expires
+        expired = time.monotonic() + self.app.config.get("ROUTE_GRAPH_TIMEOUT", 60) + 1
+        with mock.patch("app.graph.time.monotonic", return_value=expired):
+            itineraries = TripItinerary.search(richmond.id, atlanta.id, departure_dt)
+        self.assertEqual(1, len(itineraries))